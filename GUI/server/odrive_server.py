@@ -10,6 +10,7 @@ import time
 import argparse
 import logging
 import math
+import struct
 import traceback
 import asyncio
 import inspect
@@ -68,6 +69,7 @@ def discovered_device(device):
 
     # add to list of odrives
     print(f"discovered_device: adding {odrive_name}, lock exists: {'odrive_lock' in globals()}")
+    invalidateProperties(odrive_name)
     if 'odrive_lock' in globals():
         with globals()['odrive_lock']:
             globals()['odrives'][odrive_name] = device
@@ -125,6 +127,7 @@ def start_discovery():
 def handle_disconnect(odrive_name):
     print("lost odrive")
     globals()['odrives_status'][odrive_name] = False
+    invalidateProperties(odrive_name)
     # emit the whole list of odrive statuses
     # in the GUI, mark and use status as ODrive state.
     socketio.emit('odrives-status', json.dumps(globals()['odrives_status']))
@@ -144,62 +147,33 @@ def enableSampling(message):
 def stopSampling(message):
     print("sampling disabled")
     session['samplingEnabled'] = False
+    sampling_engine.unsubscribe(request.sid)
     emit('samplingDisabled')
 
 @socketio.on('sampledVarNames')
 def sampledVarNames(message):
     session['sampledVars'] = message
     print(f"sampledVars set: {session['sampledVars']}")
+    if session.get('samplingEnabled', False):
+        try:
+            sampling_engine.update(request.sid, message)
+        except ValueError as ex:
+            print(f"sampledVarNames rejected: {ex}")
+            emit('samplingError', str(ex))
 
 @socketio.on('startSampling')
 def sendSamples(message):
     print(f"startSampling: samplingEnabled={session.get('samplingEnabled', False)}")
-    # Reset debug counter for timing measurements
-    globals()['_sampling_debug_counter'] = 0
-    # Simple blocking loop - Flask-SocketIO threading mode handles this properly
-    iteration = 0
-    last_log_time = time.time()
-    loop_start_time = time.time()
-    while session.get('samplingEnabled', False):
+    if session.get('samplingEnabled', False):
         try:
-            iter_start = time.time()
-            iteration += 1
-
-            # Detailed logging for first iteration only
-            if iteration == 1:
-                print(f"First iteration timing:")
-
-            data = getSampledData(session.get('sampledVars', {'paths': []}))
-
-            if iteration == 1:
-                emit_start = time.time()
-
-            emit('sampledData', json.dumps(data))
+            sampling_engine.subscribe(request.sid, session.get('sampledVars', {'paths': []}))
+        except ValueError as ex:
+            print(f"startSampling rejected: {ex}")
+            emit('samplingError', str(ex))
 
-            if iteration == 1:
-                emit_time = (time.time() - emit_start) * 1000
-                iter_time = (time.time() - iter_start) * 1000
-                print(f"  Iteration time: {iter_time:.0f}ms")
-                print(f"  Sampling rate: ~{1000/iter_time:.1f}Hz")
-
-            # Log statistics every 10 seconds
-            current_time = time.time()
-            if current_time - last_log_time >= 10.0:
-                elapsed = current_time - loop_start_time
-                actual_hz = iteration / elapsed if elapsed > 0 else 0
-                print(f"Sampling: {iteration} samples in {elapsed:.0f}s = {actual_hz:.1f}Hz")
-                last_log_time = current_time
-
-            # No sleep - run at maximum possible speed
-            # (limited by ODrive USB communication speed)
-
-        except Exception as e:
-            print(f"Error in sampling loop at iteration {iteration}: {e}")
-            import traceback
-            traceback.print_exc()
-            break
-
-    print(f"startSampling loop ended after {iteration} iterations")
+@socketio.on('disconnect')
+def clientDisconnected(*args):
+    sampling_engine.unsubscribe(request.sid)
 
 @socketio.on('message')
 def handle_message(message):
@@ -208,19 +182,49 @@ def handle_message(message):
 
 @socketio.on('getODrives')
 def get_odrives(data):
-    print(">>> getODrives called, acquiring lock...")
+    # Sends the structure of all connected ODrives with the values of their
+    # top level properties. The values further down the tree are sent on
+    # demand, see getValues.
+    print(">>> getODrives called")
     with globals()['odrive_lock']:
-        print(">>> getODrives: lock acquired")
-        odriveDict = {}
-        #for (index, odrv) in enumerate(globals()['odrives']):
-        #    odriveDict["odrive" + str(index)] = dictFromRO(odrv)
-        for key in globals()['odrives_status'].keys():
-            if globals()['odrives_status'][key] == True:
-                print(f">>> getODrives: building dict for {key}")
-                odriveDict[key] = dictFromRO(globals()['odrives'][key])
-        print(">>> getODrives: emitting odrives")
-        emit('odrives', json.dumps(odriveDict))
-    print(">>> getODrives: lock released, done")
+        devices = {key: globals()['odrives'][key] for key, status in globals()['odrives_status'].items() if status}
+    odriveDict = {}
+    for key, device in devices.items():
+        schema = getSchema(key, device)
+        if schema is None:
+            # fibre versions that don't describe their interface
+            print(f">>> getODrives: building dict for {key}")
+            odriveDict[key] = dictFromRO(device)
+            continue
+        tree, leaves = schema
+        tree = dict(tree)
+        for path, val in readValues([leaf for leaf in leaves if leaf.count('.') == 1]).items():
+            tree[path.split('.')[1]] = dict(tree[path.split('.')[1]], val=val)
+        odriveDict[key] = tree
+    print(">>> getODrives: emitting odrives")
+    emit('odrives', json.dumps(odriveDict))
+
+@socketio.on('getValues')
+def get_values(message):
+    # message is {"paths": ["odriveX", "odriveX.axisY...", ...], "full": true/false, "id": n}
+    # Reads all properties at or below the paths at once and replies with
+    # {"paths": paths, "values": {"odriveX.axisY.blah": val}, "id": n},
+    # containing only the values that changed since the last getValues of this
+    # client, unless "full" is set. The GUI asks for the values that it shows
+    # and for the subtrees that the user expands.
+    paths = message.get("paths", [message["path"]] if "path" in message else [])
+    leaves = {} # used as ordered set
+    for path in paths:
+        odrv = path.split('.')[0]
+        if not globals()['odrives_status'].get(odrv, False):
+            continue
+        schema = getSchema(odrv, globals()['odrives'][odrv])
+        if schema is None:
+            continue
+        prefix = path + '.'
+        leaves.update((leaf, None) for leaf in schema[1] if leaf.startswith(prefix) or leaf == path)
+    values = readValues(list(leaves), session, message.get("full", False)) if len(leaves) else {}
+    emit('ODriveValues', json.dumps({"paths": paths, "values": values, "id": message.get("id", None)}))
 
 @socketio.on('getProperty')
 def get_property(message):
@@ -441,6 +445,79 @@ def dictFromRO(RO):
 
     return returnDict
 
+# Timeout for each property read of getValues and getODrives
+VALUES_TIMEOUT = 1.0
+
+def schemaFromRO(RO, prefix, leaves):
+    """
+    Create the structure of an ODrive RemoteObject without reading any value.
+    Properties are {"val": None, "readonly": ..., "type": ...} like in
+    dictFromRO(). The paths of all properties that can be read as a value are
+    appended to leaves.
+    """
+    schema = {}
+    for key in dir(RO):
+        if key.startswith('_'):
+            continue
+        member = getattr(type(RO), key, None)
+        if isinstance(member, fibre.libfibre.RemoteFunction):
+            schema[key] = "function"
+        elif isinstance(member, fibre.libfibre.RemoteAttribute) and member._magic_getter:
+            _type = getattr(type(member._get_obj(RO)).read, '_outputs', [(None, "unknown")])[0][1]
+            schema[key] = {
+                "val": None,
+                "readonly": not member._magic_setter,
+                "type": _type
+            }
+            if _type != 'object_ref':
+                leaves.append(prefix + key)
+        elif isinstance(member, fibre.libfibre.RemoteAttribute):
+            schema[key] = schemaFromRO(member._get_obj(RO), prefix + key + '.', leaves)
+    return schema
+
+def getSchema(odrive_name, device):
+    # Returns (structure, paths of all properties) for the ODrive, or None if
+    # the fibre version doesn't describe its interface. The structure of a
+    # connection doesn't change so it's only built once.
+    schema = schema_cache.get(odrive_name, None)
+    if schema is None:
+        libfibre = getattr(fibre, 'libfibre', None)
+        if not isinstance(device, getattr(libfibre, 'RemoteObject', ())):
+            return None
+        with property_cache_lock:
+            generation = property_cache_generation
+        leaves = []
+        schema = (schemaFromRO(device, odrive_name + '.', leaves), leaves)
+        with property_cache_lock:
+            if generation == property_cache_generation:
+                schema_cache[odrive_name] = schema
+    return schema
+
+def toTreeValue(val):
+    # same representation as the values of dictFromRO()
+    if val == math.inf:
+        return "Infinity"
+    elif val == -math.inf:
+        return "-Infinity"
+    return str(val)
+
+def readValues(paths, session=None, full=True):
+    # Reads all paths at once and returns {path: value} for the object tree.
+    # If a session is given, the values are remembered and unless full is set,
+    # only the values that changed since the last call for the same session
+    # are returned.
+    values = readPlan(SamplingPlan(globals()['odrives'], {'paths': paths, 'timeout': VALUES_TIMEOUT}))
+    values = {path: val for path, val in values.items() if val is not None}
+    if not session is None:
+        if session.get('sentValuesGeneration', None) != property_cache_generation:
+            session['sentValues'] = {}
+            session['sentValuesGeneration'] = property_cache_generation
+        sent = session['sentValues']
+        if not full:
+            values = {path: val for path, val in values.items() if sent.get(path, None) != val}
+        sent.update(values)
+    return {path: toTreeValue(val) for path, val in values.items()}
+
 def postVal(odrives, keyList, value, argType):
     # expect a list of keys in the form of ["key1", "key2", "keyN"]
     # "key1" will be "odriveN"
@@ -448,12 +525,8 @@ def postVal(odrives, keyList, value, argType):
     print(f"postVal: keyList={keyList}, value={value}, argType={argType}")
     odrv = None
     try:
-        odrv = keyList.pop(0)
-        RO = odrives[odrv]
-        keyList[-1] = '_' + keyList[-1] + '_property'
-        print(f"postVal: Getting property path: {keyList}")
-        for key in keyList:
-            RO = getattr(RO, key)
+        odrv = keyList[0]
+        RO = getProperty(odrives, '.'.join(keyList))
         print(f"postVal: Got property object, writing value...")
         if argType == "number":
             ensure_event_loop()
@@ -481,23 +554,96 @@ def postVal(odrives, keyList, value, argType):
                 handle_disconnect(odrv)
         print("exception in postVal: ", traceback.format_exc())
 
+# Cache of compiled property paths {"odriveN.axisY.blah": property object}.
+# The property objects belong to one connection, so the entries of an ODrive
+# are dropped when it disconnects or is discovered again. Every invalidation
+# increments the generation so that compiled SamplingPlans notice it.
+property_cache = {}
+property_cache_lock = threading.Lock()
+property_cache_generation = 0
+schema_cache = {} # {odrive name: (structure, paths of all properties)}
+
+def invalidateProperties(odrive_name):
+    global property_cache_generation
+    with property_cache_lock:
+        prefix = odrive_name + '.'
+        for path in [path for path in property_cache if path.startswith(prefix)]:
+            del property_cache[path]
+        schema_cache.pop(odrive_name, None)
+        property_cache_generation += 1
+
+def resolveProperty(device, subpath):
+    # subpath is relative to the ODrive, e.g. "axis0.encoder.pos_estimate"
+    if hasattr(device, '_resolve_path'):
+        return device._resolve_path(subpath)
+    keys = subpath.split('.')
+    keys[-1] = '_' + keys[-1] + '_property'
+    RO = device
+    for key in keys:
+        RO = getattr(RO, key)
+    return RO
+
+def getProperty(odrives, path):
+    # Returns the property object for "odriveN.axisY.blah". The path is only
+    # parsed and traversed the first time, after that it comes from the cache.
+    prop = property_cache.get(path, None)
+    if prop is None:
+        with property_cache_lock:
+            generation = property_cache_generation
+        odrv, _, subpath = path.partition('.')
+        if not globals()['odrives_status'].get(odrv, False):
+            raise Exception(f"{odrv} is not connected")
+        prop = resolveProperty(odrives[odrv], subpath)
+        with property_cache_lock:
+            # don't cache objects of a connection that was lost in the meantime
+            if generation == property_cache_generation:
+                property_cache[path] = prop
+    return prop
+
+class SamplingPlan():
+    # The sampled paths of a session compiled to property objects and grouped
+    # by ODrive, so that the sampling loop does no path parsing and no
+    # attribute lookups. The plan must be recompiled when is_valid() returns
+    # False.
+    def __init__(self, odrives, sampledVars):
+        self.sampledVars = sampledVars
+        self.generation = property_cache_generation
+        self.timeout = sampledVars.get("timeout", SAMPLE_TIMEOUT)
+        # Remove duplicates to avoid redundant reads
+        self.paths = list(dict.fromkeys(sampledVars.get("paths", [])))
+        self.groups = [] # (odrive name, device, [path], [property object])
+        self.failed = [] # paths that could not be resolved
+        self.column_types = {} # {path: column type in binary frames}
+        groups = {}
+        for path in self.paths:
+            try:
+                prop = getProperty(odrives, path)
+            except Exception as ex:
+                print(f"cannot sample {path}: {ex}")
+                self.failed.append(path)
+                self.column_types[path] = 'f32'
+                continue
+            self.column_types[path] = getColumnType(prop)
+            odrv = path.partition('.')[0]
+            if not odrv in groups:
+                groups[odrv] = (odrv, odrives[odrv], [], [])
+                self.groups.append(groups[odrv])
+            groups[odrv][2].append(path)
+            groups[odrv][3].append(prop)
+        self.concurrent = len(self.groups) > 0 and all(hasattr(device, '_read_many') for _, device, _, _ in self.groups)
+
+    def is_valid(self, sampledVars):
+        return sampledVars is self.sampledVars and self.generation == property_cache_generation
+
 def getVal(odrives, keyList):
     odrv = None
     try:
-        original_path = '.'.join(keyList)  # Save before modifying keyList
-        odrv = keyList.pop(0)
-        RO = odrives[odrv]
-        keyList[-1] = '_' + keyList[-1] + '_property'
-        for key in keyList:
-            RO = getattr(RO, key)
+        original_path = '.'.join(keyList)
+        odrv = keyList[0]
+        RO = getProperty(odrives, original_path)
         ensure_event_loop()
         # Use very short timeout for sampling (0.1s)
-        retVal = await_if_coroutine(RO.read(), timeout=0.1)
-        if retVal == math.inf:
-            retVal = "Infinity"
-        elif retVal == -math.inf:
-            retVal = "-Infinity"
-        return retVal
+        return toSample(await_if_coroutine(RO.read(), timeout=SAMPLE_TIMEOUT))
     except asyncio.TimeoutError:
         print(f"Timeout reading {original_path}")
         return 0
@@ -510,10 +656,288 @@ def getVal(odrives, keyList):
         print(f"exception in getVal({original_path}): {ex}")
         return 0
 
-def getSampledData(vars):
-    #use getVal to populate a dict
-    #return a dict {path:value}
-    start_time = time.time()
+# Time (in seconds) that a single sampled property may take before the frame
+# is sent without it. A slow property doesn't delay the other ones.
+SAMPLE_TIMEOUT = 0.1
+
+def toSample(val):
+    if val == math.inf:
+        return "Infinity"
+    elif val == -math.inf:
+        return "-Infinity"
+    return val
+
+# Default sampling rate in Hz. Clients can ask for a different rate with a
+# "rate" entry in sampledVarNames; the engine runs at the highest one.
+SAMPLE_RATE = 100.0
+# Requested rates are clamped to this range
+MIN_SAMPLE_RATE = 1.0
+MAX_SAMPLE_RATE = 1000.0
+
+# Binary frames are sent at most every FRAME_INTERVAL seconds and contain
+# all samples that were taken in the meantime.
+FRAME_INTERVAL = 0.05
+MAX_SAMPLES_PER_FRAME = 1000
+
+# The sample count, the missing value count and the indices of the missing
+# values are uint16 in binary frames. A subscription with more paths is
+# rejected and one with many paths sends fewer samples per frame, so that even
+# a frame where every value is missing can be packed.
+MAX_FRAME_COUNT = 0xFFFF
+
+# Column types of binary frames and their struct format
+COLUMN_FORMATS = {'f32': 'f', 'i32': 'i', 'u32': 'I', 'f64': 'd'}
+CODEC_COLUMN_TYPES = {
+    'float': 'f32', 'bool': 'i32', 'int8': 'i32', 'uint8': 'i32',
+    'int16': 'i32', 'uint16': 'i32', 'int32': 'i32', 'uint32': 'u32'
+}
+
+def getColumnType(prop):
+    # The column type for the declared type of the property. 64-bit integers
+    # and properties of fibre versions that don't declare a type use f64.
+    try:
+        return CODEC_COLUMN_TYPES.get(str(type(prop).read._outputs[0][1]), 'f64')
+    except Exception:
+        return 'f64'
+
+def packSampleFrame(table_id, column_types, times, rows):
+    # Packs the samples of one subscription into a binary frame (little endian):
+    #   uint32   id of the path table (see 'sampledPaths')
+    #   uint16   number of samples N
+    #   uint16   number of missing values M
+    #   float64  time[N] in seconds since sampling started
+    #   for each column of the path table: N values of the column type
+    #   M times uint16 sample index, uint16 column index of the values that
+    #            could not be read (they are sent as 0)
+    # rows is a list with one list of values (or None) per sample.
+    n = len(times)
+    if n * len(column_types) > MAX_FRAME_COUNT:
+        raise ValueError(f"{n} samples of {len(column_types)} paths don't fit into one frame")
+    missing = []
+    columns = []
+    for col, (column_type, values) in enumerate(zip(column_types, zip(*rows))):
+        fmt = '<%d%s' % (n, COLUMN_FORMATS[column_type])
+        if None in values:
+            missing += [(i, col) for i, val in enumerate(values) if val is None]
+            values = [0 if val is None else val for val in values]
+        try:
+            columns.append(struct.pack(fmt, *values))
+        except (struct.error, TypeError):
+            missing += [(i, col) for i in range(n)]
+            columns.append(struct.pack(fmt, *([0] * n)))
+    missing.sort()
+    return b''.join([
+        struct.pack('<IHH', table_id, n, len(missing)),
+        struct.pack('<%dd' % n, *times)
+    ] + columns + [struct.pack('<HH', i, col) for i, col in missing])
+
+class SamplingSubscription():
+    def __init__(self, sampledVars, start_time):
+        self.sampledVars = sampledVars
+        paths = sampledVars.get("paths", [])
+        if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+            raise ValueError(f"paths must be a list of strings, got {paths!r}")
+        self.paths = list(dict.fromkeys(paths))
+        self.rate = self._positive(sampledVars, "rate", SAMPLE_RATE)
+        self.timeout = self._positive(sampledVars, "timeout", SAMPLE_TIMEOUT)
+        self.start_time = start_time
+        # A client that asks for the "binary" format first receives a path
+        # table and then frames with several samples at once.
+        self.binary = sampledVars.get("format", "json") == "binary"
+        self.max_samples = MAX_SAMPLES_PER_FRAME
+        if self.binary:
+            if len(self.paths) > MAX_FRAME_COUNT:
+                raise ValueError(f"cannot sample {len(self.paths)} paths in binary frames, at most {MAX_FRAME_COUNT} are supported")
+            self.max_samples = min(MAX_SAMPLES_PER_FRAME, MAX_FRAME_COUNT // max(len(self.paths), 1))
+        self.plan = None # the plan that the current path table belongs to
+        self.table_id = 0
+        self.column_types = []
+        self.times = [] # samples that were not sent yet
+        self.rows = []
+        self.last_send_time = start_time
+
+    @staticmethod
+    def _positive(sampledVars, key, default):
+        val = sampledVars.get(key, default)
+        if isinstance(val, bool) or not isinstance(val, (int, float)) or not math.isfinite(val) or val <= 0:
+            raise ValueError(f"{key} must be a positive number, got {val!r}")
+        return float(val)
+
+class SamplingEngine():
+    # Samples the union of the paths of all subscribed clients on a single
+    # background thread and sends each client only its own paths. Each ODrive
+    # is read once per frame, however many clients subscribed to it, so the
+    # load scales with the number of devices rather than with the number of
+    # browser tabs.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {} # {sid: SamplingSubscription}
+        self._sampledVars = {'paths': []} # union of all subscriptions
+        self._running = False
+        self._table_id = 0
+
+    def _update_union(self):
+        # must be called with _lock held
+        paths = [path for sub in self._subscriptions.values() for path in sub.paths]
+        rates = [sub.rate for sub in self._subscriptions.values()]
+        timeouts = [sub.timeout for sub in self._subscriptions.values()]
+        self._sampledVars = {
+            'paths': list(dict.fromkeys(paths)),
+            'rate': min(max(max(rates, default=SAMPLE_RATE), MIN_SAMPLE_RATE), MAX_SAMPLE_RATE),
+            'timeout': min(timeouts, default=SAMPLE_TIMEOUT)
+        }
+
+    def subscribe(self, sid, sampledVars):
+        # raises ValueError if the client can't be sampled as requested
+        subscription = SamplingSubscription(sampledVars, time.time())
+        with self._lock:
+            self._subscriptions[sid] = subscription
+            self._update_union()
+            # Reset debug counter for timing measurements
+            globals()['_sampling_debug_counter'] = 0
+            if not self._running:
+                self._running = True
+                socketio.start_background_task(self._run)
+
+    def update(self, sid, sampledVars):
+        # changes the paths of a client without restarting its time axis.
+        # Raises ValueError like subscribe(), the old paths stay sampled then.
+        with self._lock:
+            if sid in self._subscriptions:
+                self._subscriptions[sid] = SamplingSubscription(sampledVars, self._subscriptions[sid].start_time)
+                self._update_union()
+
+    def unsubscribe(self, sid):
+        with self._lock:
+            if self._subscriptions.pop(sid, None) is not None:
+                self._update_union()
+
+    def _run(self):
+        print("sampling engine started")
+        plan = None
+        iteration = 0
+        loop_start_time = last_log_time = next_time = time.time()
+        while True:
+            with self._lock:
+                if len(self._subscriptions) == 0:
+                    self._running = False
+                    break
+                subscriptions = list(self._subscriptions.items())
+                sampledVars = self._sampledVars
+
+            interval = 1.0 / SAMPLE_RATE
+            try:
+                interval = 1.0 / sampledVars['rate']
+                if plan is None or not plan.is_valid(sampledVars):
+                    plan = SamplingPlan(globals()['odrives'], sampledVars)
+                frame = getSampledData(plan)
+                iteration += 1
+
+                # frames are empty while a write operation is in progress
+                if len(frame) > 0:
+                    for sid, sub in subscriptions:
+                        if sub.binary:
+                            self._send_binary(sid, sub, plan, frame)
+                        else:
+                            data = {path: toSample(frame[path]) for path in sub.paths}
+                            data["time"] = frame["time"] - sub.start_time
+                            socketio.emit('sampledData', json.dumps(data), to=sid)
+            except Exception as e:
+                print(f"Error in sampling engine at iteration {iteration}: {e}")
+                traceback.print_exc()
+
+            # Log statistics every 10 seconds
+            current_time = time.time()
+            if current_time - last_log_time >= 10.0:
+                elapsed = current_time - loop_start_time
+                print(f"Sampling: {iteration} samples in {elapsed:.0f}s = {iteration / elapsed:.1f}Hz for {len(subscriptions)} clients")
+                last_log_time = current_time
+
+            next_time += interval
+            if next_time > current_time:
+                time.sleep(next_time - current_time)
+            else:
+                next_time = current_time # fell behind, don't try to catch up
+
+        print(f"sampling engine stopped after {iteration} iterations")
+
+    def _send_binary(self, sid, sub, plan, frame):
+        if not sub.plan is plan:
+            # the column types may have changed, announce a new path table
+            self._flush(sid, sub)
+            self._table_id += 1
+            sub.plan = plan
+            sub.table_id = self._table_id
+            sub.column_types = [plan.column_types[path] for path in sub.paths]
+            socketio.emit('sampledPaths', json.dumps({
+                'id': sub.table_id, 'paths': sub.paths, 'types': sub.column_types
+            }), to=sid)
+        sub.times.append(frame["time"] - sub.start_time)
+        sub.rows.append([frame[path] for path in sub.paths])
+        if frame["time"] - sub.last_send_time >= FRAME_INTERVAL or len(sub.times) >= sub.max_samples:
+            self._flush(sid, sub)
+            sub.last_send_time = frame["time"]
+
+    def _flush(self, sid, sub):
+        if len(sub.times) > 0:
+            socketio.emit('sampledFrame', packSampleFrame(sub.table_id, sub.column_types, sub.times, sub.rows), to=sid)
+            sub.times = []
+            sub.rows = []
+
+sampling_engine = SamplingEngine()
+
+def readProperty(prop, timeout):
+    # returns the value or the exception that occurred
+    try:
+        ensure_event_loop()
+        return await_if_coroutine(prop.read(), timeout=timeout)
+    except Exception as ex:
+        return ex
+
+def readAllConcurrently(plan):
+    # Starts the reads of all paths of all ODrives at the same time on the
+    # Fibre event loop and waits until every read completed or timed out.
+    # Returns one tuple per group of the plan with one value or exception per
+    # path.
+    loop = plan.groups[0][1]._libfibre.loop
+    return fibre.libfibre.run_coroutine_threadsafe(loop,
+        lambda: asyncio.gather(*[device._read_many(props, plan.timeout) for _, device, _, props in plan.groups]))
+
+def readPlan(plan):
+    # Reads all paths of a SamplingPlan and returns {path: value}. Properties
+    # that could not be read are None.
+    if plan.concurrent:
+        try:
+            results = readAllConcurrently(plan)
+        except Exception as e:
+            print(f"Error reading sampled properties: {e}")
+            results = [[e] * len(props) for _, _, _, props in plan.groups]
+    else:
+        # Fibre versions without concurrent reads: read one property after the
+        # other
+        results = [[readProperty(prop, plan.timeout) for prop in props] for _, _, _, props in plan.groups]
+
+    values = {}
+    for (odrv, _, paths, _), group_values in zip(plan.groups, results):
+        lost = False
+        for path, val in zip(paths, group_values):
+            if isinstance(val, Exception):
+                if isinstance(val, getattr(fibre, 'ObjectLostError', ())) or 'lost' in str(val).lower():
+                    lost = True
+                elif globals().get('_sampling_debug_counter', 0) == 0:
+                    print(f"    {path}: {val}")
+                val = None
+            values[path] = val
+        if lost:
+            handle_disconnect(odrv)
+    for path in plan.failed:
+        values[path] = None
+    return values
+
+def getSampledData(plan):
+    #return one frame {"time": t, path: value} for a SamplingPlan
+    #"time" is the time.time() at which the reads were issued. Properties that
+    #could not be read are None.
     samples = {}
 
     # Skip sampling if a write operation is in progress
@@ -522,31 +946,18 @@ def getSampledData(vars):
 
     # Read operations don't need lock - fibre library is thread-safe for reads
     # Only write operations (setProperty) need exclusive access
-    paths = vars.get("paths", [])
-
-    # Remove duplicates to avoid redundant reads
-    unique_paths = list(dict.fromkeys(paths))
 
     # Log timing for first sample only
     debug_first = globals().get('_sampling_debug_counter', 0) == 0
 
-    for i, path in enumerate(unique_paths):
-        try:
-            path_start = time.time()
-            keys = path.split('.')
-            val = getVal(globals()['odrives'], keys)
-            samples[path] = val
-            path_time = (time.time() - path_start) * 1000
-
-            if debug_first:
-                print(f"    {path}: {path_time:.0f}ms")
-        except Exception as e:
-            print(f"Error reading {path}: {e}")
-            samples[path] = 0  # Return 0 on error to keep sampling going
+    start_time = time.time()
+    samples["time"] = start_time
+
+    samples.update(readPlan(plan))
 
     total_time = (time.time() - start_time) * 1000
     if debug_first:
-        print(f"  Total read time: {total_time:.0f}ms for {len(unique_paths)} properties")
+        print(f"  Total read time: {total_time:.0f}ms for {len(plan.paths)} properties")
         globals()['_sampling_debug_counter'] = 1
 
     return samples
@@ -575,7 +986,10 @@ if __name__ == "__main__":
     #print(sys.argv[1:])
     # try to import based on command line arguments or config file
 
+    no_daemon = '--no-daemon' in sys.argv[1:]
     for optPath in sys.argv[1:]:
+        if optPath == '--no-daemon':
+            continue
         print("adding " + str(optPath.rstrip()) + " to import path for odrive_server.py")
         sys.path.insert(0,optPath.rstrip())
 
@@ -583,6 +997,20 @@ if __name__ == "__main__":
     import odrive.utils # for dump_errors()
     import fibre
 
+    # While an odrivetool daemon runs it holds the connections to the ODrives
+    # and the server would wait forever for a device.
+    try:
+        import odrive.daemon
+        daemon_running = not no_daemon and odrive.daemon.is_daemon_running()
+    except ImportError:
+        daemon_running = False # odrive package without daemon support
+    if daemon_running:
+        message = ("An odrivetool daemon is running and holds the connections to the ODrives. "
+                   "Stop the daemon or, if it serves different devices, start the server with --no-daemon.")
+        print(message)
+        sys.__stderr__.write(message + "\n")
+        sys.exit(1)
+
     # global for holding references to all connected odrives
     globals()['odrives'] = {}
     # global dict {'odriveX': True/False} where True/False reflects status of connection
@@ -0,0 +1,54 @@
+// decoding of the binary sample frames sent by odrive_server.py
+
+// byte size and DataView getter for each column type of a path table
+const columnTypes = {
+    f32: { size: 4, get: (view, offset) => view.getFloat32(offset, true) },
+    i32: { size: 4, get: (view, offset) => view.getInt32(offset, true) },
+    u32: { size: 4, get: (view, offset) => view.getUint32(offset, true) },
+    f64: { size: 8, get: (view, offset) => view.getFloat64(offset, true) },
+};
+
+// given a path table {id, paths, types} (from a 'sampledPaths' message) and a
+// binary 'sampledFrame' message, return {time: [t0, t1, ...], values: {path: [v0, v1, ...]}}
+// values that the server could not read are null.
+// returns undefined if the frame belongs to a different path table.
+export let decodeSampleFrame = (table, buffer) => {
+    const bytes = buffer instanceof ArrayBuffer ? new Uint8Array(buffer) : buffer;
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    if (!table || view.getUint32(0, true) != table.id) {
+        return undefined;
+    }
+    const n = view.getUint16(4, true);
+    const nMissing = view.getUint16(6, true);
+    let offset = 8;
+
+    let time = new Array(n);
+    for (let i = 0; i < n; i++) {
+        time[i] = view.getFloat64(offset, true);
+        offset += 8;
+    }
+
+    let columns = [];
+    for (const type of table.types) {
+        const columnType = columnTypes[type];
+        let column = new Array(n);
+        for (let i = 0; i < n; i++) {
+            column[i] = columnType.get(view, offset);
+            offset += columnType.size;
+        }
+        columns.push(column);
+    }
+
+    for (let m = 0; m < nMissing; m++) {
+        const i = view.getUint16(offset, true);
+        const col = view.getUint16(offset + 2, true);
+        columns[col][i] = null;
+        offset += 4;
+    }
+
+    let values = {};
+    table.paths.forEach((path, col) => {
+        values[path] = columns[col];
+    });
+    return { time: time, values: values };
+}
@@ -4,6 +4,7 @@ import TuningDashOld from "./assets/dashboards/Tuning_0_4_12.json";
 import TuningDashNew from "./assets/dashboards/Tuning_0_5_1.json";
 import * as socketio from "./comms/socketio";
 import {filterBy, deleteBy } from "./lib/utils.js";
+import { decodeSampleFrame } from "./lib/sample_frames.js";
 //import { v4 as uuidv4 } from "uuid";
 
 
@@ -11,6 +12,12 @@ import {filterBy, deleteBy } from "./lib/utils.js";
 
 Vue.use(Vuex);
 
+// getValues requests that wait for their ODriveValues reply, {id: resolve}
+let valueRequests = {};
+let nextValueRequestId = 0;
+// paths whose values were loaded since the last odrives message
+let loadedValuePaths = new Set();
+
 export default new Vuex.Store({
     // state is the data for this app
     state: {
@@ -30,6 +37,7 @@ export default new Vuex.Store({
             },
         ],
         timeSampleStart: 0,
+        sampleTable: null, // path table of the binary sample frames, {id, paths, types}
         sampledProperties: [], // make this an object where the full path is a key and the value is the sampled var
         propSamples: { time: [] }, // {time: [time values], ...path: [path var values]}
         newData: false,
@@ -53,6 +61,7 @@ export default new Vuex.Store({
         },
         setOdrives(state, odrives) {
             state.odrives = odrives;
+            loadedValuePaths = new Set();
             if (state.firstConn == false) {
                 // first time we're getting odrive data, add correct config page
                 let TuningDash;
@@ -84,7 +93,8 @@ export default new Vuex.Store({
                         socketio.sendEvent({
                             type: 'sampledVarNames',
                             data: {
-                                paths: state.sampledProperties
+                                paths: state.sampledProperties,
+                                format: "binary"
                             }
                         });
                     }
@@ -92,12 +102,29 @@ export default new Vuex.Store({
             }
             state.firstConn = true;
         },
+        updateOdriveValues(state, payload) {
+            // payload is {paths, values: {path: val}} with values formatted
+            // like in the tree sent by getODrives
+            for (const path of Object.keys(payload.values)) {
+                let ref = state.odrives;
+                for (const key of path.split('.')) {
+                    ref = ref === undefined ? undefined : ref[key];
+                }
+                if (ref !== undefined) {
+                    Vue.set(ref, "val", payload.values[path]);
+                }
+            }
+        },
         setOdriveConfigs(state, payload) {
-            state.odriveConfigs['full'] = payload.full;
-            state.odriveConfigs['functions'] = payload.functions;
-            state.odriveConfigs['params'] = payload.params;
-            state.odriveConfigs['writeAble'] = payload.writeAble;
-            state.odriveConfigs['writeAbleNumeric'] = payload.writeAbleNumeric;
+            // replaced as a whole so that the parameter tree shows values
+            // that are loaded while it is open
+            state.odriveConfigs = {
+                full: payload.full,
+                functions: payload.functions,
+                params: payload.params,
+                writeAble: payload.writeAble,
+                writeAbleNumeric: payload.writeAbleNumeric,
+            };
         },
         setODrivesStatus(state, obj) {
             // obj is {"odriveX": true/false}
@@ -145,7 +172,8 @@ export default new Vuex.Store({
             socketio.sendEvent({
                 type: 'sampledVarNames',
                 data: {
-                    paths: state.sampledProperties
+                    paths: state.sampledProperties,
+                    format: "binary"
                 }
             });
         },
@@ -158,19 +186,47 @@ export default new Vuex.Store({
             }
         },
         updateSampledProperty(state, payload) {
-            // payload is object of paths and values
+            // payload is object of paths and values, plus the time at which
+            // the server sampled them
             for (const path of Object.keys(payload)) {
+                if (path == "time" || !(path in state.propSamples)) {
+                    continue;
+                }
                 state.propSamples[path].push(payload[path]);
                 if (state.propSamples[path].length > 250) {
                     state.propSamples[path].splice(0, 1); // emulate circular buffer
                 }
             }
-            state.propSamples["time"].push((Date.now() - state.timeSampleStart) / 1000);
+            if ("time" in payload) {
+                state.propSamples["time"].push(payload["time"]);
+            } else {
+                state.propSamples["time"].push((Date.now() - state.timeSampleStart) / 1000);
+            }
             if (state.propSamples["time"].length > 250) {
                 state.propSamples["time"].splice(0, 1);
             }
             state.newData = true;
         },
+        updateSampledFrame(state, payload) {
+            // payload is a decoded binary frame {time: [...], values: {path: [...]}}
+            for (const path of Object.keys(payload.values)) {
+                if (!(path in state.propSamples)) {
+                    continue;
+                }
+                state.propSamples[path].push(...payload.values[path]);
+                if (state.propSamples[path].length > 250) {
+                    state.propSamples[path].splice(0, state.propSamples[path].length - 250);
+                }
+            }
+            state.propSamples["time"].push(...payload.time);
+            if (state.propSamples["time"].length > 250) {
+                state.propSamples["time"].splice(0, state.propSamples["time"].length - 250);
+            }
+            state.newData = true;
+        },
+        setSampleTable(state, table) {
+            state.sampleTable = table;
+        },
         logServerMessage(state, payload) {
             // payload is string
             state.serverOutput.push(payload);
@@ -325,6 +381,45 @@ export default new Vuex.Store({
                                                 writeAble: treeParse(writeAble),
                                                 writeAbleNumeric: treeParse(writeAbleNumeric)});
         },
+        loadOdriveValues(context, paths) {
+            // ask for the values of all properties at or below the paths
+            // (e.g. "odrive0.axis0.controller"). The server only sends the
+            // values that changed since it last sent them, unless a path
+            // wasn't loaded since the ODrives were (re)connected.
+            // Returns a promise that resolves when the values arrived.
+            paths = paths.filter(path => context.state.ODrivesConnected[path.split('.')[0]]);
+            if (paths.length == 0) {
+                return Promise.resolve();
+            }
+            const full = paths.some(path => !loadedValuePaths.has(path));
+            paths.forEach(path => loadedValuePaths.add(path));
+            const id = nextValueRequestId++;
+            return new Promise(resolve => {
+                valueRequests[id] = resolve;
+                socketio.sendEvent({
+                    type: "getValues",
+                    data: {paths: paths, full: full, id: id},
+                });
+            });
+        },
+        loadShownValues(context) {
+            // load the values that the current dashboard shows. Everything
+            // else is loaded when it's needed, e.g. when a subtree of the
+            // parameter tree is expanded.
+            let paths = [...context.state.sampledProperties];
+            const dash = context.state.dashboards.find(dash => dash.name === context.state.currentDash);
+            if (dash && dash.component === "Wizard") {
+                // the wizard works on the configuration of the whole ODrive
+                paths = paths.concat(Object.keys(context.state.odrives));
+            }
+            else if (dash) {
+                // paths of dashboard items start with "odrives."
+                for (const item of (dash.controls || []).concat(dash.actions || [])) {
+                    paths.push(item.path.split('.').slice(1).join('.'));
+                }
+            }
+            return context.dispatch('loadOdriveValues', paths);
+        },
         getAxes(context) {
             let axes = [];
             //for each connected odrive, collect axes and display them
@@ -385,6 +480,29 @@ export default new Vuex.Store({
                     context.commit("updateSampledProperty", data);
                 }
             });
+            socketio.addEventListener({
+                type: "sampledPaths",
+                callback: message => {
+                    context.commit("setSampleTable", Object.freeze(JSON.parse(message)));
+                }
+            });
+            socketio.addEventListener({
+                type: "sampledFrame",
+                callback: message => {
+                    // frames of an outdated path table are dropped
+                    const frame = decodeSampleFrame(context.state.sampleTable, message);
+                    if (frame) {
+                        context.commit("updateSampledFrame", frame);
+                    }
+                }
+            });
+            socketio.addEventListener({
+                type: "samplingError",
+                callback: message => {
+                    // the server rejected the sampled paths
+                    console.error("sampling rejected by server:", message);
+                }
+            });
             socketio.addEventListener({
                 type: "samplingEnabled",
                 callback: () => {
@@ -398,9 +516,25 @@ export default new Vuex.Store({
             socketio.addEventListener({
                 type: "odrives",
                 callback: odrives => {
+                    // odrives only has the structure of the ODrives and the
+                    // top level values, the remaining values follow in
+                    // ODriveValues messages
                     context.commit('setOdrives', JSON.parse(odrives));
                     context.dispatch('getOdriveConfigs');
                     context.dispatch('getAxes');
+                    context.dispatch('loadShownValues');
+                }
+            });
+            socketio.addEventListener({
+                type: "ODriveValues",
+                callback: retmsg => {
+                    const msg = JSON.parse(retmsg);
+                    context.commit('updateOdriveValues', msg);
+                    context.dispatch('getOdriveConfigs');
+                    if (msg.id in valueRequests) {
+                        valueRequests[msg.id]();
+                        delete valueRequests[msg.id];
+                    }
                 }
             });
             // getVal event gets sent to server, server emits ODriveProperty event with path and val of property
@@ -14,8 +14,8 @@ __version__ = get_version_str()
 del get_version_str
 
 from .utils import get_serial_number_str, get_serial_number_str_sync
+from .registry import DeviceRegistry
 import threading
-import time
 
 default_usb_search_path = 'usb:idVendor=0x1209,idProduct=0x0D32,bInterfaceClass=0,bInterfaceSubClass=1,bInterfaceProtocol=0'
 default_search_path = default_usb_search_path
@@ -24,26 +24,20 @@ default_search_path = default_usb_search_path
 _discovery_lock = threading.Lock()
 _discovery_started = [False]
 _discovery_path = [None]
-_discovery_signal = threading.Condition()
-_objects = []
+_discovery_lazy = [None]
+_registry = DeviceRegistry()
 
 
-def _start_discovery(path):
+def _start_discovery(path, lazy):
     _domain_termination_token = fibre.Event()
+    Domain = fibre.Domain # fails here rather than on the discovery thread if libfibre is missing
 
     async def discovered_object(obj):
-        def lost_object(_):
-            idx = [i for i, (o, _) in enumerate(_objects) if o == obj][0]
-            _objects.pop(idx)
-
-        _objects.append((obj, await get_serial_number_str(obj)))
-
-        obj._on_lost.add_done_callback(lost_object)
-        with _discovery_signal:
-            _discovery_signal.notify_all()
+        _registry._add(obj, await get_serial_number_str(obj))
+        obj._on_lost.add_done_callback(lambda _: _registry._remove(obj))
 
     def domain_thread():
-        with fibre.Domain(path) as domain:
+        with Domain(path, lazy=lazy, prefetch=lazy) as domain:
             discovery = domain.run_discovery(discovered_object)
             _domain_termination_token.wait()
             discovery.stop()
@@ -51,7 +45,34 @@ def _start_discovery(path):
     threading.Thread(target=domain_thread, daemon=True).start()
 
 
-def find_any(path=default_search_path, serial_number=None, cancellation_token=None, timeout=None):
+def get_registry(path=default_search_path, lazy=False):
+    """
+    Returns the DeviceRegistry that tracks all ODrives connected on the
+    specified path.
+
+    The first call to get_registry(), find_any() or find_all() will start a
+    background thread that handles the backend. This background thread will
+    keep running until the program is terminated. path and lazy can't be
+    changed by later calls.
+    """
+    with _discovery_lock:
+        if not _discovery_started[0]:
+            _start_discovery(path, lazy)
+            _discovery_started[0] = True
+            _discovery_path[0] = path
+            _discovery_lazy[0] = lazy
+        elif path != _discovery_path[0]:
+            raise Exception("Cannot change discovery path between multiple find_any() "
+                            "calls: {} != {}. Use fibre.Domain() directly for finer "
+                            "grained discovery control.".format(path, _discovery_path[0]))
+        elif lazy != _discovery_lazy[0]:
+            raise Exception("Cannot change lazy loading between multiple find_any() "
+                            "calls: {} != {}. Use fibre.Domain() directly for finer "
+                            "grained discovery control.".format(lazy, _discovery_lazy[0]))
+    return _registry
+
+
+def find_any(path=default_search_path, serial_number=None, cancellation_token=None, timeout=None, lazy=False):
     """
     Blocks until the first matching ODrive object is connected and then returns
     that object.
@@ -59,54 +80,24 @@ def find_any(path=default_search_path, serial_number=None, cancellation_token=No
     If find_any() is called multiple times, the same object may be returned (
     depending on the serial_number argument).
 
-    The first call to find_any() will start a background thread that handles
-    the backend. This background thread will keep running until the program is
-    terminated.
-    
+    Returns None if the cancellation_token is set and raises a TimeoutError if
+    no matching ODrive is connected within timeout seconds.
+
+    If lazy is True, devices are returned before their complete object tree
+    is loaded. The rest of the tree is loaded on first access and in the
+    background. Like path, this can't be changed after the first call.
+
     If you want finer grained control over object discovery
     consider using fibre.Domain directly.
     """
     assert(cancellation_token is None or isinstance(cancellation_token, fibre.Event))
+    return get_registry(path, lazy).find_any(serial_number, timeout, cancellation_token)
 
-    # Start backend if it's not already started
-    with _discovery_lock:
-        if not _discovery_started[0]:
-            _start_discovery(path)
-            _discovery_started[0] = True
-            _discovery_path[0] = path
-        elif path != _discovery_path[0]:
-            raise Exception("Cannot change discovery path between multiple find_any() "
-                            "calls: {} != {}. Use fibre.Domain() directly for finer "
-                            "grained discovery control.".format(path, _discovery_path))
-
-    cancelled = [False]
-
-    def cancel():
-        with _discovery_signal:
-            cancelled[0] = True
-            _discovery_signal.notify_all()
-
-    try:
-        if cancellation_token:
-            cancellation_token.subscribe(cancel)
-
-        wait_start = time.monotonic()
-        with _discovery_signal:
-            while True:
-                # If the ODrive was already found, return it now
-                for (obj, s) in _objects:
-                    if (serial_number is None) or (serial_number == s):
-                        return obj
-                
-                current_timeout = None if timeout is None else min(0, timeout - (time.monotonic() - wait_start))
-                _discovery_signal.wait(current_timeout)
-
-                # TODO: it would be more sensible to raise an exception here but
-                # DFU implementation assumes that None is returned on cancellation.
-                if cancelled[0]:
-                    return None
-
-    finally:
-        if cancellation_token:
-            cancellation_token.unsubscribe(cancel)
 
+def find_all(count, path=default_search_path, cancellation_token=None, timeout=None, lazy=False):
+    """
+    Blocks until at least `count` ODrives are connected and returns a list of
+    `count` ODrive objects. See find_any() for details.
+    """
+    assert(cancellation_token is None or isinstance(cancellation_token, fibre.Event))
+    return get_registry(path, lazy).find_all(count, timeout, cancellation_token)
@@ -53,31 +53,52 @@ def set_dict(obj, path, config_dict):
     return errors
 
 def get_temp_config_filename(device):
-    serial_number = odrive.get_serial_number_str_sync(device)
+    return get_temp_config_filename_for_serial_number(odrive.get_serial_number_str_sync(device))
+
+def get_temp_config_filename_for_serial_number(serial_number):
     safe_serial_number = ''.join(filter(str.isalnum, serial_number))
     return os.path.join(tempfile.gettempdir(), 'odrive-config-{}.json'.format(safe_serial_number))
 
-def backup_config(device, filename, logger):
+def save_config_file(data_callback, filename, logger):
     """
-    Exports the configuration of an ODrive to a JSON file.
-    If no file name is provided, the file is placed into a
-    temporary directory.
+    Writes the configuration returned by data_callback() to a JSON file,
+    after asking the user whether an existing file should be overwritten.
     """
-
-    if filename is None:
-        filename = get_temp_config_filename(device)
-
     logger.info("Saving configuration to {}...".format(filename))
 
     if os.path.exists(filename):
         if not yes_no_prompt("The file {} already exists. Do you want to override it?".format(filename), True):
             raise OperationAbortedException()
 
-    data = get_dict(device, device, False)
+    data = data_callback()
     with open(filename, 'w') as file:
         json.dump(data, file)
     logger.info("Configuration saved.")
 
+def load_config_file(filename, logger):
+    with open(filename) as file:
+        data = json.load(file)
+    logger.info("Restoring configuration from {}...".format(filename))
+    return data
+
+def report_restore_errors(errors, logger):
+    for error in errors:
+        logger.info(error)
+    if errors:
+        logger.warn("Some of the configuration could not be restored.")
+
+def backup_config(device, filename, logger):
+    """
+    Exports the configuration of an ODrive to a JSON file.
+    If no file name is provided, the file is placed into a
+    temporary directory.
+    """
+
+    if filename is None:
+        filename = get_temp_config_filename(device)
+
+    save_config_file(lambda: get_dict(device, device, False), filename, logger)
+
 def restore_config(device, filename, logger):
     """
     Restores the configuration stored in a file 
@@ -86,16 +107,9 @@ def restore_config(device, filename, logger):
     if filename is None:
         filename = get_temp_config_filename(device)
 
-    with open(filename) as file:
-        data = json.load(file)
-
-    logger.info("Restoring configuration from {}...".format(filename))
+    data = load_config_file(filename, logger)
     errors = set_dict(device, "", data)
-
-    for error in errors:
-        logger.info(error)
-    if errors:
-        logger.warn("Some of the configuration could not be restored.")
+    report_restore_errors(errors, logger)
     
     try:
         device.save_configuration()
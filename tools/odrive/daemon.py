@@ -0,0 +1,266 @@
+"""
+Long-lived process that owns the ODrive connections and serves them to
+short-lived clients (e.g. `odrivetool backup-config`) over a local Unix
+socket. This saves the clients the time for USB discovery and for loading
+the object tree.
+
+Protocol: The client sends one JSON object per line of the form
+{"op": "read", "serial_number": "205A3591304B", ...} and receives one JSON
+object per line, either {"result": ...} or {"error": "...", "type": "..."}.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import stat
+import tempfile
+import threading
+import fibre.libfibre
+import odrive
+from odrive.configuration import (get_dict, set_dict, obj_to_path,
+    get_temp_config_filename_for_serial_number, save_config_file,
+    load_config_file, report_restore_errors)
+
+def get_default_socket_path():
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR', None)
+    if runtime_dir is None:
+        # The temp directory can be shared between users
+        user_id = os.getuid() if hasattr(os, 'getuid') else os.getlogin()
+        return os.path.join(tempfile.gettempdir(), 'odrivetool-{}.sock'.format(user_id))
+    return os.path.join(runtime_dir, 'odrivetool.sock')
+
+class DaemonError(Exception):
+    pass
+
+def is_daemon_running(socket_path=None):
+    """
+    Returns True if a daemon is listening on the socket. While it runs, the
+    daemon holds the connections to the ODrives so other processes cannot
+    connect to them directly.
+    """
+    client = DaemonClient.connect(socket_path)
+    if client is None:
+        return False
+    client.close()
+    return True
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                response = {'result': self.server.daemon.handle_request(request)}
+            except Exception as ex:
+                response = {'error': str(ex), 'type': type(ex).__name__}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class Daemon():
+    def __init__(self, path, socket_path, timeout, logger):
+        # Eager loading so that a device is only served once its object tree is
+        # complete. The daemon is long-lived so the startup time does not matter.
+        self._registry = odrive.get_registry(path)
+        self._path = path
+        self._socket_path = socket_path
+        self._timeout = timeout
+        self._logger = logger
+        self._device_locks = {} # key: device, value: lock that serializes configuration operations
+
+    def _get_device(self, serial_number):
+        try:
+            return self._registry.find_any(serial_number, timeout=self._timeout)
+        except TimeoutError:
+            raise self._not_connected(serial_number)
+
+    def _not_connected(self, serial_number):
+        return DaemonError("{} not connected".format("no ODrive" if serial_number is None else "ODrive " + serial_number))
+
+    def _to_json(self, device, value):
+        if isinstance(value, fibre.libfibre.RemoteObject):
+            return obj_to_path(device, value)
+        return value
+
+    def handle_request(self, request):
+        op = request['op']
+        if op == 'list':
+            return [serial_number for _, serial_number in self._registry.get_all()]
+
+        if op == 'find' and not request.get('path', None) in [None, self._path]:
+            raise DaemonError("the daemon discovers devices on {} but {} was requested. "
+                              "Use --no-daemon to connect directly.".format(self._path, request['path']))
+
+        device = self._get_device(request.get('serial_number', None))
+
+        if op == 'find':
+            serial_number = dict(self._registry.get_all()).get(device, None)
+            if serial_number is None:
+                raise self._not_connected(request.get('serial_number', None)) # lost in the meantime
+            return serial_number
+        elif op == 'read':
+            values = fibre.read_many(device, request['paths'])
+            return [self._to_json(device, v) for v in values]
+        elif op == 'write':
+            device._resolve_path(request['path'], writable=True).exchange(request['value'])
+            return None
+        elif op == 'call':
+            keys = request['path'].split('.')
+            obj = device
+            for key in keys[:-1]:
+                obj = getattr(obj, key)
+            return self._to_json(device, getattr(obj, keys[-1])(*request.get('args', [])))
+        elif op == 'get_config':
+            with self._device_locks.setdefault(device, threading.Lock()):
+                return get_dict(device, device, False)
+        elif op == 'set_config':
+            with self._device_locks.setdefault(device, threading.Lock()):
+                return set_dict(device, "", request['config'])
+        else:
+            raise DaemonError("unknown operation: {}".format(op))
+
+    def serve_forever(self, shutdown_token):
+        if os.path.lexists(self._socket_path):
+            # The default socket path can be in a directory that is shared
+            # between users so never touch a file that someone else owns.
+            st = os.lstat(self._socket_path)
+            if hasattr(os, 'getuid') and st.st_uid != os.getuid():
+                raise DaemonError("{} is owned by another user".format(self._socket_path))
+            if not stat.S_ISSOCK(st.st_mode):
+                raise DaemonError("{} exists and is not a socket".format(self._socket_path))
+            if DaemonClient.connect(self._socket_path) is not None:
+                raise DaemonError("a daemon is already listening on {}".format(self._socket_path))
+            os.unlink(self._socket_path) # stale socket from a daemon that crashed
+
+        # The socket gives full control over the devices so it must not be
+        # accessible by other users, not even between bind() and chmod().
+        old_umask = os.umask(0o077)
+        try:
+            server = _Server(self._socket_path, _RequestHandler)
+        finally:
+            os.umask(old_umask)
+        server.daemon = self
+        shutdown_token.subscribe(lambda: threading.Thread(target=server.shutdown, daemon=True).start())
+
+        def on_event(event, serial_number, device):
+            self._logger.info("{} ODrive {}".format("Connected to" if event == 'connected' else "Lost", serial_number))
+            if event == 'lost':
+                self._device_locks.pop(device, None)
+        self._registry.subscribe(on_event)
+
+        self._logger.info("Listening on {}".format(self._socket_path))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(self._socket_path)
+
+def run_daemon(path, socket_path, shutdown_token, logger, timeout=5.0):
+    """
+    Runs the connection daemon until shutdown_token is set.
+    timeout: The time that a request waits for the requested device to
+             appear before it fails.
+    """
+    Daemon(path, socket_path or get_default_socket_path(), timeout, logger).serve_forever(shutdown_token)
+
+class DaemonClient():
+    """
+    Client for a daemon started with `odrivetool daemon`. The methods raise a
+    DaemonError if the daemon reports an error.
+    """
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._file = sock.makefile('rwb')
+
+    @staticmethod
+    def connect(socket_path=None):
+        """
+        Returns a DaemonClient or None if no daemon is running.
+        """
+        socket_path = socket_path or get_default_socket_path()
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(socket_path):
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(socket_path)
+        except OSError:
+            sock.close()
+            return None
+        return DaemonClient(sock)
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def _request(self, op, **kwargs):
+        kwargs['op'] = op
+        self._file.write(json.dumps(kwargs).encode('utf-8') + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise DaemonError("connection to daemon closed")
+        response = json.loads(line.decode('utf-8'))
+        if 'error' in response:
+            raise DaemonError("{}: {}".format(response['type'], response['error']))
+        return response['result']
+
+    def find(self, serial_number=None, path=None):
+        """
+        Waits for the device with the specified serial number (or any device)
+        and returns its serial number.
+        If path is not None the daemon fails the request unless it discovers
+        devices on that path.
+        """
+        return self._request('find', serial_number=serial_number, path=path)
+
+    def list_devices(self):
+        """Returns the serial numbers of all connected ODrives"""
+        return self._request('list')
+
+    def read(self, paths, serial_number=None):
+        """Reads a list of property paths and returns a list of values"""
+        return self._request('read', serial_number=serial_number, paths=paths)
+
+    def write(self, path, value, serial_number=None):
+        return self._request('write', serial_number=serial_number, path=path, value=value)
+
+    def call(self, path, *args, serial_number=None):
+        return self._request('call', serial_number=serial_number, path=path, args=args)
+
+    def get_config(self, serial_number=None):
+        """Returns the configuration in the same format as backup_config()"""
+        return self._request('get_config', serial_number=serial_number)
+
+    def set_config(self, config, serial_number=None):
+        """Restores a configuration and returns a list of error messages"""
+        return self._request('set_config', serial_number=serial_number, config=config)
+
+def backup_config(client, serial_number, filename, logger, path=None):
+    """
+    Same as odrive.configuration.backup_config() but goes through the daemon.
+    """
+    serial_number = client.find(serial_number, path)
+    if filename is None:
+        filename = get_temp_config_filename_for_serial_number(serial_number)
+    save_config_file(lambda: client.get_config(serial_number), filename, logger)
+
+def restore_config(client, serial_number, filename, logger, path=None):
+    """
+    Same as odrive.configuration.restore_config() but goes through the daemon.
+    """
+    serial_number = client.find(serial_number, path)
+    if filename is None:
+        filename = get_temp_config_filename_for_serial_number(serial_number)
+
+    data = load_config_file(filename, logger)
+    report_restore_errors(client.set_config(data, serial_number), logger)
+
+    try:
+        client.call('save_configuration', serial_number=serial_number)
+    except DaemonError as ex:
+        if not str(ex).startswith("ObjectLostError"):
+            raise # Saving configuration makes the device reboot
+    logger.info("Configuration restored.")
@@ -1,4 +1,16 @@
-
 from .utils import Event, Logger, TimeoutError
 from .shell import launch_shell
-from .libfibre import Domain, ObjectLostError
+
+_libfibre_names = ['Domain', 'AsyncDomain', 'AsyncRemoteObject', 'ObjectLostError', 'read_many', 'snapshot', 'call_all', 'write_nowait', 'subscribe', 'Subscription', 'enable_stats', 'disable_stats', 'reset_stats', 'stats']
+
+try:
+    from .libfibre import Domain, AsyncDomain, AsyncRemoteObject, ObjectLostError, read_many, snapshot, call_all, write_nowait, subscribe, Subscription, enable_stats, disable_stats, reset_stats, stats
+except ModuleNotFoundError as ex:
+    # The pure Python protocol stack (fibre.protocol, fibre.loopback) works
+    # without libfibre. Everything that needs libfibre raises the original
+    # error on first use.
+    _libfibre_error = ex
+    def __getattr__(name):
+        if name in _libfibre_names:
+            raise _libfibre_error
+        raise AttributeError("module 'fibre' has no attribute '{}'".format(name))
@@ -0,0 +1,220 @@
+"""
+Services any number of fibre.protocol Channels from a single thread.
+"""
+
+import math
+import selectors
+import socket
+import threading
+import time
+import traceback
+
+from fibre.protocol import Channel, StreamToPacketSegmenter, MAX_PACKET_SIZE
+from fibre.utils import Logger
+
+class _Registration():
+    def __init__(self, input, segmenter, on_closed):
+        self.input = input
+        self.segmenter = segmenter
+        self.on_closed = on_closed
+        self.n_bytes = 0
+        self.n_reads = 0
+
+class ChannelManager():
+    """
+    Runs the receive path and the resend timers of many Channels on one
+    thread. Instead of a receiver thread per Channel that polls its
+    PacketSource, the manager waits on the input streams of all Channels with
+    a selector and reads them without blocking.
+
+    The input streams must be StreamSources that have a fileno() and that
+    return immediately from get_bytes() if the deadline is in the past.
+    Channels that receive their packets some other way can still leave their
+    resend timers to the manager, see add_channel().
+    """
+
+    _read_size = 4096
+
+    def __init__(self, logger):
+        self._logger = logger
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ, None)
+        self._lock = threading.Lock()
+        self._changes = [] # (registration, add) tuples to be applied on the manager thread
+        self._registrations = []
+        self._channels = {} # key: Channel, value: _Registration
+        self._next_wakeup = math.inf
+        self._wakeup_pending = False
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _wakeup(self):
+        """Must be called with _lock held."""
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self._wakeup_writer.send(b'\0')
+
+    def _schedule(self, deadline):
+        """
+        Called by the Channels to make sure that the manager thread wakes up
+        at the specified time to service the resend timers.
+        """
+        with self._lock:
+            if deadline < self._next_wakeup:
+                self._next_wakeup = deadline
+                self._wakeup()
+
+    def add_stream(self, input, sink, max_packet_size=MAX_PACKET_SIZE, on_closed=None):
+        """
+        Segments the bytes that arrive on the input stream into packets and
+        passes them to sink (a PacketSink).
+        on_closed: Invoked when reading from the stream or processing a packet
+                   fails. The stream is then removed.
+        Returns a handle that can be passed to remove_stream().
+        """
+        registration = _Registration(input, StreamToPacketSegmenter(sink, max_packet_size=max_packet_size), on_closed)
+        with self._lock:
+            self._changes.append((registration, True))
+            self._wakeup()
+        return registration
+
+    def remove_stream(self, registration):
+        with self._lock:
+            self._changes.append((registration, False))
+            self._wakeup()
+
+    def create_channel(self, name, input, output, cancellation_token, logger,
+                       max_packet_size=MAX_PACKET_SIZE, **kwargs):
+        """
+        Creates a Channel that is serviced by this manager. The Channel reads
+        from the input stream (a StreamSource) and writes packets to output (a
+        PacketSink). The remaining arguments are passed on to the Channel.
+        """
+        channel = Channel(name, None, output, cancellation_token, logger,
+                          max_packet_size=max_packet_size, manager=self, **kwargs)
+        registration = self.add_stream(input, channel, max_packet_size, channel._channel_broken.set)
+        self.add_channel(channel, registration)
+        return channel
+
+    def add_channel(self, channel, registration=None):
+        """
+        Services the resend timers of the Channel until it breaks. Channels
+        that are created without a manager are added to the default manager
+        (see get_default_manager()) this way.
+        registration: The handle of the Channel's input stream, if it was
+                      added with add_stream(). The stream is removed when the
+                      Channel breaks.
+        """
+        with self._lock:
+            self._channels[channel] = registration
+
+        def on_broken():
+            with self._lock:
+                self._channels.pop(channel, None)
+            if not registration is None:
+                self.remove_stream(registration)
+        channel._channel_broken.subscribe(on_broken)
+
+    def get_stats(self):
+        """
+        Returns a dict that maps the name of each Channel to the statistics
+        returned by Channel.get_stats(), extended by the number of bytes
+        received and the number of reads from the input stream (for Channels
+        that were created with create_channel()).
+        """
+        with self._lock:
+            channels = list(self._channels.items())
+        result = {}
+        for channel, registration in channels:
+            stats = channel.get_stats()
+            if not registration is None:
+                stats['bytes_received'] = registration.n_bytes
+                stats['reads'] = registration.n_reads
+            result[channel._name] = stats
+        return result
+
+    def stop(self):
+        """
+        Stops the manager thread. The Channels are not closed.
+        """
+        with self._lock:
+            self._stopped = True
+            self._wakeup()
+        self._thread.join()
+        self._selector.close()
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
+
+    def _read(self, registration):
+        try:
+            data = registration.input.get_bytes(self._read_size, 0)
+            registration.n_reads += 1
+            if data:
+                registration.n_bytes += len(data)
+                registration.segmenter.process_bytes(data)
+        except Exception:
+            self._logger.debug("stream is closed: " + traceback.format_exc())
+            self._unregister(registration)
+            if not registration.on_closed is None:
+                registration.on_closed()
+
+    def _unregister(self, registration):
+        if registration in self._registrations:
+            self._registrations.remove(registration)
+            self._selector.unregister(registration.input)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._stopped:
+                    return
+                changes, self._changes = self._changes, []
+                for registration, add in changes:
+                    if add:
+                        self._registrations.append(registration)
+                        self._selector.register(registration.input, selectors.EVENT_READ, registration)
+                    else:
+                        self._unregister(registration)
+                timeout = None if self._next_wakeup == math.inf else max(0.0, self._next_wakeup - time.monotonic())
+
+            for key, _ in self._selector.select(timeout):
+                if key.data is None:
+                    with self._lock:
+                        self._wakeup_reader.recv(4096)
+                        self._wakeup_pending = False
+                elif key.data in self._registrations:
+                    self._read(key.data)
+
+            with self._lock:
+                if time.monotonic() < self._next_wakeup:
+                    continue
+                self._next_wakeup = math.inf
+                channels = list(self._channels.keys())
+            next_wakeup = math.inf
+            for channel in channels:
+                deadline = channel.service_resends()
+                if not deadline is None:
+                    next_wakeup = min(next_wakeup, deadline)
+            with self._lock:
+                self._next_wakeup = min(self._next_wakeup, next_wakeup)
+
+
+_default_manager = None
+_default_manager_lock = threading.Lock()
+
+def get_default_manager():
+    """
+    Returns the ChannelManager that services the resend timers of all Channels
+    that are created without a manager, so that they share one thread. It is
+    started on the first call and runs until the program terminates.
+    """
+    global _default_manager
+    with _default_manager_lock:
+        if _default_manager is None:
+            _default_manager = ChannelManager(Logger(verbose=False))
+        return _default_manager
@@ -4,12 +4,14 @@ from ctypes import *
 import asyncio
 import os
 from itertools import count, takewhile
+from collections import deque
 import struct
 from types import MethodType
 import concurrent
 import threading
 import time
 import platform
+import math
 from .utils import Logger, Event
 import sys
 
@@ -220,14 +222,21 @@ class StructCodec():
     """
     def __init__(self, struct_format, target_type):
         self._struct_format = struct_format
+        self._struct = struct.Struct(struct_format)
         self._target_type = target_type
     def get_length(self):
-        return struct.calcsize(self._struct_format)
+        return self._struct.size
+    def get_fused_format(self):
+        return self._struct_format.lstrip("<")
+    def to_wire(self, libfibre, value):
+        return self._target_type(value)
+    def from_wire(self, libfibre, value):
+        return self._target_type(value)
     def serialize(self, libfibre, value):
         value = self._target_type(value)
-        return struct.pack(self._struct_format, value)
+        return self._struct.pack(value)
     def deserialize(self, libfibre, buffer):
-        value = struct.unpack(self._struct_format, buffer)
+        value = self._struct.unpack(buffer)
         value = value[0] if len(value) == 1 else value
         return self._target_type(value)
 
@@ -240,18 +249,41 @@ class ObjectPtrCodec():
     """
     def get_length(self):
         return struct.calcsize("P")
-    def serialize(self, libfibre, value):
+    def get_fused_format(self):
+        # The "P" format is only available in native mode. libfibre is only
+        # shipped for little endian hosts so an unsigned integer of the same
+        # size is equivalent.
+        return "Q" if struct.calcsize("P") == 8 else "I"
+    def to_wire(self, libfibre, value):
         if value is None:
-            return struct.pack("P", 0)
+            return 0
         elif isinstance(value, RemoteObject):
             assert(value._obj_handle) # Cannot serialize reference to a lost object
-            return struct.pack("P", value._obj_handle)
+            return value._obj_handle
         else:
             raise TypeError("Expected value of type RemoteObject or None but got '{}'. An example for a RemoteObject is this expression: odrv0.axis0.controller._input_pos_property".format(type(value).__name__))
+    def from_wire(self, libfibre, handle):
+        return None if handle == 0 else libfibre._find_py_obj(handle)
+    def serialize(self, libfibre, value):
+        return struct.pack("P", self.to_wire(libfibre, value))
     def deserialize(self, libfibre, buffer):
-        handle = struct.unpack("P", buffer)[0]
-        return None if handle == 0 else libfibre._objects[handle]
+        return self.from_wire(libfibre, struct.unpack("P", buffer)[0])
 
+class ArgListCodec():
+    """
+    Serializer/deserializer for a complete argument list. The formats of all
+    arguments are fused into a single struct.Struct when the function is
+    loaded so that a call needs only one pack() and one unpack().
+    """
+    def __init__(self, codecs):
+        self._codecs = codecs
+        self._struct = struct.Struct("<" + "".join(codec.get_fused_format() for codec in codecs))
+    def get_length(self):
+        return self._struct.size
+    def serialize(self, libfibre, values):
+        return self._struct.pack(*[codec.to_wire(libfibre, value) for codec, value in zip(self._codecs, values)])
+    def deserialize(self, libfibre, buffer):
+        return [codec.from_wire(libfibre, value) for codec, value in zip(self._codecs, self._struct.unpack(buffer))]
 
 codecs = {
     'int8': StructCodec("<b", int),
@@ -267,6 +299,21 @@ codecs = {
     'object_ref': ObjectPtrCodec()
 }
 
+# numpy types of the codecs for Subscription
+numpy_dtypes = {
+    'int8': 'i1',
+    'uint8': 'u1',
+    'int16': 'i2',
+    'uint16': 'u2',
+    'int32': 'i4',
+    'uint32': 'u4',
+    'int64': 'i8',
+    'uint64': 'u8',
+    'bool': '?',
+    'float': 'f4',
+    'object_ref': 'O',
+}
+
 def decode_arg_list(arg_names, codec_names):
     for i in count(0):
         if arg_names[i] is None or codec_names[i] is None:
@@ -277,8 +324,10 @@ def decode_arg_list(arg_names, codec_names):
             raise Exception("unsupported codec {}".format(codec_name))
         yield arg_name, codec_name, codecs[codec_name]
 
+_no_value = object() # placeholder for "no value" where None is a valid value
+
 def insert_with_new_id(dictionary, val):
-    key = next(x for x in count(1) if x not in set(dictionary.keys()))
+    key = next(x for x in count(1) if x not in dictionary)
     dictionary[key] = val
     return key
 
@@ -448,6 +497,97 @@ class RxStream():
         return data
 
 
+class EndpointStats():
+    """
+    Call statistics of a single endpoint (a function or property accessor on a
+    specific remote object). Latencies are recorded in a histogram with
+    logarithmically spaced bins, so percentiles are accurate to about 10%.
+    """
+    bins_per_octave = 8
+    n_bins = 8 * 32 # 1us ... ~70min
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.bytes_tx = 0
+        self.bytes_rx = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.histogram = [0] * self.n_bins
+        self.callers = {} # key: "file:line", value: number of calls
+
+    def add(self, latency, bytes_tx, bytes_rx, failed):
+        self.count += 1
+        self.errors += failed
+        self.bytes_tx += bytes_tx
+        self.bytes_rx += bytes_rx
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+        latency_us = latency * 1e6
+        index = int(math.log2(latency_us) * self.bins_per_octave) if latency_us > 1 else 0
+        self.histogram[min(index, self.n_bins - 1)] += 1
+
+    def percentile(self, p):
+        """Returns the upper bound of the bin that contains the p-th percentile [s]"""
+        if self.count == 0:
+            return None
+        threshold = self.count * p / 100
+        total = 0
+        for index, n in enumerate(self.histogram):
+            total += n
+            if total >= threshold:
+                return min(2 ** ((index + 1) / self.bins_per_octave) * 1e-6, self.max_latency)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'bytes_tx': self.bytes_tx,
+            'bytes_rx': self.bytes_rx,
+            'mean': self.total_latency / self.count if self.count else None,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max_latency if self.count else None,
+            'callers': dict(self.callers),
+        }
+
+class CallStats():
+    """
+    Collects EndpointStats for all calls that go through RemoteFunction.
+    Enabled with enable_stats().
+    """
+    def __init__(self, track_callers):
+        self.track_callers = track_callers
+        self.start_time = time.monotonic()
+        self.endpoints = {} # key: endpoint name, value: EndpointStats
+        self._lock = threading.Lock() # Stats are written on the Fibre thread but can be read from any thread
+
+    def get_endpoint(self, name):
+        endpoint = self.endpoints.get(name, None)
+        if endpoint is None:
+            with self._lock:
+                endpoint = self.endpoints.setdefault(name, EndpointStats())
+        return endpoint
+
+    def snapshot(self):
+        with self._lock:
+            return {name: endpoint.to_dict() for name, endpoint in self.endpoints.items()}
+
+def _find_caller():
+    """
+    Returns "file:line" of the innermost stack frame outside of the fibre
+    package or "<event loop>" if the call was issued by a callback of the
+    event loop (e.g. read_many()).
+    """
+    frame = sys._getframe(1)
+    while not frame is None and os.path.dirname(frame.f_code.co_filename) == script_dir:
+        frame = frame.f_back
+    if frame is None or os.path.dirname(frame.f_code.co_filename) == os.path.dirname(asyncio.__file__):
+        return "<event loop>"
+    return "{}:{}".format(frame.f_code.co_filename, frame.f_lineno)
+
 class Call(object):
     """
     This call behaves as you would expect an async generator to behave. This is
@@ -465,9 +605,16 @@ class Call(object):
         return self
 
     async def asend(self, val):
+        """
+        val: None for the first call, otherwise a tuple (tx_buf, rx_buf,
+        should_close) where rx_buf is a writable buffer (e.g. a memoryview
+        into a bytearray) that receives the response bytes in-place.
+
+        Returns: (remaining tx_buf, number of bytes written to rx_buf, is_closed)
+        """
         assert(self._is_started == (not val is None))
         if not val is None:
-            self._tx_buf, self._rx_len, self._should_close = val
+            self._tx_buf, self._rx_buf, self._should_close = val
         return await self.__anext__()
 
     async def __anext__(self):
@@ -481,14 +628,15 @@ class Call(object):
         tx_end = c_void_p(0)
         rx_end = c_void_p(0)
 
-        rx_buf = b'\0' * self._rx_len
+        rx_mem = (c_char * len(self._rx_buf)).from_buffer(self._rx_buf)
+        rx_start = addressof(rx_mem)
 
         call_id = insert_with_new_id(self._func._libfibre._calls, self)
 
         status = libfibre_call(self._func._func_handle, byref(self._call_handle),
                 kFibreClosed if self._should_close else kFibreOk,
                 cast(self._tx_buf, c_char_p), len(self._tx_buf),
-                cast(rx_buf, c_char_p), len(rx_buf),
+                rx_start, len(self._rx_buf),
                 byref(tx_end), byref(rx_end), self._func._libfibre.c_on_call_completed, call_id)
 
         if status == kFibreBusy:
@@ -501,12 +649,13 @@ class Call(object):
 
         n_written = tx_end - cast(self._tx_buf, c_void_p).value
         self._tx_buf = self._tx_buf[n_written:]
-        n_read = rx_end - cast(rx_buf, c_void_p).value
-        rx_buf = rx_buf[:n_read]
+        n_read = rx_end - rx_start
+        del rx_mem # release the export on rx_buf
+        self._rx_buf = None
 
         if status != kFibreOk:
             self._is_closed = True
-        return self._tx_buf, rx_buf, self._is_closed
+        return self._tx_buf, n_read, self._is_closed
 
     async def cancel():
         # TODO: this doesn't follow the official Python async generator protocol. Should implement aclose() instead.
@@ -522,22 +671,54 @@ class RemoteFunction(object):
     """
     Represents a callable function that maps to a function call on a remote object.
     """
-    def __init__(self, libfibre, func_handle, inputs, outputs):
+    def __init__(self, libfibre, func_handle, name, inputs, outputs):
         self._libfibre = libfibre
         self._func_handle = func_handle
+        self._name = name
         self._inputs = inputs
         self._outputs = outputs
-        self._rx_size = sum(codec.get_length() for _, _, codec in self._outputs)
 
-    async def async_call(self, args, cancellation_token):
+        # The codecs for the complete input and output lists are compiled once
+        # here so that a call only needs one serialize and one deserialize.
+        self._input_codec = ArgListCodec([codec for _, _, codec in self._inputs])
+        self._output_codec = ArgListCodec([codec for _, _, codec in self._outputs])
+        self._rx_size = self._output_codec.get_length()
+
+        # RX buffers are recycled across calls. There can be several calls to
+        # the same function in flight (e.g. all float properties share one
+        # read() function) so this is a pool rather than a single buffer.
+        self._rx_buf_pool = []
+
+    async def async_call(self, args, cancellation_token, caller=None):
         #print("making call on " + hex(args[0]._obj_handle))
-        tx_buf = bytes()
-        for i, arg in enumerate(self._inputs):
-            tx_buf += arg[2].serialize(self._libfibre, args[i])
-        rx_buf = bytes()
+        if call_stats is None:
+            return await self._async_call(args, cancellation_token)
+
+        obj = args[0] if len(args) and isinstance(args[0], RemoteObject) else None
+        path = None if obj is None else obj._path
+        endpoint = call_stats.get_endpoint(self._name if not path else path + "." + self._name)
+        if not caller is None:
+            endpoint.callers[caller] = endpoint.callers.get(caller, 0) + 1
+
+        endpoint.in_flight += 1
+        start_time = time.monotonic()
+        failed = True
+        try:
+            result = await self._async_call(args, cancellation_token)
+            failed = False
+            return result
+        finally:
+            endpoint.in_flight -= 1
+            endpoint.add(time.monotonic() - start_time, self._input_codec.get_length(), 0 if failed else self._rx_size, failed)
+
+    async def _async_call(self, args, cancellation_token):
+        tx_buf = self._input_codec.serialize(self._libfibre, args)
+        rx_buf = self._rx_buf_pool.pop() if len(self._rx_buf_pool) else bytearray(self._rx_size)
+        rx_view = memoryview(rx_buf)
+        rx_len = 0
 
         agen = Call(self)
-        
+
         if not cancellation_token is None:
             cancellation_token.add_done_callback(agen.cancel)
 
@@ -546,20 +727,19 @@ class RemoteFunction(object):
 
             is_closed = False
             while not is_closed:
-                tx_buf, rx_chunk, is_closed = await agen.asend((tx_buf, self._rx_size - len(rx_buf), True))
-                rx_buf += rx_chunk
+                tx_buf, n_read, is_closed = await agen.asend((tx_buf, rx_view[rx_len:], True))
+                rx_len += n_read
 
         finally:
             if not cancellation_token is None:
                 cancellation_token.remove_done_callback(agen.cancel)
 
-        assert(len(rx_buf) == self._rx_size)
+        assert(rx_len == self._rx_size)
+        outputs = self._output_codec.deserialize(self._libfibre, rx_buf)
 
-        outputs = []
-        for arg in self._outputs:
-            arg_length = arg[2].get_length()
-            outputs.append(arg[2].deserialize(self._libfibre, rx_buf[:arg_length]))
-            rx_buf = rx_buf[arg_length:]
+        # Only recycle the buffer if the call completed normally. Otherwise
+        # libfibre might still hold a pointer to it.
+        self._rx_buf_pool.append(rx_buf)
 
         if len(outputs) == 0:
             return
@@ -578,13 +758,17 @@ class RemoteFunction(object):
         invokation.
         """
 
+        caller = _find_caller() if not call_stats is None and call_stats.track_callers else None
+
         if threading.current_thread() != libfibre_thread:
-            return run_coroutine_threadsafe(self._libfibre.loop, lambda: self.__call__(*args))
+            return run_coroutine_threadsafe(self._libfibre.loop, lambda: self._start_call(args, None, caller))
+        return self._start_call(args, cancellation_token, caller)
 
+    def _start_call(self, args, cancellation_token, caller):
         if (len(self._inputs) != len(args)):
             raise TypeError("expected {} arguments but have {}".format(len(self._inputs), len(args)))
 
-        coro = self.async_call(args, cancellation_token)
+        coro = self.async_call(args, cancellation_token, caller)
         return asyncio.ensure_future(coro, loop=self._libfibre.loop)
 
     def __get__(self, instance, owner):
@@ -599,27 +783,48 @@ class RemoteFunction(object):
             " -> (" + print_arglist(self._outputs) + ")")
 
 class RemoteAttribute(object):
-    def __init__(self, libfibre, attr_handle, intf_handle, intf_name, magic_getter, magic_setter):
+    def __init__(self, libfibre, attr_handle, name, intf_handle, intf_name, magic_getter, magic_setter):
         self._libfibre = libfibre
         self._attr_handle = attr_handle
+        self._name = name
         self._intf_handle = intf_handle
         self._intf_name = intf_name
         self._magic_getter = magic_getter
         self._magic_setter = magic_setter
 
     def _get_obj(self, instance):
+        # Fast path: the child object was already resolved before. Entries are
+        # dropped when the parent object is destroyed.
+        cache = instance._attribute_cache
+        if not cache is None:
+            obj = cache.get(self._attr_handle, None)
+            if not obj is None:
+                return obj
+
+        if threading.current_thread() != libfibre_thread:
+            # Objects that were not loaded at discovery time (see lazy loading
+            # in Domain) must be loaded on the Fibre thread.
+            return run_coroutine_threadsafe(self._libfibre.loop, lambda: self._get_obj(instance))
+
         obj_handle = c_void_p(0)
         status = libfibre_get_attribute(instance._obj_handle, self._attr_handle, byref(obj_handle))
         if status != kFibreOk:
             raise _get_exception(status)
         
         obj = self._libfibre._load_py_obj(obj_handle.value, self._intf_handle)
+        if instance._children is None:
+            instance._children = set()
+            instance._attribute_cache = {}
         if obj in instance._children:
             self._libfibre._release_py_obj(obj_handle.value)
         else:
             # the object will be released when the parent is released
             instance._children.add(obj)
 
+        if obj._path is None:
+            obj._path = self._name if instance._path is None else instance._path + "." + self._name
+
+        instance._attribute_cache[self._attr_handle] = obj
         return obj
 
     def __get__(self, instance, owner):
@@ -644,39 +849,150 @@ class RemoteAttribute(object):
         else:
             raise Exception("this attribute cannot be written to")
 
-class EmptyInterface():
+def _iterate_tree(obj):
+    """
+    Loads and yields all objects in the tree below obj (depth-first). Objects
+    that get lost during the iteration are skipped.
+    """
+    stack = [obj]
+    while len(stack):
+        subobj = stack.pop()
+        if getattr(subobj, '_obj_handle', None) is None:
+            continue # object was lost
+        yield subobj
+        for key in dir(subobj.__class__):
+            if not key.startswith('_'):
+                attr = getattr(subobj.__class__, key)
+                if isinstance(attr, RemoteAttribute):
+                    stack.append(attr._get_obj(subobj))
+
+# Guards the on-demand creation of RemoteObject._on_lost_future against
+# _destroy(). One lock for all objects because it is rarely contended.
+_on_lost_lock = threading.Lock()
+
+# Handed out by _on_lost when it races with _destroy()
+_lost_future = concurrent.futures.Future()
+_lost_future.set_result(True)
+
+class RemoteObjectSlots(object):
+    """
+    Storage layout shared by RemoteObject and EmptyInterface. A lost object
+    changes its class to EmptyInterface which requires identical layouts.
+
+    There can be thousands of remote objects so they don't have an instance
+    dict. This also makes assignments to undefined attributes raise an
+    AttributeError.
+    """
+    __slots__ = ('_refcount', '_children', '_attribute_cache', '_path', '_libfibre', '_obj_handle', '_on_lost_future')
+
+class EmptyInterface(RemoteObjectSlots):
+    __slots__ = ()
+    _on_lost = None
     def __str__(self):
         return "[lost object]"
     def __repr__(self):
         return self.__str__()
 
-class RemoteObject(object):
+class RemoteObject(RemoteObjectSlots):
     """
     Base class for interfaces of remote objects.
     """
-    __sealed__ = False
+    __slots__ = ()
 
     def __init__(self, libfibre, obj_handle):
-        self.__class__._refcount += 1
+        self.__class__._instance_count += 1
         self._refcount = 0
-        self._children = set()
+        self._children = None # set of child objects, allocated on demand
+        self._attribute_cache = None # key: libfibre attribute handle, value: child object, allocated on demand
+        self._path = None # dotted path relative to the root object, None for root objects
 
         self._libfibre = libfibre
         self._obj_handle = obj_handle
-        self._on_lost = concurrent.futures.Future() # TODO: maybe we can do this with conc
-
-        # Ensure that assignments to undefined attributes raise an exception
-        self.__sealed__ = True
+        self._on_lost_future = None # allocated on demand, see _on_lost
 
-    def __setattr__(self, key, value):
-        if self.__sealed__ and not key in dir(self) and not hasattr(self, key):
-            raise AttributeError("Attribute {} not found".format(key))
-        object.__setattr__(self, key, value)
+    @property
+    def _on_lost(self):
+        """
+        A concurrent.futures.Future that completes when the object is lost.
+        Most objects are never asked for it so it is only created on first use.
+        """
+        future = self._on_lost_future
+        if future is None:
+            with _on_lost_lock:
+                # _destroy() replaces the slot with _lost_future under the
+                # lock so a future created here is never missed.
+                if self._on_lost_future is None:
+                    self._on_lost_future = concurrent.futures.Future()
+                future = self._on_lost_future
+        return future
 
     #def __del__(self):
     #    print("unref")
     #    libfibre_unref_obj(self._obj_handle)
 
+    def _collect_properties(self, depth, keys, result):
+        """
+        Appends a tuple (keys, property object) to result for every readable
+        property up to `depth` levels below this object.
+        Must be called on the Fibre thread.
+        """
+        for key in dir(self.__class__):
+            if key.startswith('_'):
+                continue
+            class_member = getattr(self.__class__, key)
+            if isinstance(class_member, RemoteAttribute):
+                obj = class_member._get_obj(self)
+                if class_member._magic_getter:
+                    result.append((keys + (key,), obj))
+                elif depth > 1 and isinstance(obj, RemoteObject):
+                    obj._collect_properties(depth - 1, keys + (key,), result)
+
+    async def _read_subtree_async(self, depth):
+        properties = []
+        self._collect_properties(depth, (), properties)
+        values = await asyncio.gather(*[prop.read() for _, prop in properties], return_exceptions=True)
+        return [(keys, prop, value) for (keys, prop), value in zip(properties, values)]
+
+    def _read_subtree(self, depth):
+        """
+        Reads all properties up to `depth` levels below this object with all
+        reads in flight at the same time. Returns a list of tuples
+        (keys, property object, value). If a read fails, the value is the
+        exception.
+
+        If this function is called from the Fibre thread then it is nonblocking
+        and returns an asyncio.Future.
+        """
+        if threading.current_thread() != libfibre_thread:
+            return run_coroutine_threadsafe(self._libfibre.loop, lambda: self._read_subtree(depth))
+        return asyncio.ensure_future(self._read_subtree_async(depth), loop=self._libfibre.loop)
+
+    async def _snapshot_async(self, depth):
+        snapshot = {}
+        for keys, prop, value in await self._read_subtree_async(depth):
+            node = snapshot
+            for key in keys[:-1]:
+                node = node.setdefault(key, {})
+            node[keys[-1]] = value
+        return snapshot
+
+    def _snapshot(self, depth=None):
+        """
+        Reads all properties in the subtree of this object concurrently and
+        returns their values as nested dicts, e.g.
+        {'vbus_voltage': 24.0, 'axis0': {'encoder': {'pos_estimate': 1.5, ...}, ...}, ...}
+        If a read fails, the value is the exception.
+
+        depth: The number of levels to read (None for the complete subtree).
+
+        If this function is called from the Fibre thread then it is nonblocking
+        and returns an asyncio.Future.
+        """
+        depth = math.inf if depth is None else depth
+        if threading.current_thread() != libfibre_thread:
+            return run_coroutine_threadsafe(self._libfibre.loop, lambda: self._snapshot(depth))
+        return asyncio.ensure_future(self._snapshot_async(depth), loop=self._libfibre.loop)
+
     def _dump(self, indent, depth):
         if self._obj_handle is None:
             return "[object lost]"
@@ -684,29 +1000,40 @@ class RemoteObject(object):
         try:
             if depth <= 0:
                 return "..."
-            lines = []
-            for key in dir(self.__class__):
-                if key.startswith('_'):
-                    continue
-                class_member = getattr(self.__class__, key)
-                if isinstance(class_member, RemoteFunction):
-                    lines.append(indent + class_member._dump(key))
-                elif isinstance(class_member, RemoteAttribute):
-                    val = getattr(self, key)
-                    if isinstance(val, RemoteObject) and not class_member._magic_getter:
-                        lines.append(indent + key + (": " if depth == 1 else ":\n") + val._dump(indent + "  ", depth - 1))
-                    else:
-                        if isinstance(val, RemoteObject) and class_member._magic_getter:
-                            val_str = get_user_name(val)
-                        else:
-                            val_str = str(val)
-                        property_type = str(class_member._get_obj(self).__class__.read._outputs[0][1])
-                        lines.append(indent + key + ": " + val_str + " (" + property_type + ")")
-                else:
-                    lines.append(indent + key + ": " + str(type(val)))
+            values = {keys: (prop, value) for keys, prop, value in self._read_subtree(depth)}
+            return self._format_dump(values, (), indent, depth)
         except:
             return "[failed to dump object]"
 
+    def _format_dump(self, values, keys, indent, depth):
+        lines = []
+        for key in dir(self.__class__):
+            if key.startswith('_'):
+                continue
+            class_member = getattr(self.__class__, key)
+            if isinstance(class_member, RemoteFunction):
+                lines.append(indent + class_member._dump(key))
+            elif isinstance(class_member, RemoteAttribute) and class_member._magic_getter:
+                prop, val = values[keys + (key,)]
+                if isinstance(val, Exception):
+                    val_str = "[failed to read: {}]".format(val)
+                elif isinstance(val, RemoteObject):
+                    val_str = get_user_name(val)
+                else:
+                    val_str = str(val)
+                property_type = str(prop.__class__.read._outputs[0][1])
+                lines.append(indent + key + ": " + val_str + " (" + property_type + ")")
+            elif isinstance(class_member, RemoteAttribute):
+                obj = class_member._get_obj(self)
+                if depth == 1:
+                    val_str = "..."
+                elif isinstance(obj, RemoteObject):
+                    val_str = obj._format_dump(values, keys + (key,), indent + "  ", depth - 1)
+                else:
+                    val_str = str(obj) # lost object
+                lines.append(indent + key + (": " if depth == 1 else ":\n") + val_str)
+            else:
+                lines.append(indent + key + ": " + str(type(class_member)))
         return "\n".join(lines)
 
     def __str__(self):
@@ -715,25 +1042,135 @@ class RemoteObject(object):
     def __repr__(self):
         return self.__str__()
 
+    def _resolve_path(self, path, writable=False):
+        """
+        Resolves a dotted path such as "axis0.encoder.pos_estimate" relative to
+        this object and returns the underlying property object (the one that
+        is otherwise reachable as axis0.encoder._pos_estimate_property).
+        Must be called on the Fibre thread unless the path was resolved before.
+        """
+        keys = path.split('.')
+        obj = self
+        for key in keys[:-1]:
+            obj = getattr(obj, key)
+        class_member = getattr(obj.__class__, keys[-1], None)
+        if not isinstance(class_member, RemoteAttribute) or not class_member._magic_getter:
+            raise AttributeError("{} is not a readable property".format(path))
+        if writable and not class_member._magic_setter:
+            raise AttributeError("{} is not a writable property".format(path))
+        return class_member._get_obj(obj)
+
+    def _lookup_path(self, path):
+        return self._resolve_path(path) if isinstance(path, str) else path
+
+    async def _read_with_timeout(self, path, timeout):
+        try:
+            prop = self._lookup_path(path)
+        except Exception as ex:
+            return ex
+        return await _call_with_timeout(prop.read, prop, prop._path, timeout)
+
+    async def _read_many_async(self, paths, timeout=None):
+        if not timeout is None:
+            return tuple(await asyncio.gather(*[self._read_with_timeout(path, timeout) for path in paths]))
+        properties = [self._lookup_path(path) for path in paths]
+        return tuple(await asyncio.gather(*[prop.read() for prop in properties]))
+
+    def _read_many(self, paths, timeout=None):
+        """
+        Reads all properties specified by the list of dotted paths at once.
+        All read calls are started before the first one is awaited so that the
+        round trips overlap instead of adding up.
+        Instead of a path, an entry can also be a property object that was
+        returned by _resolve_path() before. This saves the path lookup when the
+        same properties are read repeatedly.
+
+        If a timeout (in seconds) is specified, a path that cannot be read or
+        that does not complete in time does not fail the whole operation.
+        Instead the corresponding entry of the result is the exception (e.g.
+        ObjectLostError or TimeoutError). A read that timed out stays in flight
+        until the device responds and until then the path is reported as
+        TimeoutError without starting another read. This way a stalled device
+        that is polled periodically doesn't accumulate unanswered reads.
+
+        If this function is called from the Fibre thread then it is nonblocking
+        and returns an asyncio.Future. If it is called from another thread then
+        it blocks until all reads are complete and returns a tuple with one
+        value per path.
+        """
+        if threading.current_thread() != libfibre_thread:
+            return run_coroutine_threadsafe(self._libfibre.loop, lambda: self._read_many(paths, timeout))
+        return asyncio.ensure_future(self._read_many_async(list(paths), timeout), loop=self._libfibre.loop)
+
     def _destroy(self):
         libfibre = self._libfibre
-        on_lost = self._on_lost
+        with _on_lost_lock:
+            on_lost = self._on_lost_future
+            self._on_lost_future = _lost_future
         children = self._children
 
         self._libfibre = None
         self._obj_handle = None
-        self._on_lost = None
-        self._children = set()
+        self._children = None
+        self._attribute_cache = None
 
-        for child in children:
+        for child in children or ():
             libfibre._release_py_obj(child._obj_handle)
 
-        self.__class__._refcount -= 1
-        if self.__class__._refcount == 0:
+        self.__class__._instance_count -= 1
+        if self.__class__._instance_count == 0:
             libfibre.interfaces.pop(self.__class__._handle)
 
         self.__class__ = EmptyInterface # ensure that this object has no more attributes
-        on_lost.set_result(True)
+        if not on_lost is None and not on_lost is _lost_future:
+            on_lost.set_result(True)
+
+class AsyncRemoteObject():
+    """
+    Facade for a RemoteObject that is meant to be used on the Fibre thread,
+    e.g. from coroutines running inside an AsyncDomain. Sub-objects are wrapped
+    in AsyncRemoteObject and property reads, property writes and function
+    calls return awaitables instead of blocking:
+
+        pos = await odrv.axis0.encoder.pos_estimate
+        await odrv.axis0.controller._write('input_pos', 1.0)
+        await odrv.clear_errors()
+    """
+    __slots__ = ['_remote_obj']
+
+    def __init__(self, remote_obj):
+        object.__setattr__(self, '_remote_obj', remote_obj)
+
+    def __getattr__(self, key):
+        class_member = getattr(self._remote_obj.__class__, key, None)
+        if isinstance(class_member, RemoteAttribute):
+            if class_member._magic_getter:
+                return class_member._get_obj(self._remote_obj).read()
+            else:
+                return AsyncRemoteObject(class_member._get_obj(self._remote_obj))
+        return getattr(self._remote_obj, key)
+
+    def __setattr__(self, key, value):
+        raise AttributeError("Assignments cannot be awaited. Use `await obj._write('{}', value)` instead.".format(key))
+
+    def __dir__(self):
+        return dir(self._remote_obj)
+
+    def __str__(self):
+        return "[async] " + object.__repr__(self._remote_obj)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def _write(self, key, value):
+        """
+        Writes the property `key` of this object and returns an awaitable that
+        completes when the write was acknowledged.
+        """
+        class_member = getattr(self._remote_obj.__class__, key, None)
+        if not isinstance(class_member, RemoteAttribute) or not class_member._magic_setter:
+            raise Exception("this attribute cannot be written to")
+        return class_member._get_obj(self._remote_obj).exchange(value)
 
 
 class LibFibre():
@@ -762,6 +1199,8 @@ class LibFibre():
         self.discovery_processes = {} # key: ID, value: python dict
         self._objects = {} # key: libfibre handle, value: python class
         self._calls = {} # key: libfibre handle, value: Call object
+        self._coalesced_writes = {} # key: property object with a write in flight, value: next value to write or _no_value
+        self._timed_out_calls = {} # key: see _call_with_timeout(), value: future of a call that timed out but is still in flight
 
         event_loop = LibFibreEventLoop()
         event_loop.post = self.c_post
@@ -816,7 +1255,7 @@ class LibFibre():
         else:
             if name is None:
                 name = "anonymous_interface_" + str(intf_handle)
-            py_intf = self.interfaces[intf_handle] = type(name, (RemoteObject,), {'_handle': intf_handle, '_refcount': 0})
+            py_intf = self.interfaces[intf_handle] = type(name, (RemoteObject,), {'__slots__': (), '_handle': intf_handle, '_instance_count': 0})
             #exit(1)
             libfibre_subscribe_to_interface(intf_handle, self.c_on_attribute_added, self.c_on_attribute_removed, self.c_on_function_added, self.c_on_function_removed, intf_handle)
             return py_intf
@@ -836,6 +1275,26 @@ class LibFibre():
         py_obj._refcount += 1
         return py_obj
 
+    def _find_py_obj(self, obj_handle):
+        """
+        Returns the python object for a libfibre object handle that was received
+        as an object reference (e.g. the value of an endpoint_ref property).
+
+        libfibre does not tell the interface of such a handle so if the object
+        was not loaded yet (lazy loading) the trees of the discovered objects
+        are loaded until the object shows up.
+        Must be called on the Fibre thread.
+        """
+        if not obj_handle in self._objects:
+            roots = [obj for obj in self._objects.values() if obj._path is None]
+            for root in roots:
+                if any(obj_handle in self._objects for _ in _iterate_tree(root)):
+                    break
+        py_obj = self._objects.get(obj_handle, None)
+        if py_obj is None:
+            raise ObjectLostError()
+        return py_obj
+
     def _release_py_obj(self, obj_handle):
         py_obj = self._objects[obj_handle]
         py_obj._refcount -= 1
@@ -847,20 +1306,26 @@ class LibFibre():
         py_obj = self._load_py_obj(obj, intf)
         discovery = self.discovery_processes[ctx]
 
-        # TODO: this is a hack because ObjectPtrCodec is broken
-        def load(subobj):
-            for key in dir(subobj):
-                if not key.startswith('_'):
-                    attr = getattr(subobj.__class__, key)
-                    if isinstance(attr, RemoteAttribute):
-                        load(attr._get_obj(subobj))
-
-        load(py_obj)
+        if not discovery._domain._lazy:
+            for _ in _iterate_tree(py_obj):
+                pass # the objects are loaded as a side effect of the iteration
 
         discovery._unannounced.append(py_obj)
         old_future = discovery._future
         discovery._future = self.loop.create_future()
         old_future.set_result(None)
+
+        if discovery._domain._lazy and discovery._domain._prefetch:
+            asyncio.ensure_future(self._prefetch(py_obj))
+
+    async def _prefetch(self, obj):
+        """
+        Loads the object tree below obj in the background after obj was handed
+        to the application. Only one object is loaded per event loop iteration
+        so that calls issued by the application are not held up.
+        """
+        for _ in _iterate_tree(obj):
+            await asyncio.sleep(0)
     
     def _on_lost_object(self, ctx, obj):
         assert(obj)
@@ -877,9 +1342,9 @@ class LibFibre():
         magic_getter = not subintf_name is None and subintf_name.startswith("fibre.Property<") and subintf_name.endswith(">")
         magic_setter = not subintf_name is None and subintf_name.startswith("fibre.Property<readwrite ") and subintf_name.endswith(">")
 
-        setattr(intf, name, RemoteAttribute(self, attr, subintf, subintf_name, magic_getter, magic_setter))
+        setattr(intf, name, RemoteAttribute(self, attr, name, subintf, subintf_name, magic_getter, magic_setter))
         if magic_getter or magic_setter:
-            setattr(intf, "_" + name + "_property", RemoteAttribute(self, attr, subintf, subintf_name, False, False))
+            setattr(intf, "_" + name + "_property", RemoteAttribute(self, attr, name, subintf, subintf_name, False, False))
 
     def _on_attribute_removed(self, ctx, attr):
         print("attribute removed") # TODO
@@ -889,11 +1354,37 @@ class LibFibre():
         inputs = list(decode_arg_list(input_names, input_codecs))
         outputs = list(decode_arg_list(output_names, output_codecs))
         intf = self.interfaces[ctx]
-        setattr(intf, name, RemoteFunction(self, func, inputs, outputs))
+        setattr(intf, name, RemoteFunction(self, func, name, inputs, outputs))
 
     def _on_function_removed(self, ctx, func):
         print("function removed") # TODO
 
+    def _write_coalesced(self, prop, value):
+        """
+        Writes value to the property object prop such that there is at most one
+        write in flight per property. If a write is already in flight, value
+        replaces any value that is still waiting to be written.
+        Must be called on the Fibre thread.
+        """
+        if prop in self._coalesced_writes:
+            self._coalesced_writes[prop] = value
+            return
+
+        self._coalesced_writes[prop] = _no_value
+        try:
+            future = prop.exchange(value)
+        except Exception:
+            self._coalesced_writes.pop(prop) # object lost
+            return
+        future.add_done_callback(lambda f: self._on_coalesced_write_done(prop, f))
+
+    def _on_coalesced_write_done(self, prop, future):
+        if not future.cancelled():
+            future.exception() # errors are not reported to the writer
+        value = self._coalesced_writes.pop(prop)
+        if not value is _no_value:
+            self._write_coalesced(prop, value)
+
     def _on_call_completed(self, ctx, status, tx_end, rx_end, tx_buf, tx_len, rx_buf, rx_len):
         call = self._calls.pop(ctx)
 
@@ -910,13 +1401,13 @@ class Discovery():
         self._domain = domain
         self._id = 0
         self._discovery_handle = c_void_p(0)
-        self._unannounced = []
+        self._unannounced = deque()
         self._future = domain._libfibre.loop.create_future()
 
     async def _next(self):
         if len(self._unannounced) == 0:
             await self._future
-        return self._unannounced.pop(0)
+        return self._unannounced.popleft()
 
     def _stop(self):
         self._domain._libfibre.discovery_processes.pop(self._id)
@@ -934,9 +1425,11 @@ class _Domain():
     All public members of this class are thread-safe.
     """
 
-    def __init__(self, libfibre, handle):
+    def __init__(self, libfibre, handle, lazy, prefetch):
         self._libfibre = libfibre
         self._domain_handle = handle
+        self._lazy = lazy
+        self._prefetch = prefetch
 
     def _close(self):
         libfibre_close_domain(self._domain_handle)
@@ -958,7 +1451,11 @@ class _Domain():
     def discover_one(self):
         """
         Blocks until exactly one object is discovered.
+        If this function is called from the Fibre thread then it is nonblocking
+        and returns an awaitable instead.
         """
+        if threading.current_thread() == libfibre_thread:
+            return asyncio.ensure_future(self._discover_one(), loop=self._libfibre.loop)
         return run_coroutine_threadsafe(self._libfibre.loop, self._discover_one)
 
     def run_discovery(self, callback):
@@ -968,7 +1465,10 @@ class _Domain():
         Returns a `Discovery` object on which `stop()` can be called to
         terminate the discovery.
         """
-        discovery = run_coroutine_threadsafe(self._libfibre.loop, self._start_discovery)
+        if threading.current_thread() == libfibre_thread:
+            discovery = self._start_discovery()
+        else:
+            discovery = run_coroutine_threadsafe(self._libfibre.loop, self._start_discovery)
         async def loop():
             while True:
                 obj = await discovery._next()
@@ -978,15 +1478,23 @@ class _Domain():
 
 
 class Domain():
-    def __init__(self, path):
+    def __init__(self, path, lazy=False, prefetch=False):
+        """
+        path: The path(s) on which objects are discovered (e.g. "usb").
+        lazy: If False, the complete object tree of a discovered object is
+              loaded before the object is announced. If True, the object is
+              announced immediately and sub-objects are loaded on first access.
+        prefetch: Only relevant if lazy is True. If True, the object tree is
+              loaded in the background after the object was announced.
+        """
         increment_lib_refcount()
-        self._opened_domain = run_coroutine_threadsafe(libfibre.loop, lambda: Domain._open(path))
+        self._opened_domain = run_coroutine_threadsafe(libfibre.loop, lambda: Domain._open(path, lazy, prefetch))
         
-    def _open(path):
+    def _open(path, lazy, prefetch):
         assert(libfibre_thread == threading.current_thread())
         buf = path.encode('ascii')
         domain_handle = libfibre_open_domain(libfibre.ctx, buf, len(buf))
-        return _Domain(libfibre, domain_handle)
+        return _Domain(libfibre, domain_handle, lazy, prefetch)
 
     def __enter__(self):
         return self._opened_domain
@@ -996,19 +1504,67 @@ class Domain():
         self._opened_domain = None
         decrement_lib_refcount()
 
-libfibre = None
+class AsyncDomain():
+    """
+    Counterpart of Domain for applications that already run an asyncio event
+    loop. Instead of starting a separate libfibre thread, libfibre is run on
+    the event loop of the caller, which makes that loop the Fibre thread.
+    Calls issued from the loop thus complete without any cross-thread handoff.
 
-def _run_event_loop():
-    global libfibre
-    global terminate_libfibre
+    Usage:
 
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+        async with fibre.AsyncDomain(path) as domain:
+            odrv = fibre.AsyncRemoteObject(await domain.discover_one())
+            pos, vel = await asyncio.gather(
+                odrv.axis0.encoder.pos_estimate,
+                odrv.axis0.encoder.vel_estimate)
 
-    terminate_libfibre = loop.create_future()
-    libfibre = LibFibre()
+    The blocking API (Domain) cannot be used at the same time. See Domain for
+    the meaning of lazy and prefetch.
+    """
+    def __init__(self, path, lazy=False, prefetch=False):
+        self._path = path
+        self._lazy = lazy
+        self._prefetch = prefetch
+        self._opened_domain = None
 
-    libfibre.loop.run_until_complete(terminate_libfibre)
+    async def __aenter__(self):
+        global libfibre
+        global libfibre_refcount
+        global libfibre_thread
+        global libfibre_on_external_loop
+
+        with lock:
+            if libfibre_refcount == 0:
+                libfibre_thread = threading.current_thread()
+                libfibre_on_external_loop = True
+                libfibre = LibFibre()
+            elif not libfibre_on_external_loop or libfibre.loop != asyncio.get_event_loop():
+                raise Exception("libfibre is already running on a different event loop")
+            libfibre_refcount += 1
+
+        self._opened_domain = Domain._open(self._path, self._lazy, self._prefetch)
+        return self._opened_domain
+
+    async def __aexit__(self, type, value, traceback):
+        global libfibre_refcount
+        global libfibre_thread
+        global libfibre_on_external_loop
+
+        self._opened_domain._close()
+        self._opened_domain = None
+
+        with lock:
+            libfibre_refcount -= 1
+            if libfibre_refcount == 0:
+                _close_libfibre()
+                libfibre_thread = None
+                libfibre_on_external_loop = False
+
+libfibre = None
+
+def _close_libfibre():
+    global libfibre
 
     libfibre_close(libfibre.ctx)
 
@@ -1024,16 +1580,34 @@ def _run_event_loop():
 
     libfibre = None
 
+def _run_event_loop():
+    global libfibre
+    global terminate_libfibre
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    terminate_libfibre = loop.create_future()
+    libfibre = LibFibre()
+
+    libfibre.loop.run_until_complete(terminate_libfibre)
+
+    _close_libfibre()
+
 
 lock = threading.Lock()
 libfibre_refcount = 0
 libfibre_thread = None
+libfibre_on_external_loop = False # True while libfibre runs on the loop of an AsyncDomain user
 
 def increment_lib_refcount():
     global libfibre_refcount
     global libfibre_thread
 
     with lock:
+        if libfibre_on_external_loop:
+            raise Exception("libfibre is already running on the event loop of an AsyncDomain")
+
         libfibre_refcount += 1
         #print("inc refcount to {}".format(libfibre_refcount))
 
@@ -1062,6 +1636,312 @@ def decrement_lib_refcount():
             libfibre_thread.join()
             libfibre_thread = None
 
+call_stats = None # CallStats object while stats collection is enabled
+
+def enable_stats(track_callers=False):
+    """
+    Starts collecting call statistics (call count, bytes, latency) for every
+    function and property endpoint. If track_callers is True, the source
+    location that issued each call is recorded too (this adds some overhead to
+    every call).
+    """
+    global call_stats
+    call_stats = CallStats(track_callers)
+
+def disable_stats():
+    global call_stats
+    call_stats = None
+
+def reset_stats():
+    """Clears all statistics collected so far."""
+    if not call_stats is None:
+        enable_stats(call_stats.track_callers)
+
+def stats():
+    """
+    Returns a snapshot of the call statistics as a dict. Latencies are in
+    seconds, 'p50' and 'p99' are the median and 99th percentile latency.
+    Returns None if stats collection is not enabled (see enable_stats()).
+    Example:
+        fibre.enable_stats()
+        ...
+        fibre.stats()['endpoints']['axis0.encoder.pos_estimate.read']['p99']
+    """
+    current_stats = call_stats
+    if current_stats is None:
+        return None
+    current_libfibre = libfibre
+    return {
+        'duration': time.monotonic() - current_stats.start_time,
+        'in_flight': 0 if current_libfibre is None else len(current_libfibre._calls),
+        'endpoints': current_stats.snapshot(),
+    }
+
+def read_many(obj, paths, timeout=None):
+    """
+    Reads the properties specified by a list of dotted paths (relative to obj)
+    with all calls in flight at the same time.
+    Example: read_many(odrv0, ['vbus_voltage', 'axis0.encoder.pos_estimate'])
+
+    Returns a tuple with one value per path. See RemoteObject._read_many() for
+    the threading behavior and the meaning of timeout.
+    """
+    return obj._read_many(paths, timeout)
+
+def snapshot(obj, depth=None):
+    """
+    Reads all properties below obj concurrently and returns them as nested
+    dicts. See RemoteObject._snapshot() for details.
+    Example: snapshot(odrv0.axis0)['encoder']['pos_estimate']
+    """
+    return obj._snapshot(depth)
+
+def _start_path_call(obj, path, args):
+    """
+    Starts reading the property or calling the function at the specified
+    dotted path (relative to obj) and returns an awaitable.
+    Must be called on the Fibre thread.
+    """
+    keys = path.split('.')
+    parent = obj
+    for key in keys[:-1]:
+        parent = getattr(parent, key)
+    class_member = getattr(parent.__class__, keys[-1], None)
+    if isinstance(class_member, RemoteFunction):
+        return class_member(parent, *args)
+    elif len(args) == 0:
+        return obj._resolve_path(path).read()
+    else:
+        raise AttributeError("{} is not a function".format(path))
+
+async def _call_with_timeout(start_call, key, path, timeout):
+    """
+    Starts a call with start_call() (on the Fibre thread) and waits up to
+    `timeout` seconds for it. Returns the result or the exception that
+    occurred.
+
+    A call that timed out is not cancelled (see below) so it keeps running
+    until the device responds. While it is still in flight, further calls
+    with the same key (e.g. the property object) are not started and return
+    a TimeoutError right away.
+    """
+    if key in libfibre._timed_out_calls:
+        return TimeoutError("{} did not complete within {}s (the previous call is still pending)".format(path, timeout))
+    try:
+        # The call is shielded so that a timeout doesn't cancel it while
+        # libfibre still holds its buffers. Only the waiting is aborted.
+        future = asyncio.ensure_future(start_call())
+        future.add_done_callback(lambda f: f.cancelled() or f.exception()) # don't warn about unretrieved exceptions
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+    except asyncio.TimeoutError:
+        timed_out_calls = libfibre._timed_out_calls
+        timed_out_calls[key] = future
+        future.add_done_callback(lambda f: timed_out_calls.pop(key, None))
+        return TimeoutError("{} did not complete within {}s".format(path, timeout))
+    except Exception as ex:
+        return ex
+
+async def _call_all_async(objects, path, args, timeout):
+    return await asyncio.gather(*[
+        _call_with_timeout(lambda obj=obj: _start_path_call(obj, path, args), (obj, path), path, timeout)
+        for obj in objects])
+
+def call_all(objects, path, *args, timeout=None):
+    """
+    Reads the property or calls the function specified by a dotted path on
+    each object in `objects`. All calls are in flight at the same time.
+    Examples:
+        call_all(odrives, 'vbus_voltage')
+        call_all(odrives, 'clear_errors')
+        call_all(odrives, 'get_adc_voltage', 5, timeout=0.5)
+
+    Returns a list with one entry per object. If the call failed or did not
+    complete within `timeout` seconds on an object, the corresponding entry is
+    the exception (e.g. ObjectLostError or TimeoutError) instead of the result.
+    As in read_many(), a path whose previous call on an object timed out and
+    is still pending is not called again on that object until it completes.
+
+    If this function is called from the Fibre thread then it is nonblocking
+    and returns an asyncio.Future.
+    """
+    objects = list(objects)
+    current_libfibre = libfibre
+    if current_libfibre is None:
+        raise Exception("call_all() needs an open Domain. Use it on objects that were discovered with fibre.Domain or fibre.AsyncDomain.")
+    loop = current_libfibre.loop
+    if threading.current_thread() != libfibre_thread:
+        return run_coroutine_threadsafe(loop, lambda: _call_all_async(objects, path, args, timeout))
+    return asyncio.ensure_future(_call_all_async(objects, path, args, timeout), loop=loop)
+
+def _write_fire_and_forget(prop, value):
+    try:
+        future = prop.exchange(value)
+    except Exception:
+        return # object lost
+    future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+def write_nowait(obj, path, value, coalesce=True):
+    """
+    Writes a property without waiting for the write to complete. This is meant
+    for streaming setpoints at a high rate:
+        write_nowait(odrv0, 'axis0.controller.input_pos', pos)
+
+    If coalesce is True, there is at most one write in flight per property.
+    Values that are written while a write is in flight replace each other so
+    that only the most recent one is sent once the write completes
+    (last writer wins).
+    If coalesce is False, every value is sent right away without limiting the
+    number of writes in flight.
+
+    Errors (e.g. a lost device) are not reported to the caller. Only the first
+    write to a path may block while the path is resolved.
+    """
+    prop = obj._resolve_path(path, writable=True)
+    lib = prop._libfibre
+    if coalesce:
+        write = lambda: lib._write_coalesced(prop, value)
+    else:
+        write = lambda: _write_fire_and_forget(prop, value)
+
+    if threading.current_thread() == libfibre_thread:
+        write()
+    else:
+        lib.loop.call_soon_threadsafe(write)
+
+class Subscription():
+    """
+    Periodically samples a set of properties on the Fibre thread and stores
+    the timestamped samples in a preallocated ring buffer. Use subscribe() to
+    create a subscription.
+
+    The sampling times are scheduled on an absolute time grid so that they
+    don't drift. If a sampling round takes longer than the period, the
+    sampling slots that were missed are skipped and counted in n_missed.
+
+    If the consumer doesn't drain the buffer fast enough, the oldest samples
+    are overwritten and counted in n_dropped.
+
+    drain() and stop() are thread-safe and don't wait for the Fibre thread.
+    """
+
+    def __init__(self, obj, paths, rate, capacity):
+        self._obj = obj
+        self._paths = list(paths)
+        if len(set(self._paths)) != len(self._paths):
+            raise ValueError("duplicate paths")
+        self._period = 1.0 / rate
+        self._capacity = capacity
+        self._buffer = None # allocated in _start() once the codecs are known
+        self._lock = threading.Lock()
+        self._n_written = 0
+        self._n_read = 0
+        self._loop = None
+        self._task = None
+        self._stop_requested = None
+        self.n_missed = 0
+        self.n_dropped = 0
+        self.error = None # Set to the exception that terminated the sampling (if any)
+
+    def _start(self):
+        import numpy as np
+        properties = [self._obj._resolve_path(path) for path in self._paths]
+        # Each column has the type of the property so that e.g. uint64 values
+        # don't lose precision in a float64 column.
+        self._buffer = np.zeros(self._capacity, dtype=[('time', 'f8')] + [
+            (path, numpy_dtypes[prop.__class__.read._outputs[0][1]])
+            for path, prop in zip(self._paths, properties)])
+        # The loop is kept because obj._libfibre is cleared when obj is lost
+        self._loop = self._obj._libfibre.loop
+        self._stop_requested = self._loop.create_future()
+        self._task = asyncio.ensure_future(self._run(properties), loop=self._loop)
+
+    async def _run(self, properties):
+        loop = self._loop
+        next_time = loop.time()
+        try:
+            while not self._stop_requested.done():
+                timestamp = loop.time()
+                values = await asyncio.gather(*[prop.read() for prop in properties])
+                self._push(timestamp, values)
+
+                next_time += self._period
+                delay = next_time - loop.time()
+                if delay < 0:
+                    n_missed = int(-delay / self._period)
+                    self.n_missed += n_missed
+                    next_time += n_missed * self._period
+                # Calls that are in flight are never cancelled, stop() only
+                # interrupts the wait between two samples.
+                await asyncio.wait([self._stop_requested], timeout=max(delay, 0))
+        except Exception as ex:
+            self.error = ex
+
+    def _push(self, timestamp, values):
+        with self._lock:
+            self._buffer[self._n_written % self._capacity] = (timestamp, *values)
+            self._n_written += 1
+            if self._n_written - self._n_read > self._capacity:
+                self._n_read += 1
+                self.n_dropped += 1
+
+    def get_paths(self):
+        return list(self._paths)
+
+    def drain(self):
+        """
+        Removes all samples from the buffer and returns them as a numpy
+        structured array with one entry per sample. The field 'time' holds the
+        sampling time (in seconds, same time base as time.monotonic()). The
+        value of each property is in the field named by its path and has the
+        type of the property (e.g. uint64 or float32).
+        Example: data = sub.drain(); data['axis0.encoder.pos_estimate']
+        """
+        import numpy as np
+        with self._lock:
+            n_samples = self._n_written - self._n_read
+            indices = (self._n_read + np.arange(n_samples)) % self._capacity
+            self._n_read = self._n_written
+            return self._buffer[indices]
+
+    def stop(self):
+        """
+        Stops the sampling. A sampling round that is already in progress is
+        completed. Samples that are still in the buffer can be drained
+        afterwards. Does nothing if the sampling already ended (e.g. because
+        the object was lost).
+        """
+        if self._task is None or self._task.done():
+            return
+        def request_stop():
+            if not self._stop_requested.done():
+                self._stop_requested.set_result(None)
+        if threading.current_thread() == libfibre_thread:
+            request_stop()
+        else:
+            self._loop.call_soon_threadsafe(request_stop)
+
+def subscribe(obj, paths, rate, capacity=10000):
+    """
+    Starts sampling the properties specified by a list of dotted paths
+    (relative to obj) at the specified rate [Hz]. All properties of one sample
+    are read concurrently. The samples are stored in a ring buffer that can
+    hold `capacity` samples.
+
+    Returns a Subscription object.
+    Example:
+        sub = subscribe(odrv0, ['axis0.encoder.pos_estimate', 'axis0.encoder.vel_estimate'], rate=1000)
+        ...
+        data = sub.drain()
+        plot(data['time'], data['axis0.encoder.pos_estimate'])
+        sub.stop()
+    """
+    subscription = Subscription(obj, paths, rate, capacity)
+    if threading.current_thread() == libfibre_thread:
+        subscription._start()
+    else:
+        run_coroutine_threadsafe(obj._libfibre.loop, subscription._start)
+    return subscription
+
 def get_user_name(obj):
     """
     Can be overridden by the application to return the user-facing name of an
@@ -0,0 +1,386 @@
+"""
+In-memory transport and simulated device for the Python implementation of the
+Fibre protocol (fibre.protocol). Together they allow exercising Channel and the
+layers above it without hardware.
+
+Example:
+
+    device = SimulatedDevice({'vbus_voltage': ('float', 24.0, 'r'),
+                              'axis0': {'pos_setpoint': ('float', 0.0)}})
+    channel = connect(device, Event(), Logger(verbose=False), latency=0.001)
+    json_bytes = load_interface_definition(channel)
+"""
+
+import heapq
+import itertools
+import json
+import math
+import random
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+from fibre.utils import TimeoutError
+from fibre.protocol import (StreamSource, StreamSink, PacketSink, Channel,
+    PacketFromStreamConverter, StreamBasedPacketSink, calc_crc16,
+    PROTOCOL_VERSION, MAX_PACKET_SIZE)
+
+# Maps the type names of the legacy JSON interface definition to struct formats
+codecs = {
+    'bool': '<?',
+    'int8': '<b', 'uint8': '<B',
+    'int16': '<h', 'uint16': '<H',
+    'int32': '<i', 'uint32': '<I',
+    'int64': '<q', 'uint64': '<Q',
+    'float': '<f',
+}
+
+class _Timer():
+    """
+    Invokes callbacks at specified times on a single thread that is shared by
+    all LoopbackStreams.
+    """
+    def __init__(self):
+        self._heap = [] # (time, sequence number, callback) tuples
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def call_at(self, when, callback):
+        with self._condition:
+            heapq.heappush(self._heap, (when, next(self._sequence), callback))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._condition.wait(self._heap[0][0] - now if self._heap else None)
+                _, _, callback = heapq.heappop(self._heap)
+            callback()
+
+_timer = _Timer()
+
+class LoopbackStream(StreamSource, StreamSink):
+    """
+    One direction of an in-memory link. Bytes that are written with
+    process_bytes() can be read with get_bytes() once they went through the
+    link.
+
+    latency: Time in seconds between the end of the transmission of a chunk
+             and its arrival.
+    bandwidth: Bytes per second or None for unlimited bandwidth. Chunks are
+               transmitted one after another.
+    bit_error_rate: Probability of each bit being flipped on the way.
+    seed: Seed for the bit error generator.
+
+    The stream can be used with a selector through fileno(). The bytes are
+    then read with get_bytes() and a deadline in the past.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=None, bit_error_rate=0.0, seed=None):
+        if not (0.0 <= bit_error_rate < 1.0):
+            raise ValueError("bit_error_rate must be in [0, 1)")
+        self._latency = latency
+        self._bandwidth = bandwidth
+        self._bit_error_rate = bit_error_rate
+        self._rng = random.Random(seed)
+        self._chunks = deque() # (arrival time, bytearray) tuples in order of arrival
+        self._line_free_at = 0.0
+        self._condition = threading.Condition()
+        self._signal = None # socket pair that signals arrived bytes to a selector
+        self._signalled = False
+        self.n_bytes = 0
+        self.n_bit_errors = 0
+
+    def fileno(self):
+        """
+        Returns a file descriptor that is readable while get_bytes() would
+        return bytes.
+        """
+        with self._condition:
+            if self._signal is None:
+                self._signal = socket.socketpair()
+                for sock in self._signal:
+                    sock.setblocking(False)
+                self._update_signal(time.monotonic())
+            return self._signal[0].fileno()
+
+    def close(self):
+        with self._condition:
+            if not self._signal is None:
+                for sock in self._signal:
+                    sock.close()
+
+    def _update_signal(self, now):
+        """Must be called with _condition held."""
+        if self._signal is None or self._signal[0].fileno() < 0:
+            return
+        has_arrived = self._has_arrived(now)
+        if has_arrived and not self._signalled:
+            self._signal[1].send(b'\0')
+            self._signalled = True
+        elif not has_arrived and self._signalled:
+            self._signal[0].recv(1)
+            self._signalled = False
+
+    def _on_arrival(self):
+        with self._condition:
+            self._update_signal(time.monotonic())
+
+    def _inject_errors(self, data):
+        # Instead of rolling the dice for each bit, draw the distance to the
+        # next bit error from the geometric distribution.
+        log_q = math.log1p(-self._bit_error_rate)
+        pos = -1
+        while True:
+            pos += 1 + int(math.log(1.0 - self._rng.random()) / log_q)
+            if pos >= len(data) * 8:
+                return
+            data[pos >> 3] ^= 1 << (pos & 7)
+            self.n_bit_errors += 1
+
+    def process_bytes(self, bytes):
+        data = bytearray(bytes)
+        with self._condition:
+            if self._bit_error_rate:
+                self._inject_errors(data)
+            now = time.monotonic()
+            if self._bandwidth is None:
+                self._line_free_at = now
+            else:
+                self._line_free_at = max(now, self._line_free_at) + len(data) / self._bandwidth
+            arrival = self._line_free_at + self._latency
+            self._chunks.append((arrival, data))
+            self.n_bytes += len(data)
+            self._condition.notify_all()
+            if not self._signal is None:
+                if arrival <= now:
+                    self._update_signal(now)
+                else:
+                    _timer.call_at(arrival, self._on_arrival)
+
+    def _has_arrived(self, now):
+        return bool(self._chunks) and self._chunks[0][0] <= now
+
+    def _n_arrived(self, now):
+        return sum(len(data) for arrival, data in self._chunks if arrival <= now)
+
+    def _wait(self, predicate, deadline):
+        """
+        Waits (with _condition held) until predicate(now) is True. Returns False
+        if the deadline passed before that.
+        """
+        while True:
+            now = time.monotonic()
+            if predicate(now):
+                return True
+            if not deadline is None and now >= deadline:
+                return False
+            next_arrival = next((arrival for arrival, _ in self._chunks if arrival > now), None)
+            timeouts = [] if next_arrival is None else [next_arrival - now]
+            if not deadline is None:
+                timeouts.append(deadline - now)
+            self._condition.wait(min(timeouts) if timeouts else None)
+
+    def _take(self, n_bytes, now):
+        result = bytearray()
+        while self._chunks and self._chunks[0][0] <= now and len(result) < n_bytes:
+            arrival, data = self._chunks.popleft()
+            n_taken = min(len(data), n_bytes - len(result))
+            result += data[:n_taken]
+            if n_taken < len(data):
+                self._chunks.appendleft((arrival, data[n_taken:]))
+        self._update_signal(now)
+        return bytes(result)
+
+    def get_bytes(self, n_bytes, deadline):
+        """
+        Returns up to n_bytes bytes that arrived until the deadline (which can
+        be None to wait indefinitely). Returns an empty result if no bytes
+        arrived before the deadline.
+        """
+        with self._condition:
+            if not self._wait(self._has_arrived, deadline):
+                return b''
+            return self._take(n_bytes, time.monotonic())
+
+    def get_bytes_or_fail(self, n_bytes, deadline):
+        """
+        Returns exactly n_bytes bytes or raises a TimeoutError if they did not
+        arrive until the deadline. In that case no bytes are consumed.
+        """
+        with self._condition:
+            if not self._wait(lambda now: self._n_arrived(now) >= n_bytes, deadline):
+                raise TimeoutError()
+            return self._take(n_bytes, time.monotonic())
+
+
+class SimulatedDevice():
+    """
+    Serves a JSON interface definition and a table of properties through the
+    legacy Fibre protocol, similar to the firmware.
+
+    properties: A nested dict that maps names to either a dict (a sub-object)
+                or a tuple (type, initial value[, access]) where type is one
+                of the keys of `codecs` and access is 'r' or 'rw' (default).
+    """
+
+    def __init__(self, properties):
+        self._values = [None] # endpoint 0 is the JSON interface definition
+        self._codecs = [None]
+        self._writable = [False]
+        self._endpoint_ids = {}
+        definition = [{'name': '', 'id': 0, 'type': 'json', 'access': 'r'}]
+        definition += self._add_members(properties, '')
+        self.json = json.dumps(definition).encode('utf-8')
+        self.json_crc = calc_crc16(PROTOCOL_VERSION, self.json)
+        self.version_id = (self.json_crc << 16) | calc_crc16(self.json_crc, self.json)
+        self._lock = threading.Lock()
+        self.n_requests = 0
+
+    def _add_members(self, members, prefix):
+        result = []
+        for name, member in members.items():
+            if isinstance(member, dict):
+                result.append({'name': name, 'type': 'object',
+                               'members': self._add_members(member, prefix + name + '.')})
+            else:
+                codec, value, access = (tuple(member) + ('rw',))[:3]
+                if not codec in codecs:
+                    raise ValueError("unsupported type {} for {}".format(codec, prefix + name))
+                self._endpoint_ids[prefix + name] = len(self._values)
+                result.append({'name': name, 'id': len(self._values), 'type': codec, 'access': access})
+                self._values.append(value)
+                self._codecs.append(codecs[codec])
+                self._writable.append('w' in access)
+        return result
+
+    def get_endpoint_id(self, path):
+        """Returns the endpoint ID of a property, e.g. "axis0.pos_setpoint"."""
+        return self._endpoint_ids[path]
+
+    def get_value(self, path):
+        with self._lock:
+            return self._values[self._endpoint_ids[path]]
+
+    def set_value(self, path, value):
+        """Changes the value of a property from the device side."""
+        with self._lock:
+            self._values[self._endpoint_ids[path]] = value
+
+    def _handle_endpoint(self, endpoint_id, input):
+        if endpoint_id == 0:
+            if len(input) < 4:
+                return None
+            offset, = struct.unpack('<I', input[:4])
+            if offset == 0xffffffff:
+                return struct.pack('<I', self.version_id)
+            return self.json[offset:]
+        if endpoint_id >= len(self._values):
+            return None
+        codec = self._codecs[endpoint_id]
+        with self._lock:
+            old_value = self._values[endpoint_id]
+            if len(input) >= struct.calcsize(codec) and self._writable[endpoint_id]:
+                self._values[endpoint_id], = struct.unpack(codec, input[:struct.calcsize(codec)])
+        return struct.pack(codec, old_value)
+
+    def handle_request(self, packet, mtu=MAX_PACKET_SIZE - 1):
+        """
+        Handles one request packet (without framing) and returns the response
+        packet or None if there is no response.
+        mtu: The maximum size of the response packet.
+        """
+        self.n_requests += 1
+        if len(packet) < 8:
+            return None
+        seq_no, endpoint_id, output_length = struct.unpack('<HHH', packet[:6])
+        expect_response = endpoint_id & 0x8000
+        endpoint_id &= 0x7fff
+        trailer, = struct.unpack('<H', packet[-2:])
+        if trailer != (self.json_crc if endpoint_id else PROTOCOL_VERSION):
+            return None
+        output = self._handle_endpoint(endpoint_id, bytes(packet[6:-2]))
+        if not expect_response:
+            return None
+        output = (output or b'')[:min(output_length, mtu - 2)]
+        return struct.pack('<H', seq_no | 0x8000) + output
+
+    def serve(self, input, output, cancellation_token, max_packet_size=MAX_PACKET_SIZE, manager=None):
+        """
+        Handles the requests that arrive on the input stream and sends the
+        responses to the output stream until the cancellation_token is set.
+        The requests are handled on a new thread, or on the thread of a
+        fibre.channel_manager.ChannelManager if one is specified.
+        """
+        sink = StreamBasedPacketSink(output, max_packet_size=max_packet_size)
+
+        def handle_packet(packet):
+            response = self.handle_request(packet, max_packet_size - 1)
+            if not response is None:
+                sink.process_packet(response)
+
+        if not manager is None:
+            registration = manager.add_stream(input, _CallbackPacketSink(handle_packet), max_packet_size)
+            cancellation_token.subscribe(lambda: manager.remove_stream(registration))
+            return
+
+        converter = PacketFromStreamConverter(input, max_packet_size=max_packet_size)
+
+        def server_thread():
+            while not cancellation_token.is_set():
+                try:
+                    packet = converter.get_packet(time.monotonic() + 0.1)
+                except TimeoutError:
+                    continue
+                handle_packet(packet)
+
+        t = threading.Thread(target=server_thread)
+        t.daemon = True
+        t.start()
+
+
+class _CallbackPacketSink(PacketSink):
+    def __init__(self, callback):
+        self._callback = callback
+
+    def process_packet(self, packet):
+        self._callback(packet)
+
+
+def connect(device, cancellation_token, logger, latency=0.0, bandwidth=None,
+            bit_error_rate=0.0, seed=None, max_packet_size=MAX_PACKET_SIZE,
+            manager=None, device_manager=None, name="loopback", **kwargs):
+    """
+    Connects a new Channel to a SimulatedDevice through a pair of
+    LoopbackStreams with the specified properties and returns the Channel.
+    The remaining keyword arguments are passed on to the Channel.
+    The streams are available as channel.to_device and channel.from_device.
+
+    manager, device_manager: ChannelManagers that service the Channel and the
+        device respectively. By default both use their own threads.
+    """
+    rng = random.Random(seed)
+    to_device = LoopbackStream(latency, bandwidth, bit_error_rate, rng.random())
+    from_device = LoopbackStream(latency, bandwidth, bit_error_rate, rng.random())
+    device.serve(to_device, from_device, cancellation_token, max_packet_size, device_manager)
+    output = StreamBasedPacketSink(to_device, max_packet_size=max_packet_size)
+    if manager is None:
+        channel = Channel(name, PacketFromStreamConverter(from_device, max_packet_size=max_packet_size),
+                          output, cancellation_token, logger, max_packet_size=max_packet_size, **kwargs)
+    else:
+        channel = manager.create_channel(name, from_device, output, cancellation_token, logger,
+                                         max_packet_size=max_packet_size, **kwargs)
+    channel.to_device = to_device
+    channel.from_device = from_device
+    return channel
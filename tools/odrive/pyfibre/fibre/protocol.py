@@ -1,10 +1,12 @@
 # See protocol.hpp for an overview of the protocol
 
 import time
+import concurrent.futures
 import struct
 import sys
 import threading
 import traceback
+from collections import deque
 #import fibre.utils
 from fibre.utils import Event, wait_any, TimeoutError
 
@@ -28,6 +30,13 @@ CRC16_DEFAULT = 0x3d65 # this must match the polynomial in the C++ implementatio
 
 MAX_PACKET_SIZE = 128
 
+# Packets of MAX_PACKET_SIZE bytes or more can be sent with a 4-byte header
+# whose second byte has the top bit set and holds the upper 7 bits of the
+# length. This is an extension of the Python implementation that the firmware
+# does not understand, so it must be enabled explicitly on both ends by passing
+# a max_packet_size larger than MAX_PACKET_SIZE.
+MAX_EXTENDED_PACKET_SIZE = 0x8000
+
 # For more information on the CRC algorithm refer to protocol.md
 
 def calc_crc(remainder, value, polynomial, bitwidth):
@@ -43,24 +52,41 @@ def calc_crc(remainder, value, polynomial, bitwidth):
 
     return remainder & ((1 << bitwidth) - 1)
 
-def calc_crc8(remainder, value):
-    if isinstance(value, bytearray) or isinstance(value, bytes) or isinstance(value, list):
-        for byte in value:
-            if not isinstance(byte,int):
-                byte = ord(byte)
-            remainder = calc_crc(remainder, byte, CRC8_DEFAULT, 8)
+def _make_crc_table(polynomial, bitwidth):
+    """
+    Returns a lookup table that maps every possible byte to its CRC (with
+    remainder 0). The CRC of a byte for any other remainder can be derived
+    from this table because the CRC is linear.
+    """
+    return [calc_crc(0, byte, polynomial, bitwidth) for byte in range(256)]
+
+_crc8_table = _make_crc_table(CRC8_DEFAULT, 8)
+_crc16_table = _make_crc_table(CRC16_DEFAULT, 16)
+
+def _as_bytes(value):
+    """
+    Returns value (an int, a bytes-like object or a list of ints or
+    characters) as an object that iterates over ints.
+    """
+    if isinstance(value, int):
+        return (value,)
+    elif isinstance(value, (bytes, bytearray)):
+        return value
+    elif isinstance(value, memoryview):
+        return value.cast('B') if value.format != 'B' else value
     else:
-        remainder = calc_crc(remainder, byte, CRC8_DEFAULT, 8)
+        return [byte if isinstance(byte, int) else ord(byte) for byte in value]
+
+def calc_crc8(remainder, value):
+    table = _crc8_table
+    for byte in _as_bytes(value):
+        remainder = table[remainder ^ byte]
     return remainder
 
 def calc_crc16(remainder, value):
-    if isinstance(value, bytearray) or isinstance(value, bytes) or isinstance(value, list):
-        for byte in value:
-            if not isinstance(byte, int):
-                byte = ord(byte)
-            remainder = calc_crc(remainder, byte, CRC16_DEFAULT, 16)
-    else:
-        remainder = calc_crc(remainder, value, CRC16_DEFAULT, 16)
+    table = _crc16_table
+    for byte in _as_bytes(value):
+        remainder = ((remainder << 8) & 0xffff) ^ table[(remainder >> 8) ^ byte]
     return remainder
 
 
@@ -102,127 +128,211 @@ class PacketSink(ABC):
         pass
 
 
+def _check_max_packet_size(max_packet_size):
+    if max_packet_size > MAX_EXTENDED_PACKET_SIZE:
+        raise ValueError("max_packet_size must not exceed {}".format(MAX_EXTENDED_PACKET_SIZE))
+
+def _find_packet(buffer, pos, max_packet_size=MAX_PACKET_SIZE):
+    """
+    Searches a bytearray for the next valid packet, starting at offset pos.
+    Packets of max_packet_size bytes or more are discarded.
+
+    Returns a tuple (start, end, pos):
+    If a packet was found, buffer[start:end] is its payload (without header
+    and CRC) and pos is the offset after the packet.
+    Otherwise start is None, pos is the offset of the first byte that can
+    still be the beginning of a packet (everything before it can be discarded)
+    and end is the buffer length that is needed before searching again.
+    """
+    while True:
+        pos = buffer.find(SYNC_BYTE, pos)
+        if pos < 0:
+            pos = len(buffer)
+            return None, pos + 3, pos
+        if len(buffer) < pos + 3:
+            return None, pos + 3, pos
+        if (buffer[pos + 1] & 0x80):
+            if max_packet_size <= MAX_PACKET_SIZE:
+                pos += 1
+                continue
+            if len(buffer) < pos + 4:
+                return None, pos + 4, pos
+            header_length = 4
+            packet_length = ((buffer[pos + 1] & 0x7f) << 8) | buffer[pos + 2]
+        else:
+            header_length = 3
+            packet_length = buffer[pos + 1]
+        if (packet_length >= max_packet_size) or calc_crc8(CRC8_INIT, buffer[pos:pos + header_length]):
+            pos += 1
+            continue
+        start = pos + header_length
+        end = start + packet_length + 2
+        if len(buffer) < end:
+            return None, end, pos
+        if calc_crc16(CRC16_INIT, buffer[start:end]):
+            # The sync byte may have been a payload byte of a corrupted or
+            # truncated packet, so resume the search right after it.
+            pos += 1
+            continue
+        return start, end - 2, end
+
 class StreamToPacketSegmenter(StreamSink):
-    def __init__(self, output):
-        self._header = []
-        self._packet = []
-        self._packet_length = 0
+    def __init__(self, output, max_packet_size=MAX_PACKET_SIZE):
+        _check_max_packet_size(max_packet_size)
+        self._buffer = bytearray()
+        self._n_needed = 0 # number of bytes needed to complete the pending packet
         self._output = output
+        self._max_packet_size = max_packet_size
 
     def process_bytes(self, bytes):
         """
         Processes an arbitrary number of bytes. If one or more full packets are
         are received, they are sent to this instance's output PacketSink.
         Incomplete packets are buffered between subsequent calls to this function.
-        """
-
-        for byte in bytes:
-            if (len(self._header) < 3):
-                # Process header byte
-                self._header.append(byte)
-                if (len(self._header) == 1) and (self._header[0] != SYNC_BYTE):
-                    self._header = []
-                elif (len(self._header) == 2) and (self._header[1] & 0x80):
-                    self._header = [] # TODO: support packets larger than 128 bytes
-                elif (len(self._header) == 3) and calc_crc8(CRC8_INIT, self._header):
-                    self._header = []
-                elif (len(self._header) == 3):
-                    self._packet_length = self._header[1] + 2
-            else:
-                # Process payload byte
-                self._packet.append(byte)
 
-            # If both header and packet are fully received, hand it on to the packet processor
-            if (len(self._header) == 3) and (len(self._packet) == self._packet_length):
-                if calc_crc16(CRC16_INIT, self._packet) == 0:
-                    self._output.process_packet(self._packet[:-2])
-                self._header = []
-                self._packet = []
-                self._packet_length = 0
+        The packets are passed on as memoryviews into the receive buffer. They
+        are only valid during the call to process_packet() and must be copied
+        if the PacketSink needs them afterwards.
+        """
+        buffer = self._buffer
+        buffer += bytes
+        if len(buffer) < self._n_needed:
+            return
+        pos = 0
+        try:
+            with memoryview(buffer) as view:
+                while True:
+                    start, end, pos = _find_packet(buffer, pos, self._max_packet_size)
+                    if start is None:
+                        self._n_needed = end - pos
+                        break
+                    packet = view[start:end]
+                    try:
+                        self._output.process_packet(packet)
+                    finally:
+                        packet.release()
+        finally:
+            del buffer[:pos]
 
 
 class StreamBasedPacketSink(PacketSink):
-    def __init__(self, output):
+    def __init__(self, output, max_packet_size=MAX_PACKET_SIZE):
+        _check_max_packet_size(max_packet_size)
         self._output = output
+        self._max_packet_size = max_packet_size
 
     def process_packet(self, packet):
-        if (len(packet) >= MAX_PACKET_SIZE):
-            raise NotImplementedError("packet larger than 127 currently not supported")
+        if (len(packet) >= self._max_packet_size):
+            raise NotImplementedError("packet larger than {} not supported".format(self._max_packet_size - 1))
 
         header = bytearray()
         header.append(SYNC_BYTE)
-        header.append(len(packet))
+        if (len(packet) >= MAX_PACKET_SIZE):
+            header.append(0x80 | (len(packet) >> 8))
+            header.append(len(packet) & 0xff)
+        else:
+            header.append(len(packet))
         header.append(calc_crc8(CRC8_INIT, header))
 
-        self._output.process_bytes(header)
-        self._output.process_bytes(packet)
-
         # append CRC in big endian
         crc16 = calc_crc16(CRC16_INIT, packet)
-        self._output.process_bytes(struct.pack('>H', crc16))
+        self._output.process_bytes(header + packet + struct.pack('>H', crc16))
 
 class PacketFromStreamConverter(PacketSource):
-    def __init__(self, input):
+    def __init__(self, input, max_packet_size=MAX_PACKET_SIZE):
+        _check_max_packet_size(max_packet_size)
         self._input = input
+        self._buffer = bytearray()
+        self._max_packet_size = max_packet_size
     
     def get_packet(self, deadline):
         """
         Requests bytes from the underlying input stream until a full packet is
         received or the deadline is reached, in which case None is returned. A
         deadline before the current time corresponds to non-blocking mode.
+
+        Bytes that were received but did not form a valid packet are searched
+        for the next sync byte, so that a corrupted packet does not cost the
+        packet that follows it. Bytes received before the deadline are kept
+        for the next call.
         """
+        buffer = self._buffer
         while True:
-            header = bytes()
-
+            start, end, pos = _find_packet(buffer, 0, self._max_packet_size)
+            if not start is None:
+                packet = bytes(buffer[start:end])
+                del buffer[:pos]
+                return packet
+            n_missing = end - len(buffer)
+            del buffer[:pos]
             # TODO: sometimes this call hangs, even though the device apparently sent something
-            header = header + self._input.get_bytes_or_fail(1, deadline)
-            if (header[0] != SYNC_BYTE):
-                #print("sync byte mismatch")
-                continue
+            buffer += self._input.get_bytes_or_fail(n_missing, deadline)
 
-            header = header + self._input.get_bytes_or_fail(1, deadline)
-            if (header[1] & 0x80):
-                #print("packet too large")
-                continue # TODO: support packets larger than 128 bytes
 
-            header = header + self._input.get_bytes_or_fail(1, deadline)
-            if calc_crc8(CRC8_INIT, header) != 0:
-                #print("crc8 mismatch")
-                continue
-
-            packet_length = header[1] + 2
-            #print("wait for {} bytes".format(packet_length))
-            packet = self._input.get_bytes_or_fail(packet_length, deadline)
-            if calc_crc16(CRC16_INIT, packet) != 0:
-                #print("crc16 mismatch")
-                continue
-            return packet[:-2]
+class _PendingOperation():
+    def __init__(self, packet, deadline):
+        self.packet = packet
+        self.future = concurrent.futures.Future()
+        self.n_attempts = 0
+        self.deadline = deadline # time after which the packet is resent
+        self.start_time = None
 
 
 class Channel(PacketSink):
     # Choose these parameters to be sensible for a specific transport layer
     _resend_timeout = 5.0     # [s]
     _send_attempts = 5
+    _window_size = 8          # max number of operations awaiting an ACK
+    _max_packet_size = MAX_PACKET_SIZE # must match the framing on both ends
 
-    def __init__(self, name, input, output, cancellation_token, logger):
+    def __init__(self, name, input, output, cancellation_token, logger,
+                 window_size=None, resend_timeout=None, send_attempts=None,
+                 max_packet_size=None, manager=None):
         """
         Params:
         input: A PacketSource where this channel will source packets from on
                demand. Alternatively packets can be provided to this channel
-               directly by calling process_packet on this instance.
+               directly by calling process_packet on this instance, in which
+               case input is None.
         output: A PacketSink where this channel will put outgoing packets.
+        window_size, resend_timeout, send_attempts, max_packet_size:
+               Override the class defaults of the same name.
+        manager: The fibre.channel_manager.ChannelManager that services this
+               channel. If None, the channel starts its own receiver thread
+               (if input is given) and its resend timers are serviced by the
+               default ChannelManager, which all such channels share.
         """
         self._name = name
         self._input = input
         self._output = output
         self._logger = logger
+        if not window_size is None:
+            self._window_size = window_size
+        if not resend_timeout is None:
+            self._resend_timeout = resend_timeout
+        if not send_attempts is None:
+            self._send_attempts = send_attempts
+        if not max_packet_size is None:
+            self._max_packet_size = max_packet_size
         self._outbound_seq_no = 0
         self._interface_definition_crc = 0
-        self._expected_acks = {}
-        self._responses = {}
-        self._my_lock = threading.Lock()
+        self._pending = {} # key: seq_no, value: _PendingOperation
+        self._pending_changed = threading.Condition()
+        self._window = threading.BoundedSemaphore(self._window_size)
+        self._my_lock = threading.Lock() # serializes writes to the output
+        self._manager = manager
+        self._stats = {'requests': 0, 'acks': 0, 'resends': 0, 'failures': 0, 'unexpected_acks': 0}
+        self._rtt_sum = 0.0
+        self._rtt_max = 0.0
         self._channel_broken = Event(cancellation_token)
-        self.start_receiver_thread(Event(self._channel_broken))
+        self._channel_broken.subscribe(self._on_channel_broken)
+        if not input is None:
+            self.start_receiver_thread(Event(self._channel_broken))
+        if manager is None:
+            # imported here because channel_manager depends on this module
+            from fibre.channel_manager import get_default_manager
+            self._manager = get_default_manager()
+            self._manager.add_channel(self)
 
     def start_receiver_thread(self, cancellation_token):
         """
@@ -258,81 +368,189 @@ class Channel(PacketSink):
         t.daemon = True
         t.start()
 
-    def remote_endpoint_operation(self, endpoint_id, input, expect_ack, output_length):
-        if input is None:
-            input = bytearray(0)
-        if (len(input) >= 128):
-            raise Exception("packet larger than 127 currently not supported")
-
-        if (expect_ack):
-            endpoint_id |= 0x8000
+    def _resend(self, expired):
+        for seq_no, op in expired:
+            if op.n_attempts >= self._send_attempts:
+                self._complete(seq_no, error=ObjectLostError()) # Too many resend attempts
+            else:
+                self._send(op)
 
-        self._my_lock.acquire()
-        try:
+    def service_resends(self):
+        """
+        Resends the packets whose ACK did not arrive within the resend timeout
+        and fails the operations that ran out of attempts. Called by the
+        ChannelManager. Returns the time at which this function should be
+        called next or None if no operation is pending.
+        """
+        with self._pending_changed:
+            now = time.monotonic()
+            expired = [(seq_no, op) for seq_no, op in self._pending.items() if op.deadline <= now]
+        self._resend(expired)
+        with self._pending_changed:
+            return min((op.deadline for op in self._pending.values()), default=None)
+
+    def _set_deadline(self, op, deadline):
+        """Must be called with _pending_changed held."""
+        op.deadline = deadline
+        self._manager._schedule(deadline)
+
+    def get_stats(self):
+        """
+        Returns a dict with the number of requests (that expect an ACK), ACKs,
+        resends, failed requests and unexpected ACKs, the number of requests
+        currently in flight and the mean and max round trip time in seconds.
+        """
+        with self._pending_changed:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._pending)
+            stats['rtt_mean'] = self._rtt_sum / stats['acks'] if stats['acks'] else None
+            stats['rtt_max'] = self._rtt_max
+        return stats
+
+    def _on_channel_broken(self):
+        with self._pending_changed:
+            seq_nos = list(self._pending.keys())
+        for seq_no in seq_nos:
+            self._complete(seq_no, error=ObjectLostError())
+
+    def _next_seq_no(self):
+        """
+        Returns a sequence number that is not used by any pending operation.
+        Must be called with _pending_changed held.
+        """
+        while True:
             self._outbound_seq_no = ((self._outbound_seq_no + 1) & 0x7fff)
-            seq_no = self._outbound_seq_no
-        finally:
-            self._my_lock.release()
-        seq_no |= 0x80 # FIXME: we hardwire one bit of the seq-no to 1 to avoid conflicts with the ascii protocol
-        packet = struct.pack('<HHH', seq_no, endpoint_id, output_length)
-        packet = packet + input
+            seq_no = self._outbound_seq_no | 0x80 # FIXME: we hardwire one bit of the seq-no to 1 to avoid conflicts with the ascii protocol
+            if not seq_no in self._pending:
+                return seq_no
 
-        crc16 = calc_crc16(CRC16_INIT, packet)
+    def _make_packet(self, seq_no, endpoint_id, input, output_length):
+        if input is None:
+            input = bytearray(0)
         if (endpoint_id & 0x7fff == 0):
             trailer = PROTOCOL_VERSION
         else:
             trailer = self._interface_definition_crc
-        #print("append trailer " + trailer)
-        packet = packet + struct.pack('<H', trailer)
+        packet = struct.pack('<HHH', seq_no, endpoint_id, output_length) + input + struct.pack('<H', trailer)
+        if (len(packet) >= self._max_packet_size):
+            raise Exception("packet larger than {} not supported".format(self._max_packet_size - 1))
+        return packet
+
+    def _send(self, op):
+        with self._pending_changed:
+            if op.future.done():
+                return
+            op.n_attempts += 1
+            if op.n_attempts > 1:
+                self._stats['resends'] += 1
+            else:
+                op.start_time = time.monotonic()
+            self._set_deadline(op, time.monotonic() + self._resend_timeout)
+        try:
+            with self._my_lock:
+                self._output.process_packet(op.packet)
+        except (ChannelDamagedException, TimeoutError):
+            with self._pending_changed:
+                self._set_deadline(op, time.monotonic()) # resend immediately
+
+    def _complete(self, seq_no, response=None, error=None):
+        """
+        Completes the pending operation with the specified sequence number.
+        Returns False if there is no such operation.
+        """
+        with self._pending_changed:
+            op = self._pending.pop(seq_no, None)
+            if op is None:
+                return False
+            if error is None:
+                self._stats['acks'] += 1
+                rtt = time.monotonic() - op.start_time
+                self._rtt_sum += rtt
+                self._rtt_max = max(self._rtt_max, rtt)
+            else:
+                self._stats['failures'] += 1
+        self._window.release()
+        if error is None:
+            op.future.set_result(response)
+        else:
+            op.future.set_exception(error)
+        return True
+
+    def start_remote_endpoint_operation(self, endpoint_id, input, output_length):
+        """
+        Sends an endpoint operation that expects an ACK without waiting for the
+        ACK. Returns a concurrent.futures.Future that completes with the
+        response or fails with ObjectLostError.
+
+        Up to window_size operations can be pending at the same time. If the
+        window is full, this function blocks until an operation completes.
+        The responses are matched to the operations by sequence number, so
+        they may arrive in any order.
+        """
+        self._window.acquire()
+        try:
+            with self._pending_changed:
+                seq_no = self._next_seq_no()
+                op = _PendingOperation(self._make_packet(seq_no, endpoint_id | 0x8000, input, output_length),
+                                       time.monotonic() + self._resend_timeout)
+                self._pending[seq_no] = op
+                self._stats['requests'] += 1
+        except:
+            self._window.release()
+            raise
+
+        if self._channel_broken.is_set():
+            self._complete(seq_no, error=ObjectLostError())
+        else:
+            self._send(op)
+        return op.future
 
+    def remote_endpoint_operation(self, endpoint_id, input, expect_ack, output_length):
         if (expect_ack):
-            ack_event = Event()
-            self._expected_acks[seq_no] = ack_event
-            try:
-                attempt = 0
-                while (attempt < self._send_attempts):
-                    self._my_lock.acquire()
-                    try:
-                        self._output.process_packet(packet)
-                    except ChannelDamagedException:
-                        attempt += 1
-                        continue # resend
-                    except TimeoutError:
-                        attempt += 1
-                        continue # resend
-                    finally:
-                        self._my_lock.release()
-                    # Wait for ACK until the resend timeout is exceeded
-                    try:
-                        if wait_any(self._resend_timeout, ack_event, self._channel_broken) != 0:
-                            raise ObjectLostError()
-                    except TimeoutError:
-                        attempt += 1
-                        continue # resend
-                    return self._responses.pop(seq_no)
-                    # TODO: record channel statistics
-                raise ObjectLostError() # Too many resend attempts
-            finally:
-                self._expected_acks.pop(seq_no)
-                self._responses.pop(seq_no, None)
+            return self.start_remote_endpoint_operation(endpoint_id, input, output_length).result()
         else:
             # fire and forget
-            self._output.process_packet(packet)
+            with self._pending_changed:
+                seq_no = self._next_seq_no()
+            packet = self._make_packet(seq_no, endpoint_id, input, output_length)
+            with self._my_lock:
+                self._output.process_packet(packet)
             return None
     
     def remote_endpoint_read_buffer(self, endpoint_id):
         """
         Handles reads from long endpoints
+
+        The first chunk shows how many bytes the device returns per request.
+        The following chunks are then requested in parallel (up to the window
+        size) at the offsets where they are expected to start. A chunk that is
+        shorter than that discards the speculative requests after it.
         """
         # TODO: handle device that could (maliciously) send infinite stream
-        buffer = bytes()
+        buffer = bytearray()
+        chunk_length = None # bytes per response as reported by the device
+        requests = deque() # (offset, future) tuples in order of offset
         while True:
-            chunk_length = 512
-            chunk = self.remote_endpoint_operation(endpoint_id, struct.pack("<I", len(buffer)), True, chunk_length)
+            if chunk_length is None:
+                if not requests:
+                    requests.append((len(buffer), self.start_remote_endpoint_operation(endpoint_id, struct.pack("<I", len(buffer)), max(512, self._max_packet_size))))
+            else:
+                offset = requests[-1][0] + chunk_length if requests else len(buffer)
+                while len(requests) < self._window_size:
+                    requests.append((offset, self.start_remote_endpoint_operation(endpoint_id, struct.pack("<I", offset), chunk_length)))
+                    offset += chunk_length
+
+            offset, future = requests.popleft()
+            chunk = future.result()
             if (len(chunk) == 0):
                 break
             buffer += chunk
-        return buffer
+            if chunk_length is None:
+                chunk_length = len(chunk)
+            elif len(chunk) < chunk_length:
+                requests.clear()
+                chunk_length = None
+        return bytes(buffer)
 
     def process_packet(self, packet):
         #print("process packet")
@@ -344,16 +562,38 @@ class Channel(PacketSink):
 
         if (seq_no & 0x8000):
             seq_no &= 0x7fff
-            ack_signal = self._expected_acks.get(seq_no, None)
-            if (ack_signal):
-                self._responses[seq_no] = packet[2:]
-                ack_signal.set()
-                #print("received ack for packet " + str(seq_no))
-            else:
-                print("received unexpected ACK: " + str(seq_no))
+            if not self._complete(seq_no, response=packet[2:]):
+                # Can be the ACK of a packet that was resent
+                self._logger.debug("received unexpected ACK: " + str(seq_no))
+                with self._pending_changed:
+                    self._stats['unexpected_acks'] += 1
 
         else:
             #if (calc_crc16(CRC16_INIT, struct.pack('<HBB', PROTOCOL_VERSION, packet[-2], packet[-1]))):
             #     raise Exception("CRC16 mismatch")
             print("endpoint requested")
             # TODO: handle local endpoint operation
+
+
+def load_interface_definition(channel):
+    """
+    Returns the JSON interface definition of the device behind channel (as
+    bytes) and configures the channel to use the corresponding interface CRC
+    for subsequent endpoint operations.
+
+    This is only used by the Python protocol stack. odrivetool and the GUI
+    connect through libfibre, which loads the interface inside the native
+    library.
+    """
+    # The special offset 0xffffffff returns the JSON version ID. The upper 16
+    # bits of the version ID are the CRC of the JSON.
+    response = channel.remote_endpoint_operation(0, struct.pack('<I', 0xffffffff), True, 4)
+    version_id, = struct.unpack('<I', response)
+    json_crc = version_id >> 16
+
+    json_bytes = channel.remote_endpoint_read_buffer(0)
+    if calc_crc16(PROTOCOL_VERSION, json_bytes) != json_crc:
+        raise DeviceInitException("interface definition does not match its CRC")
+
+    channel._interface_definition_crc = json_crc
+    return json_bytes
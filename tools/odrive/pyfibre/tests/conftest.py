@@ -0,0 +1,45 @@
+import itertools
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+import fake_libfibre
+
+# Must happen before the test modules import fibre
+_fake_lib = fake_libfibre.install()
+_domain_ids = itertools.count()
+
+@pytest.fixture
+def fake_lib():
+    return _fake_lib
+
+@pytest.fixture
+def open_device():
+    """
+    Returns a function open_device(properties, lazy=False, prefetch=False)
+    which connects a fake_libfibre.FakeDevice with the specified properties,
+    discovers it on a new fibre Domain and returns (FakeDevice, RemoteObject).
+    The domains are closed and the devices disconnected when the test ends.
+    """
+    import fibre.libfibre
+    opened = []
+
+    def open_device(properties, lazy=False, prefetch=False):
+        path = "fake:{}".format(next(_domain_ids))
+        device = fake_libfibre.FakeDevice(properties)
+        _fake_lib.connect(device, path)
+        domain = fibre.libfibre.Domain(path, lazy=lazy, prefetch=prefetch)
+        opened.append((device, domain))
+        return device, domain.__enter__().discover_one()
+
+    yield open_device
+
+    for device, domain in reversed(opened):
+        for path in list(device._stalled_paths):
+            device.release(path)
+        domain.__exit__(None, None, None)
+        _fake_lib.disconnect(device)
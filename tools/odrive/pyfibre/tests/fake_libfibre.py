@@ -0,0 +1,401 @@
+"""
+Fake of the libfibre shared library for testing fibre/libfibre.py without a
+device. install() loads fibre.libfibre against the fake instead of the native
+library.
+
+The fake serves devices whose object trees are described with nested dicts,
+similar to fibre.loopback.SimulatedDevice:
+
+    device = FakeDevice({
+        'vbus_voltage': ('float', 24.0, 'r'),
+        'axis0': {'pos_setpoint': ('float', 0.0)},
+        'endpoint': ('object_ref', 'axis0'),
+        'get_adc_voltage': function([('gpio', 'uint32')], [('voltage', 'float')], lambda gpio: gpio / 10),
+    })
+    lib.connect(device, 'usb')
+
+Calls complete asynchronously on the event loop of the Fibre thread, like the
+calls of the native library. The calls to a property can be stalled (held
+back) with FakeDevice.stall() to simulate a device that stops responding.
+"""
+
+import asyncio
+import itertools
+import os
+import struct
+import sys
+import threading
+from ctypes import (addressof, c_char_p, c_void_p, cast, create_string_buffer,
+                    memmove, string_at)
+from unittest import mock
+
+kFibreOk = 0
+kFibreBusy = 1
+kFibreClosed = 3
+
+# struct formats of the codecs on the wire (see ArgListCodec in libfibre.py)
+formats = {
+    'bool': '?',
+    'int8': 'b', 'uint8': 'B',
+    'int16': 'h', 'uint16': 'H',
+    'int32': 'i', 'uint32': 'I',
+    'int64': 'q', 'uint64': 'Q',
+    'float': 'f',
+    'object_ref': 'Q',
+}
+
+_handles = itertools.count(0x1000)
+
+class function():
+    """Describes a function of a FakeDevice"""
+    def __init__(self, inputs, outputs, impl):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.impl = impl
+
+class _Function():
+    def __init__(self, name, inputs, outputs, impl):
+        self.handle = next(_handles)
+        self.name = name
+        self.inputs = [('obj', 'object_ref')] + list(inputs)
+        self.outputs = list(outputs)
+        self.impl = impl # impl(obj, *args) -> tuple of outputs
+        self.input_struct = struct.Struct('<' + ''.join(formats[codec] for _, codec in self.inputs))
+        self.output_struct = struct.Struct('<' + ''.join(formats[codec] for _, codec in self.outputs))
+
+class _Attribute():
+    def __init__(self, name, intf):
+        self.handle = next(_handles)
+        self.name = name
+        self.intf = intf
+
+class _Interface():
+    def __init__(self, name=None):
+        self.handle = next(_handles)
+        self.name = name
+        self.attributes = []
+        self.functions = []
+
+class _Object():
+    def __init__(self, device, path, intf):
+        self.handle = next(_handles)
+        self.device = device
+        self.path = path
+        self.intf = intf
+        self.children = {} # key: attribute handle, value: _Object
+
+_property_interfaces = {} # key: (codec, access), value: _Interface
+
+def _get_property_interface(codec, access):
+    intf = _property_interfaces.get((codec, access), None)
+    if intf is None:
+        intf = _Interface("fibre.Property<{} {}>".format('readwrite' if 'w' in access else 'readonly', codec))
+        intf.functions.append(_Function('read', [], [('value', codec)],
+            lambda obj: (obj.device._read(obj.path),)))
+        if 'w' in access:
+            intf.functions.append(_Function('exchange', [('newval', codec)], [('oldval', codec)],
+                lambda obj, value: (obj.device._exchange(obj.path, value),)))
+        _property_interfaces[(codec, access)] = intf
+    return intf
+
+class FakeDevice():
+    """
+    properties: A nested dict that maps names to a dict (a sub-object), a
+                function or a tuple (codec, initial value[, access]) where
+                access is 'r' or 'rw' (default). The value of an object_ref
+                property is the dotted path of the target object.
+    """
+
+    def __init__(self, properties):
+        self._lock = threading.Lock()
+        self._values = {} # key: dotted path, value: property value
+        self._objects = {} # key: dotted path ('' for the root), value: _Object
+        self._stalled_paths = set()
+        self._stalled_calls = [] # (path, complete) tuples
+        self.path = None # set by FakeLibFibre.connect()
+        self.calls = [] # (path, function name, args) tuples in order of arrival
+        self.root = self._add_object('', properties)
+
+    def _add_object(self, path, members):
+        intf = _Interface()
+        obj = self._objects[path] = _Object(self, path, intf)
+        prefix = path + '.' if path else ''
+        for name, member in members.items():
+            if isinstance(member, dict):
+                child = self._add_object(prefix + name, member)
+                attr = _Attribute(name, child.intf)
+                obj.children[attr.handle] = child
+                intf.attributes.append(attr)
+            elif isinstance(member, function):
+                intf.functions.append(_Function(name, member.inputs, member.outputs,
+                    lambda obj, *args, impl=member.impl: _as_tuple(impl(*args))))
+            else:
+                codec, value, access = (tuple(member) + ('rw',))[:3]
+                child = _Object(self, prefix + name, _get_property_interface(codec, access))
+                self._objects[child.path] = child
+                self._values[child.path] = value
+                attr = _Attribute(name, child.intf)
+                obj.children[attr.handle] = child
+                intf.attributes.append(attr)
+        return obj
+
+    def get(self, path):
+        with self._lock:
+            return self._values[path]
+
+    def set(self, path, value):
+        with self._lock:
+            self._values[path] = value
+
+    def get_object_handle(self, path):
+        return self._objects[path].handle
+
+    def _encode(self, value):
+        if isinstance(value, str):
+            return self._objects[value].handle # object_ref
+        return value
+
+    def _read(self, path):
+        with self._lock:
+            return self._encode(self._values[path])
+
+    def _exchange(self, path, value):
+        with self._lock:
+            old_value = self._encode(self._values[path])
+            self._values[path] = value
+            return old_value
+
+    def stall(self, path):
+        """Holds back the calls to the property at path until release()"""
+        with self._lock:
+            self._stalled_paths.add(path)
+
+    def release(self, path):
+        """Completes the held back calls to path and stops stalling it"""
+        with self._lock:
+            self._stalled_paths.discard(path)
+            calls = [complete for p, complete in self._stalled_calls if p == path]
+            self._stalled_calls = [(p, c) for p, c in self._stalled_calls if p != path]
+        for complete in calls:
+            complete()
+
+    def n_stalled(self, path):
+        with self._lock:
+            return len([p for p, _ in self._stalled_calls if p == path])
+
+def _as_tuple(result):
+    if result is None:
+        return ()
+    return result if isinstance(result, tuple) else (result,)
+
+def _value(handle):
+    # The fake functions don't have argtypes so handles can arrive as c_void_p
+    return handle.value if isinstance(handle, c_void_p) else handle
+
+class _Version():
+    major = 0
+    minor = 1
+    patch = 0
+
+class _VersionPtr():
+    contents = _Version()
+
+class FakeLibFibre():
+    """
+    Implements the libfibre_* functions that fibre/libfibre.py uses. All of
+    them are called on the Fibre thread.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self._thread = None # the Fibre thread
+        self._lock = threading.Lock()
+        self._devices = []
+        self._announced = {} # key: FakeDevice, value: (on_lost, ctx) of the discovery that found it
+        self._domains = {} # key: domain handle, value: path
+        self._discoveries = {} # key: discovery handle, value: (domain handle, on_found, on_lost, ctx)
+        self._objects = {} # key: handle, value: _Object of a connected device
+        self._functions = {} # key: handle, value: (_Function, _Object) of the interface
+        self._interfaces = {} # key: handle, value: _Interface
+        self._buffers = [] # strings that were passed to libfibre.py
+        self.n_calls = 0
+        for name in dir(self):
+            if name.startswith('libfibre_'):
+                # libfibre.py assigns argtypes and restype, which bound methods
+                # don't support
+                method = getattr(self, name)
+                setattr(self, name, lambda *args, method=method: method(*args))
+
+    # Device management (thread-safe)
+
+    def connect(self, device, path):
+        """Makes the device discoverable on domains that were opened with path"""
+        device.path = path
+        self._run_on_loop(lambda: self._connect(device))
+
+    def disconnect(self, device):
+        """Reports the device as lost"""
+        self._run_on_loop(lambda: self._disconnect(device))
+
+    def _run_on_loop(self, func):
+        with self._lock:
+            loop = self.loop
+            if loop is None or threading.current_thread() == self._thread:
+                func()
+                return
+        loop.call_soon_threadsafe(func)
+
+    def _connect(self, device):
+        self._devices.append(device)
+        for obj in device._objects.values():
+            self._objects[obj.handle] = obj
+        for domain, on_found, on_lost, ctx in list(self._discoveries.values()):
+            if self._domains[domain] == device.path:
+                self._announce(device, on_found, on_lost, ctx)
+
+    def _disconnect(self, device):
+        if not device in self._devices:
+            return # already disconnected
+        self._devices.remove(device)
+        # libfibre reports the loss even if the discovery that found the device
+        # was stopped in the meantime
+        on_lost, ctx = self._announced.pop(device, (None, None))
+        if not on_lost is None and not self.loop is None:
+            on_lost(ctx, device.root.handle)
+
+    def _announce(self, device, on_found, on_lost, ctx):
+        self._register_interface(device.root.intf)
+        self._announced[device] = (on_lost, ctx)
+        self.loop.call_soon(on_found, ctx, device.root.handle, device.root.intf.handle)
+
+    def _register_interface(self, intf):
+        self._interfaces[intf.handle] = intf
+        for attr in intf.attributes:
+            self._register_interface(attr.intf)
+
+    def _c_string(self, value):
+        buf = create_string_buffer(value.encode('utf-8'))
+        self._buffers.append(buf)
+        return addressof(buf), len(value)
+
+    def _c_string_array(self, strings):
+        array = (c_char_p * (len(strings) + 1))(*[s.encode('utf-8') for s in strings], None)
+        self._buffers.append(array)
+        return array
+
+    # libfibre API
+
+    def libfibre_get_version(self):
+        return _VersionPtr()
+
+    def libfibre_open(self, event_loop):
+        with self._lock:
+            self.loop = asyncio.get_event_loop()
+            self._thread = threading.current_thread()
+        return 1
+
+    def libfibre_close(self, ctx):
+        with self._lock:
+            self.loop = None
+            self._thread = None
+        self._discoveries.clear()
+        self._announced.clear()
+
+    def libfibre_open_domain(self, ctx, path, path_length):
+        handle = next(_handles)
+        self._domains[handle] = path[:path_length].decode('ascii')
+        return handle
+
+    def libfibre_close_domain(self, domain):
+        self._domains.pop(_value(domain))
+
+    def libfibre_start_discovery(self, domain, handle_ref, on_found, on_lost, on_stopped, ctx):
+        handle = next(_handles)
+        handle_ref._obj.value = handle
+        self._discoveries[handle] = (domain, on_found, on_lost, ctx)
+        for device in self._devices:
+            if self._domains[domain] == device.path:
+                self._announce(device, on_found, on_lost, ctx)
+
+    def libfibre_stop_discovery(self, handle):
+        self._discoveries.pop(_value(handle), None)
+
+    def libfibre_subscribe_to_interface(self, intf_handle, on_attribute_added, on_attribute_removed, on_function_added, on_function_removed, ctx):
+        intf = self._interfaces[intf_handle]
+        for attr in intf.attributes:
+            self._register_interface(attr.intf)
+            name, name_length = self._c_string(attr.name)
+            if attr.intf.name is None:
+                intf_name, intf_name_length = None, 0
+            else:
+                intf_name, intf_name_length = self._c_string(attr.intf.name)
+            on_attribute_added(ctx, attr.handle, name, name_length, attr.intf.handle, intf_name, intf_name_length)
+        for func in intf.functions:
+            name, name_length = self._c_string(func.name)
+            on_function_added(ctx, func.handle, name, name_length,
+                self._c_string_array([n for n, _ in func.inputs]), self._c_string_array([c for _, c in func.inputs]),
+                self._c_string_array([n for n, _ in func.outputs]), self._c_string_array([c for _, c in func.outputs]))
+            self._functions[func.handle] = func
+
+    def libfibre_get_attribute(self, obj_handle, attr_handle, obj_handle_ref):
+        obj = self._objects[obj_handle]
+        obj_handle_ref._obj.value = obj.children[attr_handle].handle
+        return kFibreOk
+
+    def libfibre_call(self, func_handle, call_handle_ref, status, tx_buf, tx_len, rx_buf, rx_len, tx_end_ref, rx_end_ref, on_completed, ctx):
+        self.n_calls += 1
+        func = self._functions[func_handle]
+        tx_start = cast(tx_buf, c_void_p).value or 0
+        args = func.input_struct.unpack(string_at(tx_start, tx_len))
+        obj = self._objects.get(args[0], None)
+        call_handle_ref._obj.value = next(_handles)
+
+        def complete():
+            if obj is None or not obj.device in self._devices:
+                on_completed(ctx, kFibreClosed, tx_start, rx_buf, None, None, None, None)
+                return
+            outputs = func.impl(obj, *args[1:])
+            rx_data = func.output_struct.pack(*outputs)
+            assert len(rx_data) <= rx_len
+            memmove(rx_buf, rx_data, len(rx_data))
+            on_completed(ctx, kFibreClosed, tx_start + tx_len, rx_buf + len(rx_data), None, None, None, None)
+
+        if not obj is None:
+            device = obj.device
+            device.calls.append((obj.path, func.name, args[1:]))
+            with device._lock:
+                if obj.path in device._stalled_paths:
+                    device._stalled_calls.append((obj.path, lambda: self.loop.call_soon_threadsafe(complete)))
+                    return kFibreBusy
+        self.loop.call_soon(complete)
+        return kFibreBusy
+
+    def libfibre_start_tx(self, *args):
+        raise NotImplementedError()
+
+    def libfibre_cancel_tx(self, *args):
+        raise NotImplementedError()
+
+    def libfibre_start_rx(self, *args):
+        raise NotImplementedError()
+
+    def libfibre_cancel_rx(self, *args):
+        raise NotImplementedError()
+
+def install():
+    """
+    Imports fibre.libfibre with a FakeLibFibre in place of the native library
+    and returns the FakeLibFibre. Must be called before fibre is imported.
+    """
+    assert not 'fibre' in sys.modules, "fibre was imported before the fake libfibre was installed"
+    lib = FakeLibFibre()
+    real_isfile = os.path.isfile
+    real_getsize = os.path.getsize
+    is_fake = lambda path: os.path.basename(str(path)).startswith('libfibre-')
+    with mock.patch('platform.system', return_value='Linux'), \
+         mock.patch('platform.machine', return_value='x86_64'), \
+         mock.patch('os.path.isfile', lambda path: is_fake(path) or real_isfile(path)), \
+         mock.patch('os.path.getsize', lambda path: 1000000 if is_fake(path) else real_getsize(path)), \
+         mock.patch('ctypes.cdll.LoadLibrary', return_value=lib):
+        import fibre.libfibre
+    return lib
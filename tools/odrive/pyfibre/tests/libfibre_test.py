@@ -0,0 +1,276 @@
+"""
+Tests for the Python side of libfibre (fibre/libfibre.py). The native library
+is replaced by fake_libfibre (see conftest.py) so no device is needed.
+"""
+
+import asyncio
+import time
+
+import pytest
+
+import fibre
+from fibre import libfibre
+from fake_libfibre import function
+
+
+DEVICE = {
+    'vbus_voltage': ('float', 24.0, 'r'),
+    'serial_number': ('uint64', 2**60 + 1, 'r'),
+    'axis0': {
+        'pos_setpoint': ('float', 0.0),
+        'error': ('uint32', 0),
+        'encoder': {'pos_estimate': ('float', 1.5, 'r')},
+    },
+    'axis1': {
+        'pos_setpoint': ('float', 0.0),
+    },
+    'endpoint': ('object_ref', 'axis1.pos_setpoint'),
+    'clear_errors': function([], [], lambda: None),
+    'add': function([('a', 'uint32'), ('b', 'float')], [('sum', 'float'), ('flag', 'bool')],
+                    lambda a, b: (a + b, a > b)),
+}
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met within {}s".format(timeout)
+        time.sleep(0.005)
+
+def on_fibre_thread(obj, func):
+    """Runs func on the Fibre thread and returns its (awaited) result"""
+    return libfibre.run_coroutine_threadsafe(obj._libfibre.loop, func)
+
+def start_on_fibre_thread(obj, start_call):
+    """Starts a call on the Fibre thread and returns a concurrent.futures.Future"""
+    async def run():
+        return await start_call()
+    return asyncio.run_coroutine_threadsafe(run(), obj._libfibre.loop)
+
+
+def test_arg_list_codec():
+    codec = libfibre.ArgListCodec([libfibre.codecs[name] for name in ('uint8', 'float', 'uint64', 'bool')])
+    assert codec.get_length() == 1 + 4 + 8 + 1
+    data = codec.serialize(None, [7, 1.5, 2**64 - 1, True])
+    assert len(data) == codec.get_length()
+    assert codec.deserialize(None, data) == [7, 1.5, 2**64 - 1, True]
+
+def test_arg_list_codec_object_ref():
+    codec = libfibre.ArgListCodec([libfibre.codecs['object_ref']])
+    assert codec.deserialize(None, codec.serialize(None, [None])) == [None]
+    with pytest.raises(TypeError):
+        codec.serialize(None, [5])
+
+def test_property_access(open_device):
+    device, odrv = open_device(DEVICE)
+    assert odrv.vbus_voltage == 24.0
+    assert odrv.serial_number == 2**60 + 1
+    odrv.axis0.pos_setpoint = 3.0
+    assert device.get('axis0.pos_setpoint') == 3.0
+    with pytest.raises(Exception):
+        odrv.vbus_voltage = 12.0
+
+def test_function_call(open_device):
+    device, odrv = open_device(DEVICE)
+    assert odrv.add(3, 0.5) == (3.5, True)
+    assert odrv.clear_errors() is None
+    assert device.calls[-1] == ('', 'clear_errors', ())
+
+def test_rx_buffers_are_recycled(open_device):
+    device, odrv = open_device(DEVICE)
+    read = odrv.axis0.encoder._pos_estimate_property.__class__.read
+    read._rx_buf_pool.clear()
+    for _ in range(3):
+        odrv.axis0.encoder.pos_estimate
+    assert len(read._rx_buf_pool) == 1
+    buf = read._rx_buf_pool[0]
+    odrv.axis0.encoder.pos_estimate
+    assert read._rx_buf_pool == [buf]
+
+def test_rx_buffer_pool_grows_with_concurrent_calls(open_device):
+    device, odrv = open_device(DEVICE)
+    # All readwrite float properties share one read() function
+    read = odrv.axis0._pos_setpoint_property.__class__.read
+    read._rx_buf_pool.clear()
+    for path in ('axis0.pos_setpoint', 'axis1.pos_setpoint'):
+        device.stall(path)
+    future = start_on_fibre_thread(odrv, lambda: odrv._read_many(['axis0.pos_setpoint', 'axis1.pos_setpoint']))
+    wait_until(lambda: device.n_stalled('axis1.pos_setpoint') == 1)
+    device.set('axis1.pos_setpoint', 2.0)
+    for path in ('axis0.pos_setpoint', 'axis1.pos_setpoint'):
+        device.release(path)
+    wait_until(future.done)
+    assert future.result() == (0.0, 2.0)
+    assert len(read._rx_buf_pool) == 2
+
+def test_read_many(open_device):
+    device, odrv = open_device(DEVICE)
+    prop = odrv._resolve_path('axis0.encoder.pos_estimate')
+    assert fibre.read_many(odrv, ['vbus_voltage', prop, 'axis0.error']) == (24.0, 1.5, 0)
+    with pytest.raises(AttributeError):
+        fibre.read_many(odrv, ['axis0'])
+
+def test_read_many_with_timeout_reports_errors_per_path(open_device):
+    device, odrv = open_device(DEVICE)
+    values = fibre.read_many(odrv, ['vbus_voltage', 'axis0.nonexistent'], timeout=1.0)
+    assert values[0] == 24.0
+    assert isinstance(values[1], AttributeError)
+
+def test_read_many_doesnt_pile_up_reads_on_a_stalled_device(open_device):
+    device, odrv = open_device(DEVICE)
+    device.stall('axis0.encoder.pos_estimate')
+    prop = odrv._resolve_path('axis0.encoder.pos_estimate')
+    for _ in range(5): # e.g. a 100Hz sampler
+        values = fibre.read_many(odrv, ['vbus_voltage', prop], timeout=0.01)
+        assert values[0] == 24.0
+        assert isinstance(values[1], TimeoutError)
+    assert device.n_stalled('axis0.encoder.pos_estimate') == 1
+    assert "still pending" in str(values[1])
+
+    device.release('axis0.encoder.pos_estimate')
+    wait_until(lambda: len(odrv._libfibre._timed_out_calls) == 0)
+    assert fibre.read_many(odrv, ['axis0.encoder.pos_estimate'], timeout=1.0) == (1.5,)
+
+def test_call_all(open_device):
+    device0, odrv0 = open_device(DEVICE)
+    device1, odrv1 = open_device(DEVICE)
+    device1.set('vbus_voltage', 12.0)
+    assert fibre.call_all([odrv0, odrv1], 'vbus_voltage') == [24.0, 12.0]
+    assert fibre.call_all([odrv0, odrv1], 'add', 1, 2.0, timeout=1.0) == [(3.0, False), (3.0, False)]
+    result = fibre.call_all([odrv0, odrv1], 'axis0.nonexistent', timeout=1.0)
+    assert all(isinstance(r, AttributeError) for r in result)
+
+def test_call_all_doesnt_pile_up_calls_on_a_stalled_device(open_device):
+    device0, odrv0 = open_device(DEVICE)
+    device1, odrv1 = open_device(DEVICE)
+    device1.stall('vbus_voltage')
+    for _ in range(5):
+        result = fibre.call_all([odrv0, odrv1], 'vbus_voltage', timeout=0.01)
+        assert result[0] == 24.0
+        assert isinstance(result[1], TimeoutError)
+    assert device1.n_stalled('vbus_voltage') == 1
+
+def test_call_all_without_domain():
+    assert libfibre.libfibre is None
+    with pytest.raises(Exception, match="needs an open Domain"):
+        fibre.call_all([], 'vbus_voltage')
+
+def test_write_nowait_coalesces_writes(open_device):
+    device, odrv = open_device(DEVICE)
+    device.stall('axis0.pos_setpoint')
+    for value in (1.0, 2.0, 3.0):
+        fibre.write_nowait(odrv, 'axis0.pos_setpoint', value)
+    wait_until(lambda: device.n_stalled('axis0.pos_setpoint') == 1)
+    device.release('axis0.pos_setpoint')
+    wait_until(lambda: device.get('axis0.pos_setpoint') == 3.0)
+    exchanges = [args for path, name, args in device.calls if name == 'exchange']
+    assert exchanges == [(1.0,), (3.0,)] # 2.0 was replaced by 3.0 while 1.0 was in flight
+
+def test_write_nowait_without_coalescing_sends_every_value(open_device):
+    device, odrv = open_device(DEVICE)
+    for value in (1.0, 2.0, 3.0):
+        fibre.write_nowait(odrv, 'axis0.pos_setpoint', value, coalesce=False)
+    wait_until(lambda: len([c for c in device.calls if c[1] == 'exchange']) == 3)
+    with pytest.raises(AttributeError):
+        fibre.write_nowait(odrv, 'vbus_voltage', 12.0)
+
+def test_subscription(open_device):
+    np = pytest.importorskip('numpy')
+    device, odrv = open_device(DEVICE)
+    sub = fibre.subscribe(odrv, ['vbus_voltage', 'axis0.encoder.pos_estimate'], rate=200, capacity=5)
+    time.sleep(0.1)
+    sub.stop()
+    wait_until(sub._task.done)
+    data = sub.drain()
+    assert sub.error is None
+    assert data.shape == (5,)
+    assert np.all(np.diff(data['time']) > 0)
+    assert np.all(data['vbus_voltage'] == 24.0)
+    assert np.all(data['axis0.encoder.pos_estimate'] == 1.5)
+    assert sub.n_dropped > 0
+    assert len(sub.drain()) == 0
+
+def test_subscription_keeps_integer_precision(open_device):
+    np = pytest.importorskip('numpy')
+    device, odrv = open_device(DEVICE)
+    sub = fibre.subscribe(odrv, ['serial_number', 'axis0.error'], rate=100)
+    wait_until(lambda: sub._n_written > 0)
+    sub.stop()
+    data = sub.drain()
+    assert data.dtype['serial_number'] == np.uint64
+    assert data.dtype['axis0.error'] == np.uint32
+    assert int(data['serial_number'][0]) == 2**60 + 1
+
+def test_subscription_ends_when_object_is_lost(open_device, fake_lib):
+    pytest.importorskip('numpy')
+    device, odrv = open_device(DEVICE)
+    sub = fibre.subscribe(odrv, ['vbus_voltage'], rate=100)
+    fake_lib.disconnect(device)
+    wait_until(sub._task.done)
+    assert not sub.error is None
+    sub.stop() # must not fail after the object was lost
+
+def test_call_stats(open_device):
+    device, odrv = open_device(DEVICE)
+    fibre.enable_stats()
+    try:
+        for _ in range(3):
+            odrv.vbus_voltage
+        odrv.axis0.pos_setpoint = 1.0
+        stats = fibre.stats()
+    finally:
+        fibre.disable_stats()
+    read = stats['endpoints']['vbus_voltage.read']
+    assert read['count'] == 3
+    assert read['errors'] == 0
+    assert read['bytes_rx'] == 3 * 4
+    assert read['p50'] <= read['max']
+    assert stats['endpoints']['axis0.pos_setpoint.exchange']['count'] == 1
+    assert fibre.stats() is None
+
+def test_eager_loading(open_device):
+    device, odrv = open_device(DEVICE)
+    assert not odrv._children is None
+    assert not odrv.axis0._children is None
+
+def test_lazy_loading(open_device):
+    device, odrv = open_device(DEVICE, lazy=True)
+    assert odrv._children is None
+    assert odrv.axis0.encoder.pos_estimate == 1.5
+    assert odrv.axis0._children is not None
+    assert odrv.axis1._children is None
+
+def test_prefetch(open_device):
+    device, odrv = open_device(DEVICE, lazy=True, prefetch=True)
+    wait_until(lambda: not odrv._children is None and len(odrv._children) == len(odrv._attribute_cache) == 5)
+
+def test_object_ref_resolves_unloaded_object(open_device):
+    device, odrv = open_device(DEVICE, lazy=True)
+    assert odrv.endpoint is odrv.axis1._pos_setpoint_property
+    with pytest.raises(fibre.ObjectLostError):
+        on_fibre_thread(odrv, lambda: odrv._libfibre._find_py_obj(12345))
+
+def test_remote_objects_have_slots(open_device):
+    device, odrv = open_device(DEVICE)
+    assert not hasattr(odrv, '__dict__')
+    with pytest.raises(AttributeError):
+        odrv.axis0.pos_stepoint = 1.0 # typo
+    assert not any(name == 'exchange' for _, name, _ in device.calls)
+
+def test_lost_object(open_device, fake_lib):
+    device, odrv = open_device(DEVICE)
+    axis0 = odrv.axis0
+    on_lost = odrv._on_lost
+    fake_lib.disconnect(device)
+    assert on_lost.result(timeout=2.0)
+    assert str(axis0) == "[lost object]"
+    with pytest.raises(AttributeError):
+        axis0.pos_setpoint
+
+def test_snapshot(open_device):
+    device, odrv = open_device(DEVICE)
+    snapshot = fibre.snapshot(odrv)
+    assert snapshot['vbus_voltage'] == 24.0
+    assert snapshot['axis0'] == {'pos_setpoint': 0.0, 'error': 0, 'encoder': {'pos_estimate': 1.5}}
+    assert snapshot['endpoint'] is odrv.axis1._pos_setpoint_property
+    assert fibre.snapshot(odrv, depth=1).keys() == {'vbus_voltage', 'serial_number', 'endpoint'}
+    assert fibre.snapshot(odrv.axis0.encoder) == {'pos_estimate': 1.5}
@@ -0,0 +1,243 @@
+"""
+Tests for the Python implementation of the Fibre protocol (fibre/protocol.py).
+They use the in-memory transport in fibre/loopback.py so no device is needed.
+"""
+
+import struct
+import threading
+import time
+
+import pytest
+
+from fibre import channel_manager, loopback, protocol
+from fibre.utils import Event, Logger
+
+
+class PacketCollector(protocol.PacketSink):
+    def __init__(self):
+        self.packets = []
+    def process_packet(self, packet):
+        self.packets.append(bytes(packet))
+
+class StreamCollector(protocol.StreamSink):
+    def __init__(self):
+        self.data = bytearray()
+    def process_bytes(self, bytes):
+        self.data += bytes
+
+class LossyPacketSink(protocol.PacketSink):
+    """Drops the packets whose (zero-based) index is in `dropped`"""
+    def __init__(self, output, dropped):
+        self._output = output
+        self._dropped = set(dropped)
+        self.n_packets = 0
+    def process_packet(self, packet):
+        index = self.n_packets
+        self.n_packets += 1
+        if not index in self._dropped:
+            self._output.process_packet(packet)
+
+def encode(payload, max_packet_size=protocol.MAX_PACKET_SIZE):
+    wire = StreamCollector()
+    protocol.StreamBasedPacketSink(wire, max_packet_size=max_packet_size).process_packet(payload)
+    return bytes(wire.data)
+
+def segment(data, chunk_size, max_packet_size=protocol.MAX_PACKET_SIZE):
+    collector = PacketCollector()
+    segmenter = protocol.StreamToPacketSegmenter(collector, max_packet_size=max_packet_size)
+    for i in range(0, len(data), chunk_size):
+        segmenter.process_bytes(data[i:i + chunk_size])
+    return collector.packets
+
+def convert(data, max_packet_size=protocol.MAX_PACKET_SIZE):
+    stream = loopback.LoopbackStream()
+    stream.process_bytes(data)
+    converter = protocol.PacketFromStreamConverter(stream, max_packet_size=max_packet_size)
+    packets = []
+    while True:
+        try:
+            packets.append(converter.get_packet(time.monotonic()))
+        except protocol.TimeoutError:
+            return packets
+
+
+# CRC --------------------------------------------------------------------------#
+
+@pytest.mark.parametrize('data', [b'', b'\x00', b'\xaa\x05', bytes(range(256))])
+@pytest.mark.parametrize('convert_input', [bytes, bytearray, memoryview, list])
+def test_crc_matches_bitwise_implementation(data, convert_input):
+    expected8, expected16 = protocol.CRC8_INIT, protocol.CRC16_INIT
+    for byte in data:
+        expected8 = protocol.calc_crc(expected8, byte, protocol.CRC8_DEFAULT, 8)
+        expected16 = protocol.calc_crc(expected16, byte, protocol.CRC16_DEFAULT, 16)
+    assert protocol.calc_crc8(protocol.CRC8_INIT, convert_input(data)) == expected8
+    assert protocol.calc_crc16(protocol.CRC16_INIT, convert_input(data)) == expected16
+
+
+# Segmentation ----------------------------------------------------------------#
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 1000])
+def test_segmenter_resyncs_after_bit_error(chunk_size):
+    first, second, third = b'first packet', bytes([protocol.SYNC_BYTE] * 20), b'third packet'
+    corrupted = bytearray(encode(second))
+    corrupted[5] ^= 0x10
+    data = encode(first) + bytes(corrupted) + encode(third)
+    assert segment(data, chunk_size) == [first, third]
+    assert convert(data) == [first, third]
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 1000])
+def test_segmenter_resyncs_after_truncated_packet(chunk_size):
+    # The header of the truncated packet announces more bytes than follow, so
+    # the next packets are first consumed as its payload and must be recovered
+    # once the CRC check fails.
+    truncated = encode(b'x' * 100)[:20]
+    intact = [b'after truncation', b'y' * 60, b'and one more']
+    data = truncated + b''.join(encode(packet) for packet in intact)
+    assert segment(data, chunk_size) == intact
+    assert convert(data) == intact
+
+@pytest.mark.parametrize('chunk_size', [1, 5, 1000])
+def test_segmenter_skips_garbage_with_sync_bytes(chunk_size):
+    garbage = bytes([protocol.SYNC_BYTE, 0x05, protocol.SYNC_BYTE, protocol.SYNC_BYTE, 0x00, 0x42])
+    packets = [b'', b'a', b'b' * 126]
+    data = garbage + garbage.join(encode(packet) for packet in packets) + garbage
+    assert segment(data, chunk_size) == packets
+    assert convert(data) == packets
+
+
+# Extended header --------------------------------------------------------------#
+
+def test_short_header_below_boundary():
+    payload = b'\x00' * (protocol.MAX_PACKET_SIZE - 1)
+    data = encode(payload, protocol.MAX_EXTENDED_PACKET_SIZE)
+    assert len(data) == 3 + len(payload) + 2
+    assert data[1] == protocol.MAX_PACKET_SIZE - 1
+    assert segment(data, 7) == [payload]
+
+def test_extended_header_at_boundary():
+    payload = bytes(range(protocol.MAX_PACKET_SIZE))
+    data = encode(payload, protocol.MAX_EXTENDED_PACKET_SIZE)
+    assert len(data) == 4 + len(payload) + 2
+    assert data[1] == 0x80 and data[2] == protocol.MAX_PACKET_SIZE
+    assert protocol.calc_crc8(protocol.CRC8_INIT, data[:4]) == 0
+    assert segment(data, 7, protocol.MAX_EXTENDED_PACKET_SIZE) == [payload]
+    assert convert(data, protocol.MAX_EXTENDED_PACKET_SIZE) == [payload]
+
+def test_extended_header_needs_opt_in():
+    payload = b'\x00' * protocol.MAX_PACKET_SIZE
+    with pytest.raises(NotImplementedError):
+        encode(payload)
+    # A receiver with the default packet size ignores extended packets
+    data = encode(payload, protocol.MAX_EXTENDED_PACKET_SIZE) + encode(b'short')
+    assert segment(data, 7) == [b'short']
+    assert convert(data) == [b'short']
+
+def test_extended_header_maximum_size():
+    payload = b'\x55' * (protocol.MAX_EXTENDED_PACKET_SIZE - 1)
+    data = encode(payload, protocol.MAX_EXTENDED_PACKET_SIZE)
+    assert data[1] == 0xff and data[2] == 0xff
+    assert segment(data, 1000, protocol.MAX_EXTENDED_PACKET_SIZE) == [payload]
+    with pytest.raises(NotImplementedError):
+        encode(payload + b'\x55', protocol.MAX_EXTENDED_PACKET_SIZE)
+    with pytest.raises(ValueError):
+        protocol.StreamToPacketSegmenter(PacketCollector(), max_packet_size=protocol.MAX_EXTENDED_PACKET_SIZE + 1)
+
+
+# Channel ----------------------------------------------------------------------#
+
+@pytest.fixture
+def cancellation_token():
+    token = Event()
+    yield token
+    token.set()
+
+def make_device():
+    return loopback.SimulatedDevice({
+        'vbus_voltage': ('float', 24.0, 'r'),
+        'axis0': {'controller': {'input_pos': ('float', 0.0)}},
+    })
+
+def connect_lossy(device, cancellation_token, dropped_requests=(), dropped_responses=(), **kwargs):
+    """
+    Connects a Channel to device like loopback.connect() but drops the
+    specified requests and responses.
+    """
+    to_device = loopback.LoopbackStream()
+    from_device = loopback.LoopbackStream()
+    responses = LossyPacketSink(protocol.StreamBasedPacketSink(from_device), dropped_responses)
+    device_input = protocol.PacketFromStreamConverter(to_device)
+
+    def serve():
+        while not cancellation_token.is_set():
+            try:
+                packet = device_input.get_packet(time.monotonic() + 0.1)
+            except protocol.TimeoutError:
+                continue
+            response = device.handle_request(packet)
+            if not response is None:
+                responses.process_packet(response)
+    threading.Thread(target=serve, daemon=True).start()
+
+    requests = LossyPacketSink(protocol.StreamBasedPacketSink(to_device), dropped_requests)
+    return protocol.Channel("lossy", protocol.PacketFromStreamConverter(from_device), requests,
+                            cancellation_token, Logger(verbose=False), **kwargs)
+
+def read_float(channel, device, path):
+    response = channel.remote_endpoint_operation(device.get_endpoint_id(path), None, True, 4)
+    return struct.unpack('<f', response)[0]
+
+def test_channel_resends_lost_request(cancellation_token):
+    device = make_device()
+    channel = connect_lossy(device, cancellation_token, dropped_requests=[1, 2], resend_timeout=0.05)
+    protocol.load_interface_definition(channel)
+    device.set_value('axis0.controller.input_pos', 1.5)
+    assert read_float(channel, device, 'axis0.controller.input_pos') == 1.5
+    stats = channel.get_stats()
+    assert stats['resends'] >= 2
+    assert stats['failures'] == 0
+    assert stats['in_flight'] == 0
+
+def test_channel_resends_after_lost_response(cancellation_token):
+    device = make_device()
+    channel = connect_lossy(device, cancellation_token, dropped_responses=[0], resend_timeout=0.05)
+    protocol.load_interface_definition(channel)
+    assert read_float(channel, device, 'vbus_voltage') == 24.0
+    assert channel.get_stats()['resends'] >= 1
+
+def test_channel_gives_up_after_send_attempts(cancellation_token):
+    device = make_device()
+    channel = connect_lossy(device, cancellation_token, dropped_requests=range(1000),
+                            resend_timeout=0.01, send_attempts=3)
+    future = channel.start_remote_endpoint_operation(0, struct.pack('<I', 0xffffffff), 4)
+    with pytest.raises(protocol.ObjectLostError):
+        future.result(timeout=5.0)
+    stats = channel.get_stats()
+    assert stats['resends'] == 2
+    assert stats['failures'] == 1
+
+def test_channels_share_the_resend_thread(cancellation_token):
+    # Each lossy channel has a receiver thread and a device thread. The resend
+    # timers of all of them run on the default ChannelManager.
+    n_threads = threading.active_count()
+    devices = [make_device() for _ in range(5)]
+    channels = [connect_lossy(device, cancellation_token, dropped_requests=[1], resend_timeout=0.05)
+                for device in devices]
+    assert threading.active_count() <= n_threads + 2 * len(channels) + 1
+    for channel, device in zip(channels, devices):
+        protocol.load_interface_definition(channel)
+        assert read_float(channel, device, 'vbus_voltage') == 24.0
+        assert channel.get_stats()['resends'] >= 1
+    cancellation_token.set()
+    assert not any(name == 'lossy' for name in channel_manager.get_default_manager().get_stats())
+
+@pytest.mark.parametrize('window_size', [1, 8])
+def test_channel_survives_bit_errors(cancellation_token, window_size):
+    device = loopback.SimulatedDevice({'property{}'.format(i): ('int32', i) for i in range(50)})
+    channel = loopback.connect(device, cancellation_token, Logger(verbose=False),
+                               bit_error_rate=2e-4, seed=0, window_size=window_size,
+                               resend_timeout=0.05, send_attempts=20)
+    assert protocol.load_interface_definition(channel) == device.json
+    for i in range(0, 50, 7):
+        response = channel.remote_endpoint_operation(device.get_endpoint_id('property{}'.format(i)), None, True, 4)
+        assert struct.unpack('<i', response)[0] == i
+    assert channel.to_device.n_bit_errors + channel.from_device.n_bit_errors > 0
@@ -0,0 +1,166 @@
+import asyncio
+import threading
+import time
+from fibre.utils import TimeoutError
+
+class DeviceRegistry():
+    """
+    Keeps track of the connected devices, indexed by serial number.
+
+    Devices are added and removed by the discovery thread (see
+    odrive.get_registry()). All public members of this class are thread-safe.
+    """
+
+    def __init__(self):
+        self._devices = {} # key: device, value: serial number string (in order of connection)
+        self._by_serial_number = {} # key: serial number string, value: device
+        self._condition = threading.Condition()
+        self._listeners = []
+        self._waiters = [] # list of (serial number, event loop, future)
+
+    def _add(self, device, serial_number):
+        """Called on the Fibre thread when a device was discovered."""
+        with self._condition:
+            self._devices[device] = serial_number
+            self._by_serial_number[serial_number] = device
+            waiters = [w for w in self._waiters if w[0] is None or w[0] == serial_number]
+            self._waiters = [w for w in self._waiters if not w in waiters]
+            listeners = list(self._listeners)
+            self._condition.notify_all()
+
+        for _, loop, future in waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(device))
+        for listener in listeners:
+            listener('connected', serial_number, device)
+
+    def _remove(self, device):
+        """Called on the Fibre thread when a device was lost."""
+        with self._condition:
+            serial_number = self._devices.pop(device, None)
+            if self._by_serial_number.get(serial_number, None) is device:
+                self._by_serial_number.pop(serial_number)
+            listeners = list(self._listeners)
+
+        for listener in listeners:
+            listener('lost', serial_number, device)
+
+    def get(self, serial_number):
+        """
+        Returns the connected device with the specified serial number (as
+        hex string, e.g. "205A3591304B") or None if there is none.
+        """
+        with self._condition:
+            return self._by_serial_number.get(serial_number, None)
+
+    def get_all(self):
+        """
+        Returns a list of (device, serial number) tuples of all connected
+        devices in the order in which they were connected.
+        """
+        with self._condition:
+            return list(self._devices.items())
+
+    def _wait(self, predicate, timeout, cancellation_token):
+        """
+        Waits until predicate() returns something other than None and returns
+        that. Returns None if the cancellation_token is set and raises
+        TimeoutError if the timeout expires.
+        """
+        cancelled = [False]
+
+        def cancel():
+            with self._condition:
+                cancelled[0] = True
+                self._condition.notify_all()
+
+        if cancellation_token:
+            cancellation_token.subscribe(cancel)
+
+        try:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            with self._condition:
+                while True:
+                    result = predicate()
+                    if not result is None:
+                        return result
+
+                    # TODO: it would be more sensible to raise an exception here but
+                    # DFU implementation assumes that None is returned on cancellation.
+                    if cancelled[0]:
+                        return None
+
+                    if deadline is None:
+                        self._condition.wait()
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise TimeoutError()
+                        self._condition.wait(remaining)
+        finally:
+            if cancellation_token:
+                cancellation_token.unsubscribe(cancel)
+
+    def find_any(self, serial_number=None, timeout=None, cancellation_token=None):
+        """
+        Blocks until a device with the specified serial number (or any device
+        if serial_number is None) is connected and returns it.
+        """
+        if serial_number is None:
+            predicate = lambda: next(iter(self._devices), None)
+        else:
+            predicate = lambda: self._by_serial_number.get(serial_number, None)
+        return self._wait(predicate, timeout, cancellation_token)
+
+    def find_all(self, count, timeout=None, cancellation_token=None):
+        """
+        Blocks until at least `count` devices are connected and returns a list
+        of the first `count` devices (in order of connection).
+        """
+        predicate = lambda: list(self._devices)[:count] if len(self._devices) >= count else None
+        return self._wait(predicate, timeout, cancellation_token)
+
+    async def wait_for(self, serial_number=None):
+        """
+        Waits until a device with the specified serial number (or any device
+        if serial_number is None) is connected and returns it.
+        Can be awaited from any event loop. Use asyncio.wait_for() for a
+        timeout.
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        with self._condition:
+            if serial_number is None:
+                device = next(iter(self._devices), None)
+            else:
+                device = self._by_serial_number.get(serial_number, None)
+            if not device is None:
+                return device
+            waiter = (serial_number, loop, future)
+            self._waiters.append(waiter)
+        try:
+            return await future
+        finally:
+            with self._condition:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def subscribe(self, callback, replay=True):
+        """
+        Registers callback(event, serial_number, device) to be invoked when a
+        device is connected (event = 'connected') or lost (event = 'lost').
+        A device that reconnects shows up as a new device object.
+        If replay is True, the callback is first invoked (on the calling
+        thread) for all devices that are already connected.
+
+        Subsequent events are delivered on the Fibre thread, so the callback
+        must not block.
+        """
+        with self._condition:
+            self._listeners.append(callback)
+            devices = list(self._devices.items()) if replay else []
+        for device, serial_number in devices:
+            callback('connected', serial_number, device)
+
+    def unsubscribe(self, callback):
+        with self._condition:
+            self._listeners.remove(callback)
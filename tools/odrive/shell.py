@@ -65,6 +65,7 @@ def launch_shell(args, logger):
         'start_liveplotter': start_liveplotter,
         'dump_errors': dump_errors,
         'benchmark': benchmark,
+        'read_many_benchmark': read_many_benchmark,
         'oscilloscope_dump': oscilloscope_dump,
         'dump_interrupts': dump_interrupts,
         'dump_threads': dump_threads,
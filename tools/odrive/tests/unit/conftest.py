@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The unit tests run without a device. They import the odrive package from
+# this checkout.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))))
@@ -0,0 +1,36 @@
+"""
+Tests for the global discovery in odrive/__init__.py. The discovery thread
+itself is not started.
+"""
+
+import pytest
+
+import odrive
+
+
+@pytest.fixture
+def discovery(monkeypatch):
+    """Resets the global discovery state and records the discoveries that are started"""
+    started = []
+    monkeypatch.setattr(odrive, '_start_discovery', lambda path, lazy: started.append((path, lazy)))
+    monkeypatch.setattr(odrive, '_discovery_started', [False])
+    monkeypatch.setattr(odrive, '_discovery_path', [None])
+    monkeypatch.setattr(odrive, '_discovery_lazy', [None])
+    return started
+
+
+def test_discovery_is_started_once(discovery):
+    registry = odrive.get_registry('usb', lazy=True)
+    assert odrive.get_registry('usb', lazy=True) is registry
+    assert discovery == [('usb', True)]
+
+def test_conflicting_path_raises(discovery):
+    odrive.get_registry('usb')
+    with pytest.raises(Exception, match="discovery path.*serial != usb"):
+        odrive.get_registry('serial')
+
+def test_conflicting_lazy_raises(discovery):
+    odrive.get_registry('usb')
+    with pytest.raises(Exception, match="lazy loading.*True != False"):
+        odrive.find_any('usb', lazy=True, timeout=0)
+    assert discovery == [('usb', False)]
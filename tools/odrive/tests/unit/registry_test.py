@@ -0,0 +1,133 @@
+"""
+Tests for odrive.registry.DeviceRegistry. The registry doesn't look into the
+device objects so plain objects stand in for devices.
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from odrive.registry import DeviceRegistry
+import fibre # after odrive, which puts its copy of fibre on the path
+
+
+class FakeDevice():
+    def __init__(self, name):
+        self.name = name
+    def __repr__(self):
+        return self.name
+
+def add_later(registry, device, serial_number, delay=0.05):
+    timer = threading.Timer(delay, lambda: registry._add(device, serial_number))
+    timer.start()
+    return timer
+
+
+def test_add_and_remove():
+    registry = DeviceRegistry()
+    dev0, dev1 = FakeDevice('dev0'), FakeDevice('dev1')
+    registry._add(dev0, '205A3591304B')
+    registry._add(dev1, '306B4602415C')
+    assert registry.get('205A3591304B') is dev0
+    assert registry.get_all() == [(dev0, '205A3591304B'), (dev1, '306B4602415C')]
+
+    registry._remove(dev0)
+    assert registry.get('205A3591304B') is None
+    assert registry.get_all() == [(dev1, '306B4602415C')]
+    registry._remove(dev0) # removing twice is harmless
+
+def test_remove_of_replaced_device_keeps_new_device():
+    # A device that reconnects can be added before the old object is removed
+    registry = DeviceRegistry()
+    old, new = FakeDevice('old'), FakeDevice('new')
+    registry._add(old, '205A3591304B')
+    registry._add(new, '205A3591304B')
+    registry._remove(old)
+    assert registry.get('205A3591304B') is new
+    assert registry.get_all() == [(new, '205A3591304B')]
+
+def test_find_any():
+    registry = DeviceRegistry()
+    dev0, dev1 = FakeDevice('dev0'), FakeDevice('dev1')
+    add_later(registry, dev0, '205A3591304B')
+    assert registry.find_any(timeout=2.0) is dev0
+    add_later(registry, dev1, '306B4602415C')
+    assert registry.find_any(serial_number='306B4602415C', timeout=2.0) is dev1
+    assert registry.find_any(serial_number='205A3591304B', timeout=0) is dev0
+
+def test_find_any_timeout():
+    registry = DeviceRegistry()
+    registry._add(FakeDevice('dev0'), '205A3591304B')
+    start = time.monotonic()
+    with pytest.raises(fibre.TimeoutError):
+        registry.find_any(serial_number='306B4602415C', timeout=0.05)
+    assert time.monotonic() - start >= 0.05
+
+def test_find_any_cancelled():
+    registry = DeviceRegistry()
+    cancellation_token = fibre.Event()
+    threading.Timer(0.05, cancellation_token.set).start()
+    assert registry.find_any(cancellation_token=cancellation_token) is None
+    assert cancellation_token._subscribers == []
+
+def test_find_all():
+    registry = DeviceRegistry()
+    devices = [FakeDevice('dev{}'.format(i)) for i in range(3)]
+    registry._add(devices[0], 'A')
+    add_later(registry, devices[1], 'B')
+    add_later(registry, devices[2], 'C', delay=0.1)
+    assert registry.find_all(2, timeout=2.0) == devices[:2]
+    time.sleep(0.1)
+    assert registry.find_all(2, timeout=0) == devices[:2]
+    with pytest.raises(fibre.TimeoutError):
+        registry.find_all(4, timeout=0.05)
+
+def test_wait_for():
+    registry = DeviceRegistry()
+    dev0, dev1 = FakeDevice('dev0'), FakeDevice('dev1')
+
+    async def wait():
+        add_later(registry, dev0, 'A')
+        add_later(registry, dev1, 'B', delay=0.1)
+        return await registry.wait_for('B'), await registry.wait_for()
+
+    assert asyncio.run(wait()) == (dev1, dev0)
+    assert registry._waiters == []
+
+def test_wait_for_timeout():
+    registry = DeviceRegistry()
+
+    async def wait():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(registry.wait_for('A'), 0.05)
+
+    asyncio.run(wait())
+    assert registry._waiters == [] # the cancelled waiter was removed
+    registry._add(FakeDevice('dev0'), 'A')
+
+def test_subscribe():
+    registry = DeviceRegistry()
+    dev0, dev1 = FakeDevice('dev0'), FakeDevice('dev1')
+    registry._add(dev0, 'A')
+
+    events = []
+    callback = lambda event, serial_number, device: events.append((event, serial_number, device))
+    registry.subscribe(callback)
+    assert events == [('connected', 'A', dev0)]
+
+    registry._add(dev1, 'B')
+    registry._remove(dev0)
+    assert events[1:] == [('connected', 'B', dev1), ('lost', 'A', dev0)]
+
+    registry.unsubscribe(callback)
+    registry._remove(dev1)
+    assert len(events) == 3
+
+def test_subscribe_without_replay():
+    registry = DeviceRegistry()
+    registry._add(FakeDevice('dev0'), 'A')
+    events = []
+    registry.subscribe(lambda *args: events.append(args), replay=False)
+    assert events == []
@@ -6,6 +6,7 @@ import threading
 import platform
 import subprocess
 import os
+import fibre
 from fibre.utils import Event
 import odrive.enums
 from odrive.enums import *
@@ -135,12 +136,18 @@ def oscilloscope_dump(odrv, num_vals, filename='oscilloscope.csv'):
 data_rate = 200
 plot_rate = 10
 num_samples = 500
-def start_liveplotter(get_var_callback):
+def start_liveplotter(get_var_callback=None, device=None, paths=None):
     """
     Starts a liveplotter.
     The variable that is plotted is retrieved from get_var_callback.
     This function returns immediately and the liveplotter quits when
     the user closes it.
+
+    Instead of get_var_callback, a device and a list of dotted paths can be
+    specified, e.g.
+        start_liveplotter(device=odrv0, paths=['axis0.encoder.pos_estimate'])
+    The properties are then sampled with fibre.subscribe() on the Fibre
+    thread, which keeps the sampling rate steady.
     """
 
     import matplotlib.pyplot as plt
@@ -163,6 +170,17 @@ def start_liveplotter(get_var_callback):
                 vals = vals[-num_samples:]
             time.sleep(1/data_rate)
 
+    def fetch_subscribed_data():
+        global vals
+        subscription = fibre.subscribe(device, paths, data_rate, capacity=num_samples)
+        while not cancellation_token.is_set():
+            vals = (vals + [list(row)[1:] for row in subscription.drain()])[-num_samples:]
+            if not subscription.error is None:
+                print(str(subscription.error))
+                break
+            time.sleep(1/plot_rate)
+        subscription.stop()
+
     # TODO: use animation for better UI performance, see:
     # https://matplotlib.org/examples/animation/simple_anim.html
     def plot_data():
@@ -183,7 +201,7 @@ def start_liveplotter(get_var_callback):
             fig.canvas.draw()
             fig.canvas.start_event_loop(1/plot_rate)
 
-    fetch_t = threading.Thread(target=fetch_data)
+    fetch_t = threading.Thread(target=fetch_data if device is None else fetch_subscribed_data)
     fetch_t.daemon = True
     fetch_t.start()
     
@@ -202,9 +220,15 @@ class BulkCapture:
     get_var_callback: a function that returns the data you want to collect (see the example below)
     data_rate: Rate in hz
     length: Length of time to capture in seconds
+    device, paths: can be specified instead of get_var_callback. The
+        properties at the dotted paths (relative to device) are then sampled
+        with fibre.subscribe() on the Fibre thread. In this case data is a numpy
+        structured array (see fibre.Subscription.drain()) and each value keeps
+        the type of its property.
 
     Example Usage:
         capture = BulkCapture(lambda :[odrv0.axis0.encoder.pos_estimate, odrv0.axis0.controller.pos_setpoint])
+        # or: capture = BulkCapture(device=odrv0.axis0, paths=['encoder.pos_estimate', 'controller.pos_setpoint'])
         # Do stuff while capturing (like sending position commands)
         capture.event.wait() # When you're done doing stuff, wait for the capture to be completed.
         print(capture.data) # Do stuff with the data
@@ -212,14 +236,31 @@ class BulkCapture:
     '''
 
     def __init__(self,
-                 get_var_callback,
+                 get_var_callback=None,
                  data_rate=500.0,
-                 duration=2.0):
+                 duration=2.0,
+                 device=None,
+                 paths=None):
         from threading import Event, Thread
         import numpy as np
 
         self.get_var_callback = get_var_callback
+        self.paths = paths
         self.event = Event()
+        def subscribed_loop():
+            # The capacity leaves room for the samples that arrive while the
+            # thread wakes up
+            start_time = time.monotonic()
+            subscription = fibre.subscribe(device, paths, data_rate, capacity=int(data_rate * duration * 1.5) + 1)
+            time.sleep(duration)
+            subscription.stop()
+            data = subscription.drain()
+            if not subscription.error is None:
+                print(str(subscription.error))
+            data['time'] -= start_time
+            self.data = data[data['time'] < duration]
+            print("Capture complete")
+            self.event.set()
         def loop():
             vals = []
             start_time = time.monotonic()
@@ -242,12 +283,19 @@ class BulkCapture:
                 print("Achieved average data rate: {}Hz".format(achieved_data_rate))
                 print("If this rate is significantly lower than what you specified, consider lowering it below the achieved value for more consistent sampling.")
             self.event.set() # tell the main thread that the bulk capture is complete
-        Thread(target=loop, daemon=True).start()
+        Thread(target=loop if get_var_callback else subscribed_loop, daemon=True).start()
     
     def plot(self):
         import matplotlib.pyplot as plt
         import inspect
         from textwrap import wrap
+        if self.get_var_callback is None:
+            for path in self.paths:
+                plt.plot(self.data['time'], self.data[path])
+            plt.xlabel("Time (seconds)")
+            plt.legend(self.paths)
+            plt.show()
+            return
         plt.plot(self.data[:,0], self.data[:,1:])
         plt.xlabel("Time (seconds)")
         title = (str(inspect.getsource(self.get_var_callback))
@@ -265,12 +313,12 @@ def step_and_plot(  axis,
                     ctrl_mode=CONTROL_MODE_POSITION_CONTROL):
     
     if ctrl_mode is CONTROL_MODE_POSITION_CONTROL:
-        get_var_callback = lambda :[axis.encoder.pos_estimate, axis.controller.pos_setpoint]
+        paths = ['encoder.pos_estimate', 'controller.pos_setpoint']
         initial_setpoint = axis.encoder.pos_estimate
         def set_setpoint(setpoint):
             axis.controller.pos_setpoint = setpoint
     elif ctrl_mode is CONTROL_MODE_VELOCITY_CONTROL:
-        get_var_callback = lambda :[axis.encoder.vel_estimate, axis.controller.vel_setpoint]
+        paths = ['encoder.vel_estimate', 'controller.vel_setpoint']
         initial_setpoint = 0
         def set_setpoint(setpoint):
             axis.controller.vel_setpoint = setpoint
@@ -284,7 +332,7 @@ def step_and_plot(  axis,
     axis.controller.config.control_mode = ctrl_mode
     axis.requested_state = AXIS_STATE_CLOSED_LOOP_CONTROL
     
-    capture = BulkCapture(get_var_callback,
+    capture = BulkCapture(device=axis, paths=paths,
                           data_rate=data_rate,
                           duration=initial_settle_time + settle_time)
 
@@ -347,6 +395,87 @@ def rate_test(device):
     # plt.plot(vals)
     # plt.show(block=True)
 
+default_telemetry_paths = [
+    'vbus_voltage', 'ibus',
+    'axis0.encoder.pos_estimate', 'axis0.encoder.vel_estimate',
+    'axis0.motor.current_control.Iq_measured', 'axis0.controller.pos_setpoint',
+    'axis1.encoder.pos_estimate', 'axis1.encoder.vel_estimate',
+    'axis1.motor.current_control.Iq_measured', 'axis1.controller.pos_setpoint',
+]
+
+def read_many_benchmark(device, paths=default_telemetry_paths, num_frames=100):
+    """
+    Compares the rate at which a set of properties can be polled when they are
+    read one after another versus when they are read with fibre.read_many().
+    """
+    import fibre
+
+    def get_path(obj, path):
+        for key in path.split('.'):
+            obj = getattr(obj, key)
+        return obj
+
+    print("reading {} properties {} times one by one...".format(len(paths), num_frames))
+    start = time.monotonic()
+    for _ in range(num_frames):
+        [get_path(device, path) for path in paths]
+    sequential_rate = num_frames / (time.monotonic() - start)
+    print("Frames per second: {:.1f}".format(sequential_rate))
+
+    print("reading {} properties {} times with read_many()...".format(len(paths), num_frames))
+    start = time.monotonic()
+    for _ in range(num_frames):
+        fibre.read_many(device, paths)
+    batched_rate = num_frames / (time.monotonic() - start)
+    print("Frames per second: {:.1f} ({:.1f}x)".format(batched_rate, batched_rate / sequential_rate))
+
+def connect_benchmark(path, num_runs=3):
+    """
+    Measures the time from opening a fibre.Domain until the first property
+    read on the discovered device completes, once with the complete object
+    tree loaded at discovery (eager) and once with lazy loading.
+    Must be called while no other fibre.Domain is open.
+    """
+    import fibre
+
+    for lazy in [False, True]:
+        durations = []
+        for _ in range(num_runs):
+            start = time.monotonic()
+            with fibre.Domain(path, lazy=lazy) as domain:
+                device = domain.discover_one()
+                device.vbus_voltage
+                durations.append(time.monotonic() - start)
+        print("{}: time to first read {:.3f}s (best of {})".format(
+            "lazy" if lazy else "eager", min(durations), num_runs))
+
+def remote_object_benchmark(device, num_assignments=100000):
+    """
+    Loads the complete object tree of the device and reports the memory
+    footprint of the Python-side remote objects and the cost of assigning an
+    internal attribute (which fibre does for every object it loads).
+    No calls are made to the device.
+    """
+    import sys
+    import fibre.libfibre
+
+    objects = list(fibre.libfibre._iterate_tree(device))
+    total_size = 0
+    for obj in objects:
+        instance_dict = getattr(obj, '__dict__', {})
+        parts = [obj, instance_dict,
+                 getattr(obj, '_children', None), getattr(obj, '_attribute_cache', None),
+                 instance_dict.get('_on_lost', None) or getattr(obj, '_on_lost_future', None)]
+        total_size += sum(sys.getsizeof(part) for part in parts if not part is None)
+        total_size += sum(sys.getsizeof(part.__dict__) for part in parts[2:] if hasattr(part, '__dict__'))
+    print("{} objects, {:.0f} bytes per object".format(len(objects), total_size / len(objects)))
+
+    start = time.monotonic()
+    for _ in range(num_assignments):
+        device._refcount = device._refcount
+    duration = time.monotonic() - start
+    print("attribute assignment: {:.2f}us".format(duration / num_assignments * 1e6))
+
 def usb_burn_in_test(get_var_callback, cancellation_token):
     """
     Starts background threads that read a values form the USB device in a spin-loop